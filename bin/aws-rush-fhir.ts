@@ -28,6 +28,14 @@ const app = new App();
 const envName = app.node.tryGetContext('envName') || process.env.envName || 'dev'
 const vpcCidr = app.node.tryGetContext('vpcCidr') || process.env.vpcCidr || '10.0.0.0/16'
 const healthLakeEndpoint = app.node.tryGetContext('vpcCidr') || process.env.healthLakeEndpoint || 'UNDEFINED'
+const ccdBatchSize = Number(app.node.tryGetContext('ccdBatchSize') || process.env.ccdBatchSize || 1)
+const ccdBatchingWindowSeconds = Number(app.node.tryGetContext('ccdBatchingWindowSeconds') || process.env.ccdBatchingWindowSeconds || 0)
+// the same dedup horizon is applied to the CCD and bedcap hash tables
+const hashRetentionDays = Number(app.node.tryGetContext('hashRetentionDays') || process.env.hashRetentionDays || 365)
+const ccdFusedValidation = String(app.node.tryGetContext('ccdFusedValidation') || process.env.ccdFusedValidation || 'false') === 'true'
+const ccdValidationMode = String(app.node.tryGetContext('ccdValidationMode') || process.env.ccdValidationMode || 'FULL').toUpperCase()
+// main CDA XSD file in the processed bucket, used by the STRICT validation mode
+const cdaSchemaKey = String(app.node.tryGetContext('cdaSchemaKey') || process.env.cdaSchemaKey || 'cda_schema/CDA.xsd')
 
 const InfraStack = new infraStack(app, envName+'Infra',{
   envName: envName,
@@ -42,11 +50,18 @@ FhirConv.addDependency(InfraStack,'DeployAfterInfra');
 const FhirStack = new fhirStack(app, envName+'Fhir',{
   envName: envName,
   healthLakeEndpoint: healthLakeEndpoint,
+  ccdBatchSize: ccdBatchSize,
+  ccdBatchingWindowSeconds: ccdBatchingWindowSeconds,
+  ccdFusedValidation: ccdFusedValidation,
+  ccdValidationMode: ccdValidationMode,
+  cdaSchemaKey: cdaSchemaKey,
+  hashRetentionDays: hashRetentionDays,
 });
 FhirStack.addDependency(InfraStack,'DeployAfterInfra')
 FhirStack.addDependency(FhirConv,'DeployAfterFhirConv')  // fhir stack needs fhir conv url
 
 const BedCapStack =  new bedcapStack(app, envName+'BedCap',{
   envName: envName,
+  hashRetentionDays: hashRetentionDays,
 });
 
@@ -3,13 +3,15 @@ import os
 import boto3
 import logging
 from botocore.exceptions import ClientError
-from datetime import datetime
+from datetime import datetime, timedelta
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 
 DYNAMODB_CLIENT = boto3.client("dynamodb")
 DYNAMODB_JUVARE_HASH_TABLE_LOG = os.environ["DYNAMODB_JUVARE_HASH_TABLE_LOG"]
+# Days the hashes are kept in the hash table, the expiration_time TTL attribute is set when saved, 0 never expires
+HASH_RETENTION_DAYS = int(os.environ.get("HASH_RETENTION_DAYS", "0"))
 DYNAMODB_JUVARE_EXECUTION_LOG = os.environ["DYNAMODB_JUVARE_EXECUTION_LOG"]
 
 
@@ -54,21 +56,35 @@ def update_dynamodb_log(lambdaId, status, error_result):
 
 
 def put_dynamodb_hash(lambdaId, creation_date, ccd_hash, filename):
+    item = {
+        "md5Digest": {"S": ccd_hash},
+        "lambdaId": {"S": lambdaId},
+        "filename": {"S": filename},
+        "creation_date": {"N": f"{creation_date}"},
+    }
+    if HASH_RETENTION_DAYS > 0:
+        expiration_time = datetime.fromtimestamp(creation_date) + timedelta(days=HASH_RETENTION_DAYS)
+        item["expiration_time"] = {"N": f"{int(expiration_time.timestamp())}"}
+
     try:
         DYNAMODB_CLIENT.put_item(
             TableName=DYNAMODB_JUVARE_HASH_TABLE_LOG,
-            Item={
-                "md5Digest": {"S": ccd_hash},
-                "lambdaId": {"S": lambdaId},
-                "filename": {"S": filename},
-                "creation_date": {"N": f"{creation_date}"},
-            },
+            Item=item,
         )
     except ClientError as err:
         LOGGER.error(f"## DYNAMODB PUT HASH EXCEPTION: {str(err)}")
         raise err("Error adding hash to table")
 
 
+def is_hash_expired(item) -> bool:
+    """
+    Check if the TTL of the hash item is past, DynamoDB deletes the expired items up to 48 hours later
+    :param item: the hash item
+    :return: True if the item has an expiration_time in the past
+    """
+    return "expiration_time" in item and int(item["expiration_time"]["N"]) < int(datetime.now().timestamp())
+
+
 def is_hash_existent(lambdaId, md5_digest, filename) -> bool:
     """
     Query the DynamoDB 'message' table for the item containing the given message ID
@@ -80,7 +96,7 @@ def is_hash_existent(lambdaId, md5_digest, filename) -> bool:
             TableName=DYNAMODB_JUVARE_HASH_TABLE_LOG, Key={"md5Digest": {"S": md5_digest}}
         )
 
-        if "Item" in response:
+        if "Item" in response and not is_hash_expired(response["Item"]):
             lambdaId_hash = response["Item"]["lambdaId"]["S"]
             LOGGER.info(f"JUVARE HASH {md5_digest} already found in table, lambdaId {lambdaId_hash}")
 
@@ -0,0 +1,537 @@
+"""
+File: lambda_function.py
+Project: ccda_dataset_compaction
+Description: Merge the small parquet files of the FHIR datasets, saved by step 5 for each message,
+into a few large files sorted for each resource type and day.
+
+The files are merged in batches of up to COMPACTION_BATCH_BYTES, so the memory doesn't grow with the files of the day.
+S3 has no atomic rename, so the merged files are written to a new folder of the compacted datasets, outside the partition,
+and the Glue partition of the day is moved to it, so the queries see the original files or the merged ones, never both.
+A manifest with the original files is saved before the move, so a run stopped after it finishes the move
+and deletes the original files, without merging them again.
+
+Usage:
+    python lambda/ccda_dataset_compaction/lambda_function.py --bucket dev-processed --glue-database dev-fhir --date 2021-01-08
+    python lambda/ccda_dataset_compaction/lambda_function.py --bucket dev-processed --date 2021-01-08 --resource-type observations --dry-run
+"""
+
+# Import the libraries
+import io
+import os
+import json
+import uuid
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import boto3
+from botocore.config import Config
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from utils import dataset_schemas, glue_catalog
+
+# Instatiate the Logger to save messages to Cloudwatch
+logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s")
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Load the enviroment variables, the arguments of the command line are used if not defined
+BUCKET_PROCESSED_FHIR_DATASETS = os.environ.get("BUCKET_PROCESSED_FHIR_DATASETS", "")
+FOLDER_PROCESSED_FHIRS_DATASETS = os.environ.get("FOLDER_PROCESSED_FHIRS_DATASETS", "fhir_datasets")
+# Folder of the merged files, outside the folder of the partitions written by step 5
+FOLDER_COMPACTED_FHIR_DATASETS = os.environ.get("FOLDER_COMPACTED_FHIR_DATASETS", "fhir_datasets_compacted")
+# Glue database where step 5 registers the partitions, moved to the merged files
+GLUE_DATABASE = os.environ.get("GLUE_DATABASE", "")
+GLUE_TABLE_PREFIX = os.environ.get("GLUE_TABLE_PREFIX", "fhir_")
+# Max rows of each merged file
+COMPACTION_ROWS_PER_FILE = int(os.environ.get("COMPACTION_ROWS_PER_FILE", "1000000"))
+# Max size of the original files merged together, bounds the memory used by a batch
+COMPACTION_BATCH_BYTES = int(os.environ.get("COMPACTION_BATCH_BYTES", f"{128 * 1024 * 1024}"))
+# Files downloaded at the same time
+COMPACTION_READ_WORKERS = int(os.environ.get("COMPACTION_READ_WORKERS", "32"))
+# Parquet writer settings, the same used by step 5
+PARQUET_COMPRESSION = os.environ.get("PARQUET_COMPRESSION", "zstd")
+PARQUET_COMPRESSION_LEVEL = int(os.environ.get("PARQUET_COMPRESSION_LEVEL", "3"))
+PARQUET_ROW_GROUP_SIZE = int(os.environ.get("PARQUET_ROW_GROUP_SIZE", "131072"))
+
+# Instantiate the service clients
+S3_CLIENT = boto3.client("s3", config=Config(max_pool_connections=COMPACTION_READ_WORKERS))
+GLUE_CLIENT = boto3.client("glue")
+
+# Partitions of the datasets in the Glue Data Catalog
+GLUE_REGISTRY = glue_catalog.GluePartitionRegistry(GLUE_CLIENT, GLUE_DATABASE, GLUE_TABLE_PREFIX)
+
+# Set extra constants
+RUN_PREFIX = "run_id="
+# Saved in the folder of a run before the partition is moved to it
+MANIFEST_NAME = "_manifest.json"
+# Maximum number of keys of a DeleteObjects request
+S3_DELETE_LIMIT = 1000
+# Columns used to sort the merged files, so the readers can skip the row groups by the statistics
+SORT_KEYS = {
+    "person": ["person_id"],
+    "encounters": ["person_id", "start"],
+    "conditions": ["person_id", "encounter_id"],
+    "medications": ["person_id", "encounter_id"],
+    "observations": ["person_id", "testDate"],
+}
+
+
+def day_prefix(folder, resource_type, day):
+    """Prefix of the files of a resource type and day, with the same partitions saved by step 5
+
+    Args:
+        folder (str): Datasets folder, the one of step 5 or the one of the merged files
+        resource_type (str): Dataset name
+        day (datetime): Day of the partition
+
+    Returns:
+        str: Prefix in the datasets bucket
+    """
+    return f"{folder}/resource_type={resource_type}/year={day.year}/month={day.month}/day={day.day}/"
+
+
+def partition_values(day):
+    """Values of the Glue partition of a day, the same registered by step 5
+
+    Args:
+        day (datetime): Day of the partition
+
+    Returns:
+        tuple: Year, month and day values
+    """
+    return (str(day.year), str(day.month), str(day.day))
+
+
+def list_files(bucket, prefix):
+    """List the parquet files under the prefix, the files starting with underscore are ignored, as Athena and Glue do
+
+    Args:
+        bucket (str): Datasets bucket
+        prefix (str): Prefix of the files
+
+    Returns:
+        list: Keys and sizes of the parquet files
+    """
+    files = []
+    paginator = S3_CLIENT.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            name = os.path.basename(item["Key"])
+            if name.endswith(".parquet") and not name.startswith("_"):
+                files.append((item["Key"], item["Size"]))
+    return files
+
+
+def list_runs(bucket, prefix):
+    """List the folders of the runs of a resource type and day in the compacted datasets
+
+    Args:
+        bucket (str): Datasets bucket
+        prefix (str): Prefix of the day in the compacted datasets
+
+    Returns:
+        dict: Keys of the files of each run folder, and the key of its manifest, None if not saved
+    """
+    runs = {}
+    paginator = S3_CLIENT.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            folder = os.path.dirname(item["Key"]) + "/"
+            run = runs.setdefault(folder, {"keys": [], "manifest": None})
+            if os.path.basename(item["Key"]) == MANIFEST_NAME:
+                run["manifest"] = item["Key"]
+            else:
+                run["keys"].append(item["Key"])
+    return runs
+
+
+def batch_files(files, max_bytes):
+    """Group the files in batches of up to max_bytes, a file bigger than max_bytes is a batch alone
+
+    Args:
+        files (list): Keys and sizes of the files
+        max_bytes (int): Max size of the files of a batch
+
+    Returns:
+        list: Keys of the files of each batch
+    """
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for key, size in files:
+        if batch and batch_bytes + size > max_bytes:
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(key)
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def read_dataset_file(bucket, key, schema):
+    """Read a dataset file, converted to the declared schema
+
+    Args:
+        bucket (str): Datasets bucket
+        key (str): Key of the file
+        schema (pyarrow.Schema): Declared schema of the dataset
+
+    Returns:
+        pyarrow.Table: File content
+    """
+    dataset_file = S3_CLIENT.get_object(Bucket=bucket, Key=key)
+    table = pq.read_table(io.BytesIO(dataset_file["Body"].read()))
+    return dataset_schemas.conform_table(table, schema)
+
+
+def sort_table(table, resource_type):
+    """Sort the rows by the SORT_KEYS of the dataset
+
+    Args:
+        table (pyarrow.Table): Merged table
+        resource_type (str): Dataset name
+
+    Returns:
+        pyarrow.Table: Sorted table
+    """
+    sort_keys = [(name, "ascending") for name in SORT_KEYS[resource_type]]
+    return table.take(pc.sort_indices(table, sort_keys=sort_keys))
+
+
+def write_dataset_file(bucket, key, table):
+    """Write the table as parquet and save it to S3
+
+    Args:
+        bucket (str): Datasets bucket
+        key (str): Key of the file
+        table (pyarrow.Table): Table to save
+    """
+    parquet_buffer = io.BytesIO()
+    pq.write_table(
+        table,
+        parquet_buffer,
+        compression=PARQUET_COMPRESSION,
+        compression_level=PARQUET_COMPRESSION_LEVEL,
+        row_group_size=PARQUET_ROW_GROUP_SIZE,
+        coerce_timestamps="ms",
+        allow_truncated_timestamps=True,
+    )
+    S3_CLIENT.put_object(Body=parquet_buffer.getvalue(), Bucket=bucket, Key=key)
+
+
+def count_rows(bucket, key):
+    """Number of rows of a saved parquet file, read from the footer
+
+    Args:
+        bucket (str): Datasets bucket
+        key (str): Key of the file
+
+    Returns:
+        int: Rows of the file
+    """
+    dataset_file = S3_CLIENT.get_object(Bucket=bucket, Key=key)
+    return pq.read_metadata(io.BytesIO(dataset_file["Body"].read())).num_rows
+
+
+def delete_files(bucket, keys):
+    """Delete the files in batches of S3_DELETE_LIMIT
+
+    Args:
+        bucket (str): Datasets bucket
+        keys (list): Keys of the files
+
+    Raises:
+        RuntimeError: Raised if any of the files can't be deleted
+    """
+    for start in range(0, len(keys), S3_DELETE_LIMIT):
+        response = S3_CLIENT.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in keys[start : start + S3_DELETE_LIMIT]], "Quiet": True},
+        )
+        if response.get("Errors"):
+            raise RuntimeError(f"Failed to delete {len(response['Errors'])} files: {response['Errors'][:5]}")
+
+
+def ensure_table(bucket, resource_type):
+    """Create the Glue table of the dataset if it doesn't exist, with the same location used by step 5
+
+    Args:
+        bucket (str): Datasets bucket
+        resource_type (str): Dataset name
+
+    Raises:
+        RuntimeError: Raised if the table can't be created
+    """
+    location = f"s3://{bucket}/{FOLDER_PROCESSED_FHIRS_DATASETS}/resource_type={resource_type}/"
+    if not GLUE_REGISTRY.ensure_table(resource_type, dataset_schemas.SCHEMAS[resource_type], location):
+        raise RuntimeError(f"Glue table of {resource_type} can't be created")
+
+
+def publish_run(bucket, resource_type, day, manifest_key):
+    """Move the Glue partition to the merged files of a run, then delete the original files, the merged files
+    of the previous run and the manifest. Every step can be repeated, so a run stopped at any point after the manifest
+    was saved is finished by the next run, and its original files are deleted without being merged again.
+
+    Args:
+        bucket (str): Datasets bucket
+        resource_type (str): Dataset name
+        day (datetime): Day of the partition
+        manifest_key (str): Key of the manifest of the run
+
+    Raises:
+        RuntimeError: Raised if the partition was moved by someone else since the manifest was saved, nothing is deleted
+    """
+    manifest_file = S3_CLIENT.get_object(Bucket=bucket, Key=manifest_key)
+    manifest = json.loads(manifest_file["Body"].read())
+    values = partition_values(day)
+
+    location = GLUE_REGISTRY.partition_location(resource_type, values)
+    if location != manifest["location"]:
+        if location != manifest["previous_location"]:
+            raise RuntimeError(f"Partition {values} of {resource_type} was moved to {location} after {manifest_key}")
+        # From here the queries of the partition read the merged files only
+        schema = dataset_schemas.SCHEMAS[resource_type]
+        GLUE_REGISTRY.move_partition(resource_type, schema, values, manifest["location"])
+
+    delete_files(bucket, manifest["sources"])
+    delete_files(bucket, manifest["previous"])
+    delete_files(bucket, [manifest_key])
+
+
+def compact_batch(bucket, resource_type, output_folder, keys, first_part):
+    """Merge a batch of files into files of up to COMPACTION_ROWS_PER_FILE rows in the folder of the run
+        # 1. Read the files and sort the rows
+        # 2. Write the merged files, not visible to the queries until the partition is moved to the folder of the run
+        # 3. Verify the rows of the merged files
+
+    Args:
+        bucket (str): Datasets bucket
+        resource_type (str): Dataset name
+        output_folder (str): Folder of the run
+        keys (list): Keys of the files of the batch
+        first_part (int): Number of the first merged file
+
+    Raises:
+        RuntimeError: Raised if the rows of the merged files don't match the original files
+
+    Returns:
+        tuple: Rows and keys of the files written
+    """
+    schema = dataset_schemas.SCHEMAS[resource_type]
+    with ThreadPoolExecutor(max_workers=COMPACTION_READ_WORKERS) as executor:
+        tables = list(executor.map(lambda key: read_dataset_file(bucket, key, schema), keys))
+
+    # The dictionaries of each file are merged, so all the chunks have the same dictionary
+    table = sort_table(pa.concat_tables(tables).unify_dictionaries(), resource_type)
+    del tables
+
+    written_keys = []
+    for part, start in enumerate(range(0, table.num_rows, COMPACTION_ROWS_PER_FILE), first_part):
+        key = f"{output_folder}part-{part:05d}.parquet"
+        write_dataset_file(bucket, key, table.slice(start, COMPACTION_ROWS_PER_FILE))
+        written_keys.append(key)
+
+    written_rows = sum(count_rows(bucket, key) for key in written_keys)
+    if written_rows != table.num_rows:
+        raise RuntimeError(f"Compaction of {output_folder} wrote {written_rows} rows, expected {table.num_rows}")
+
+    return table.num_rows, written_keys
+
+
+def finish_runs(bucket, resource_type, day):
+    """Finish the runs stopped after saving their manifest, and delete the folders of the runs stopped before it,
+    never read as the partition was not moved to them
+
+    Args:
+        bucket (str): Datasets bucket
+        resource_type (str): Dataset name
+        day (datetime): Day of the partition
+    """
+    compacted_prefix = day_prefix(FOLDER_COMPACTED_FHIR_DATASETS, resource_type, day)
+    runs = list_runs(bucket, compacted_prefix)
+
+    for folder, run in runs.items():
+        if run["manifest"]:
+            LOGGER.info(f"---- FINISHING THE RUN OF {run['manifest']} ----")
+            publish_run(bucket, resource_type, day, run["manifest"])
+
+    location = GLUE_REGISTRY.partition_location(resource_type, partition_values(day))
+    for folder, run in runs.items():
+        if not run["manifest"] and location != f"s3://{bucket}/{folder}":
+            delete_files(bucket, run["keys"])
+
+
+def compact_partition(bucket, resource_type, day, dry_run=False):
+    """Merge the files of the messages of a resource type and day, with the merged files of the previous run,
+    into a new folder of the compacted datasets, and move the Glue partition of the day to it
+        # 1. Finish the runs stopped after saving their manifest, and remove the folders of the runs stopped before it
+        # 2. List the files of the messages, and the merged files of the previous run, the current partition location
+        # 3. Copy the merged files of the previous run to the folder of this run, they are not merged again
+        # 4. Merge each batch of files of the messages, of up to COMPACTION_BATCH_BYTES
+        # 5. Save the manifest with the original files and the files of the previous run
+        # 6. Move the partition to the folder of this run, and delete the original files and the previous run
+
+    Args:
+        bucket (str): Datasets bucket
+        resource_type (str): Dataset name
+        day (datetime): Day of the partition
+        dry_run (bool, optional): If True, only count the files and rows. Defaults to False.
+
+    Raises:
+        RuntimeError: Raised if the rows of the merged files of a batch don't match its original files,
+        the partition is not moved and nothing is deleted
+
+    Returns:
+        dict: Files and rows read and written
+    """
+    prefix = day_prefix(FOLDER_PROCESSED_FHIRS_DATASETS, resource_type, day)
+    compacted_prefix = day_prefix(FOLDER_COMPACTED_FHIR_DATASETS, resource_type, day)
+
+    if not dry_run:
+        ensure_table(bucket, resource_type)
+        finish_runs(bucket, resource_type, day)
+
+    message_files = list_files(bucket, prefix)
+    result = {
+        "resource_type": resource_type,
+        "prefix": prefix,
+        "files_read": len(message_files),
+        "files_written": 0,
+        "rows": 0,
+    }
+
+    if not message_files:
+        LOGGER.info(f"---- {prefix} NOTHING TO COMPACT ----")
+        return result
+
+    if dry_run:
+        for keys in batch_files(message_files, COMPACTION_BATCH_BYTES):
+            rows = sum(count_rows(bucket, key) for key in keys)
+            result["rows"] += rows
+            result["files_written"] += -(-rows // COMPACTION_ROWS_PER_FILE)
+        return result
+
+    # The merged files of the previous run are the ones of the current location, if it was already compacted
+    previous_location = GLUE_REGISTRY.partition_location(resource_type, partition_values(day))
+    previous_keys = []
+    if previous_location and previous_location.startswith(f"s3://{bucket}/{compacted_prefix}"):
+        previous_keys = [key for key, _ in list_files(bucket, previous_location[len(f"s3://{bucket}/") :])]
+
+    run_id = f"{datetime.utcnow().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    output_folder = f"{compacted_prefix}{RUN_PREFIX}{run_id}/"
+
+    for part, key in enumerate(previous_keys):
+        S3_CLIENT.copy_object(
+            Bucket=bucket, CopySource={"Bucket": bucket, "Key": key}, Key=f"{output_folder}part-{part:05d}.parquet"
+        )
+
+    written_keys = []
+    for keys in batch_files(message_files, COMPACTION_BATCH_BYTES):
+        first_part = len(previous_keys) + len(written_keys)
+        rows, batch_keys = compact_batch(bucket, resource_type, output_folder, keys, first_part)
+        result["rows"] += rows
+        written_keys.extend(batch_keys)
+    result["files_written"] = len(written_keys)
+
+    manifest_key = f"{output_folder}{MANIFEST_NAME}"
+    manifest = {
+        "sources": [key for key, _ in message_files],
+        "previous": previous_keys,
+        "location": f"s3://{bucket}/{output_folder}",
+        "previous_location": previous_location,
+    }
+    S3_CLIENT.put_object(Body=json.dumps(manifest).encode("utf-8"), Bucket=bucket, Key=manifest_key)
+    publish_run(bucket, resource_type, day, manifest_key)
+
+    LOGGER.info(f"---- {prefix} COMPACTED ---- {result}")
+    return result
+
+
+def compact_day(bucket, day, resource_types=None, dry_run=False):
+    """Compact the datasets of a day
+
+    Args:
+        bucket (str): Datasets bucket
+        day (datetime): Day of the partitions
+        resource_types (list, optional): Datasets to compact. Defaults to all the datasets.
+        dry_run (bool, optional): If True, only count the files and rows. Defaults to False.
+
+    Raises:
+        ValueError: Raised if there is no Glue database, the merged files are only read through the Glue partitions
+
+    Returns:
+        list: Result of each dataset
+    """
+    if not dry_run and not GLUE_REGISTRY.database:
+        raise ValueError("GLUE_DATABASE is required to move the partitions to the merged files")
+
+    return [
+        compact_partition(bucket, resource_type, day, dry_run)
+        for resource_type in resource_types or dataset_schemas.SCHEMAS
+    ]
+
+
+def lambda_handler(event, context):
+    """Compact the datasets of a day, scheduled after the end of the day, so step 5 is not writing to the partitions.
+    Files saved by step 5 after the partition was moved are not read by the queries until the day is compacted again.
+
+    Args:
+        event (dict): Lambda Event, with the optional day as YYYY-MM-DD and resource_types, default yesterday
+        context (dict): Lambda Context
+
+    Returns:
+        dict: Result of each dataset
+    """
+    if event.get("day"):
+        day = datetime.strptime(event["day"], "%Y-%m-%d")
+    else:
+        day = datetime.utcnow() - timedelta(days=1)
+
+    results = compact_day(BUCKET_PROCESSED_FHIR_DATASETS, day, event.get("resource_types"), event.get("dry_run", False))
+    return {"day": day.strftime("%Y-%m-%d"), "Results": results}
+
+
+def main():
+    global FOLDER_PROCESSED_FHIRS_DATASETS, FOLDER_COMPACTED_FHIR_DATASETS
+
+    parser = argparse.ArgumentParser(description="Merge the small parquet files of the FHIR datasets of a day")
+    parser.add_argument("--bucket", default=BUCKET_PROCESSED_FHIR_DATASETS, help="Datasets bucket")
+    parser.add_argument("--folder", default=FOLDER_PROCESSED_FHIRS_DATASETS, help="Datasets folder, default fhir_datasets")
+    parser.add_argument(
+        "--compacted-folder",
+        default=FOLDER_COMPACTED_FHIR_DATASETS,
+        help="Folder of the merged files, default fhir_datasets_compacted",
+    )
+    parser.add_argument("--glue-database", default=GLUE_DATABASE, help="Glue database of the datasets")
+    parser.add_argument("--glue-table-prefix", default=GLUE_TABLE_PREFIX, help="Prefix of the tables, default fhir_")
+    parser.add_argument("--date", required=True, help="Day of the partitions, YYYY-MM-DD")
+    parser.add_argument(
+        "--resource-type",
+        action="append",
+        choices=list(dataset_schemas.SCHEMAS),
+        help="Dataset to compact, can be repeated, default all",
+    )
+    parser.add_argument("--dry-run", action="store_true", help="Count the files and rows without writing")
+    args = parser.parse_args()
+
+    if not args.bucket:
+        parser.error("--bucket is required if BUCKET_PROCESSED_FHIR_DATASETS is not defined")
+    if not args.glue_database and not args.dry_run:
+        parser.error("--glue-database is required if GLUE_DATABASE is not defined")
+    FOLDER_PROCESSED_FHIRS_DATASETS = args.folder
+    FOLDER_COMPACTED_FHIR_DATASETS = args.compacted_folder
+    GLUE_REGISTRY.database = args.glue_database
+    GLUE_REGISTRY.table_prefix = args.glue_table_prefix
+
+    day = datetime.strptime(args.date, "%Y-%m-%d")
+    for result in compact_day(args.bucket, day, args.resource_type, args.dry_run):
+        LOGGER.info(f"{result}{' (dry run)' if args.dry_run else ''}")
+
+
+if __name__ == "__main__":
+    main()
@@ -67,19 +67,34 @@ def save_dynamodb_log(aws_request_id, sqs_message_id, source_event, creation_dat
         LOGGER.error(f"## DYNAMODB PUT MESSAGEID EXCEPTION: {str(e)}")
 
 
-def delete_hash_log(md5_digest):
-    """Remove the hash from the DynamoDB Hash table log if needed
+def delete_hash_log(md5_digest, sqs_message_id):
+    """Remove the hash from the DynamoDB Hash table log if needed.
+    The hash is only removed if it belongs to the message and is not COMPLETED,
+    another message with the same content may have claimed or completed it.
 
     Args:
         md5_digest (str): String with md5 digest hash
+        sqs_message_id (str): SQS message id that failed
 
     Returns:
         bool: If deleted returns True otherwise False
     """
     try:
-        resp = DYNAMODB_CLIENT.delete_item(TableName=CCDS_HASH_TABLE_LOG, Key={"ccd_hash": {"S": md5_digest}})
+        resp = DYNAMODB_CLIENT.delete_item(
+            TableName=CCDS_HASH_TABLE_LOG,
+            Key={"ccd_hash": {"S": md5_digest}},
+            ExpressionAttributeNames={"#status": "status"},
+            ExpressionAttributeValues={":m": {"S": sqs_message_id}, ":completed": {"S": "COMPLETED"}},
+            ConditionExpression="messageId = :m AND (attribute_not_exists(#status) OR #status <> :completed)",
+        )
         LOGGER.info(resp)
         return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            LOGGER.info(f"CCDA HASH {md5_digest} is owned by another message or COMPLETED, not deleted")
+        else:
+            LOGGER.error(f"## DYNAMODB PUT MESSAGEID EXCEPTION: {str(e)}")
+        return False
     except Exception as e:
         LOGGER.error(f"## DYNAMODB PUT MESSAGEID EXCEPTION: {str(e)}")
         return False
@@ -128,7 +143,7 @@ def lambda_handler(event, context):
         if error_type != "CCDADuplicatedError":
             save_dynamodb_log(aws_request_id, sqs_message_id, source_event, creation_date, error_type)
             if "md5_digest" in source_event["Object"]:
-                is_dup_deleted = delete_hash_log(source_event["Object"]["md5_digest"])
+                is_dup_deleted = delete_hash_log(source_event["Object"]["md5_digest"], sqs_message_id)
                 notification_event["IsDupHashDeleted"] = is_dup_deleted
         else:
             save_dynamodb_log(aws_request_id, sqs_message_id, source_event, creation_date, error_type)
@@ -31,25 +31,37 @@ SQS_CLIENT = boto3.client("sqs")
 # Load the enviroment variables
 SQS_QUEUE_URL = os.environ["SQS_QUEUE_URL"]
 
+# Max number of entries accepted by a single DeleteMessageBatch request
+SQS_DELETE_BATCH_LIMIT = 10
+
 
 def lambda_handler(event, context):
     """Lambda Handler that finishes the Step machine pipeline
-        Get the receiptHandle and Status from the event, if the status is COMPLETED, remove the message from the queue
+        Get the receiptHandle and Status from each record of the event, if the status is COMPLETED,
+        remove the message from the queue. An execution can carry many records when micro-batching is enabled in step0.
 
     Args:
-        event (dict): Lambda Event
+        event (list): Lambda Event, list with the output of each ValidateAll iteration
         context (dict): Lambda Context
     Returns:
-        dict: Dictionary with event updated Status
+        list: List with each record updated Status
     """
 
     # SQS receiptHandle token, used to confirm receipt and remove message from Queue
-    receiptHandle = event[0]["Source"]["receiptHandle"]
+    completed = [record for record in event if record["Status"] == "COMPLETED"]
+
+    for i in range(0, len(completed), SQS_DELETE_BATCH_LIMIT):
+        entries = [
+            {"Id": str(n), "ReceiptHandle": record["Source"]["receiptHandle"]}
+            for n, record in enumerate(completed[i : i + SQS_DELETE_BATCH_LIMIT])
+        ]
+        response = SQS_CLIENT.delete_message_batch(QueueUrl=SQS_QUEUE_URL, Entries=entries)
+        for failed in response.get("Failed", []):
+            LOGGER.error(f"## SQS DELETE MESSAGE EXCEPTION: {failed}")
+
     # Validate the input save the logs and complete the state machine
-    if event[0]["Status"] == "COMPLETED":
-        SQS_CLIENT.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=receiptHandle)
-        event[0]["Status"] = "COMPLETED"
-    else:
-        event[0]["Status"] = "FAILED"
+    for record in event:
+        if record["Status"] != "COMPLETED":
+            record["Status"] = "FAILED"
 
-    return event[0]
+    return event
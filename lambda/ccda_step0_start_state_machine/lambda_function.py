@@ -22,6 +22,7 @@ import boto3
 import os
 from datetime import datetime
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
 
 # Instatiate the Logger to save messages to Cloudwatch
@@ -31,21 +32,82 @@ LOGGER.setLevel(logging.INFO)
 # Load the enviroment variables
 CCDS_SQSMESSAGE_TABLE_LOG = os.environ["CCDS_SQSMESSAGE_TABLE_LOG"]
 SFN_ARN = os.environ["SFN_ARN"]
+CLAIM_MAX_WORKERS = int(os.environ.get("CLAIM_MAX_WORKERS", "10"))
+# Serialized size of the records packed in a single State Machine execution, keeps the input under the 256KB limit
+SFN_MAX_INPUT_BYTES = int(os.environ.get("SFN_MAX_INPUT_BYTES", "200000"))
+# Seconds after which an IN_PROGRESS claim that never started its execution can be taken over by a redelivery
+CLAIM_LEASE_SECONDS = int(os.environ.get("CLAIM_LEASE_SECONDS", "900"))
 
 # Instantiate the service clients
 DYNAMODB_CLIENT = boto3.client("dynamodb")
 STEPFUNCTIONS_CLIENT = boto3.client("stepfunctions")
 
+# Max number of keys accepted by a single BatchGetItem request
+DYNAMODB_BATCH_GET_LIMIT = 100
+# Max number of items accepted by a single BatchWriteItem request
+DYNAMODB_BATCH_WRITE_LIMIT = 25
+# Status saved by the steps when a message fails, those messages can be claimed again
+FAILED_STATUS = "FAILED"
+# Final status of the messages, their redeliveries are acknowledged as duplicates.
+# The compressed files end in step 1, each file inside is sent to the queue as a new message
+TERMINAL_STATUSES = {"COMPLETED", "DUPLICATED", "COMPRESSED_FILE"}
 
-def put_dynamodb_log(lambdaId, messageId, status, creation_date, error_result):
-    """Save lof of the current state into Dynamodb
+
+def get_message_logs(message_ids) -> dict:
+    """Query the DynamoDB 'message' table for all the given message IDs at once using BatchGetItem
+
+    Args:
+        message_ids (list): SQS message ids, one for each Record inside Records
+
+    Raises:
+        err: Raise error with there is a Client exception with DynamoDB
+
+    Returns:
+        dict: Status and creation_date of the message ids present in the table
+    """
+    message_logs = {}
+    try:
+        for i in range(0, len(message_ids), DYNAMODB_BATCH_GET_LIMIT):
+            request_items = {
+                CCDS_SQSMESSAGE_TABLE_LOG: {
+                    "Keys": [{"id": {"S": f"{messageId}"}} for messageId in message_ids[i : i + DYNAMODB_BATCH_GET_LIMIT]],
+                    "ProjectionExpression": "#id, #status, creation_date",
+                    "ExpressionAttributeNames": {"#id": "id", "#status": "status"},
+                    "ConsistentRead": True,
+                }
+            }
+            # Keys not processed due to throttling are returned in UnprocessedKeys and must be requested again
+            while request_items:
+                response = DYNAMODB_CLIENT.batch_get_item(RequestItems=request_items)
+                for item in response["Responses"].get(CCDS_SQSMESSAGE_TABLE_LOG, []):
+                    message_logs[item["id"]["S"]] = (
+                        item.get("status", {}).get("S"),
+                        int(item.get("creation_date", {}).get("N", "0")),
+                    )
+                request_items = response.get("UnprocessedKeys")
+    except ClientError as err:
+        LOGGER.error(f"## DYNAMODB BATCH GET MESSAGEID EXCEPTION: {str(err)}")
+        raise err
+
+    return message_logs
+
+
+def claim_message(lambdaId, messageId, creation_date, stale_claim_date=None) -> bool:
+    """Save the message log as IN_PROGRESS only if the message id is not in the table yet, or its status is FAILED.
+    With stale_claim_date, an IN_PROGRESS claim saved at that date is taken over, if it was not changed meanwhile.
+    The conditional write makes the check and the claim a single atomic operation.
 
     Args:
         lambdaId (str): AWS request id (Lambda id), generated from the main Lambda execution
         messageId (str): SQS message id, comes with each Record inside Records
-        status (str): Status of the current pipeline
         creation_date (int): Timestamp of the event
-        error_result (str): Error description, empty if None
+        stale_claim_date (int, optional): creation_date of the stale claim to take over. Defaults to None.
+
+    Raises:
+        err: Raise error with there is a Client exception with DynamoDB
+
+    Returns:
+        bool: True if the message was claimed by this execution, False if it was already in the table and not FAILED
     """
     try:
         DYNAMODB_CLIENT.put_item(
@@ -54,77 +116,230 @@ def put_dynamodb_log(lambdaId, messageId, status, creation_date, error_result):
                 "id": {"S": messageId},
                 "lambdaId": {"S": lambdaId},
                 "creation_date": {"N": f"{creation_date}"},
-                "status": {"S": status},
-                "error": {"S": json.dumps(error_result)},
+                "status": {"S": Status.IN_PROGRESS.value},
+                "error": {"S": json.dumps({})},
             },
+            **claim_condition(stale_claim_date),
         )
-    except Exception as e:
-        LOGGER.error(f"## DYNAMODB PUT MESSAGEID EXCEPTION: {str(e)}")
+        return True
+    except ClientError as err:
+        if err.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            LOGGER.info(f"Item with ID {messageId} FOUND on DynamoDB table ")
+            return False
+        LOGGER.error(f"## DYNAMODB PUT MESSAGEID EXCEPTION: {str(err)}")
+        raise err
 
 
-def is_message_processed(aws_requestID, messageId) -> bool:
-    """Query the DynamoDB 'message' table for the item containing the given message ID and returns a boolean
+def claim_condition(stale_claim_date=None):
+    """Condition of the claim: a new or FAILED message, or the IN_PROGRESS claim read at stale_claim_date
 
     Args:
-        aws_requestID (str): AWS request id (Lambda id), generated from the main Lambda execution
-        messageId (str): SQS message id, comes with each Record inside Records
+        stale_claim_date (int, optional): creation_date of the stale claim to take over. Defaults to None.
 
-    Raises:
-        err: Raise error with there is a Client exception with DynamoDB
+    Returns:
+        dict: ConditionExpression, ExpressionAttributeNames and ExpressionAttributeValues of the put
+    """
+    if stale_claim_date is None:
+        return {
+            "ConditionExpression": "attribute_not_exists(id) OR #status = :failed",
+            "ExpressionAttributeNames": {"#status": "status"},
+            "ExpressionAttributeValues": {":failed": {"S": FAILED_STATUS}},
+        }
+    return {
+        "ConditionExpression": "#status = :in_progress AND creation_date = :claimed",
+        "ExpressionAttributeNames": {"#status": "status"},
+        "ExpressionAttributeValues": {
+            ":in_progress": {"S": Status.IN_PROGRESS.value},
+            ":claimed": {"N": f"{stale_claim_date}"},
+        },
+    }
+
+
+def claim_messages(aws_requestID, message_ids):
+    """Check and claim all the message IDs of the SQS batch together.
+    A single BatchGetItem finds the messages already processed, with a TERMINAL_STATUSES status,
+    the new and FAILED messages are claimed concurrently with conditional writes.
+    An IN_PROGRESS claim older than CLAIM_LEASE_SECONDS never reached step 1, its invocation stopped
+    before starting the execution or couldn't release it, so it is taken over.
+    The messages still in process are neither claimed nor processed.
+
+    Args:
+        aws_requestID (str): AWS request id (Lambda id), generated from the main Lambda execution
+        message_ids (list): SQS message ids, one for each Record inside Records
 
     Returns:
-        bool: If find the message returns True otherwise False
+        tuple: Set of message ids claimed by this execution, set of message ids that failed to be claimed
+        and set of message ids already processed
+    """
+    message_logs = get_message_logs(message_ids)
+    creation_date = int(datetime.now().timestamp())
+
+    processed = set()
+    pending = {}
+    for messageId in message_ids:
+        status, claim_date = message_logs.get(messageId, (None, None))
+        if status in TERMINAL_STATUSES:
+            processed.add(messageId)
+        elif status is None or status == FAILED_STATUS:
+            pending[messageId] = None
+        elif status == Status.IN_PROGRESS.value and claim_date < creation_date - CLAIM_LEASE_SECONDS:
+            LOGGER.info(f"Claim of {messageId} from {claim_date} is stale, taking it over")
+            pending[messageId] = claim_date
+
+    claimed = set()
+    failed = set()
+
+    if not pending:
+        return claimed, failed, processed
+
+    with ThreadPoolExecutor(max_workers=min(CLAIM_MAX_WORKERS, len(pending))) as executor:
+        futures = {
+            messageId: executor.submit(claim_message, aws_requestID, messageId, creation_date, stale_claim_date)
+            for messageId, stale_claim_date in pending.items()
+        }
+
+    for messageId, future in futures.items():
+        if future.exception() is not None:
+            failed.add(messageId)
+        elif future.result():
+            claimed.add(messageId)
+
+    return claimed, failed, processed
+
+
+def release_messages(message_ids):
+    """Remove the claims of the given message IDs from the DynamoDB 'message' table,
+    so the messages can be claimed again when SQS redelivers them
+
+    Args:
+        message_ids (list): SQS message ids claimed by this execution
     """
     try:
-        response = DYNAMODB_CLIENT.get_item(TableName=CCDS_SQSMESSAGE_TABLE_LOG, Key={"id": {"S": f"{messageId}"}})
+        for i in range(0, len(message_ids), DYNAMODB_BATCH_WRITE_LIMIT):
+            request_items = {
+                CCDS_SQSMESSAGE_TABLE_LOG: [
+                    {"DeleteRequest": {"Key": {"id": {"S": f"{messageId}"}}}}
+                    for messageId in message_ids[i : i + DYNAMODB_BATCH_WRITE_LIMIT]
+                ]
+            }
+            while request_items:
+                response = DYNAMODB_CLIENT.batch_write_item(RequestItems=request_items)
+                request_items = response.get("UnprocessedItems")
+    except Exception as e:
+        LOGGER.error(f"## DYNAMODB DELETE MESSAGEID EXCEPTION: {str(e)}")
 
-        if Key.ITEM.value in response:
-            LOGGER.info(f"Item with ID {messageId} FOUND on DynamoDB table ")
-            return True
-        else:
-            now = datetime.now()
-            creation_date = int(now.timestamp())
-            put_dynamodb_log(aws_requestID, messageId, Status.IN_PROGRESS.value, creation_date, {})
-            return False
-    except Exception as err:
-        LOGGER.info(err)
-        raise err
 
-    return False
+def chunk_by_size(records, max_bytes):
+    """Split the records in chunks by their serialized size, the S3 event records don't have a fixed size
+    (the object keys and the receiptHandle vary), so a fixed number of records can exceed the input limit.
+    A record bigger than max_bytes goes alone in its chunk.
+
+    Args:
+        records (list): Records of the State Machine input
+        max_bytes (int): Max serialized size of the records of a chunk
+
+    Returns:
+        list: Lists of records
+    """
+    chunks = []
+    chunk = []
+    chunk_bytes = 0
+    for record in records:
+        # the separator between the records counts too
+        record_bytes = len(json.dumps(record).encode("utf-8")) + 2
+        if chunk and chunk_bytes + record_bytes > max_bytes:
+            chunks.append(chunk)
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(record)
+        chunk_bytes += record_bytes
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def start_state_machine(aws_requestID, records) -> list:
+    """Start one State Machine execution for the given list of records
+
+    Args:
+        aws_requestID (str): AWS request id (Lambda id), generated from the main Lambda execution
+        records (list): Records to be processed by the execution, each one with its own Source
+
+    Returns:
+        list: batchItemFailures for the records of the execution, empty if the execution started
+    """
+    input_sfn = {"aws_request_id": aws_requestID, "Records": records}
+    LOGGER.info(input_sfn)
+
+    try:
+        response = STEPFUNCTIONS_CLIENT.start_execution(stateMachineArn=SFN_ARN, input=json.dumps(input_sfn))
+        LOGGER.info(f"State Machine execution started: {response['executionArn']} with {len(records)} records")
+        return []
+    except ClientError as err:
+        LOGGER.error(f"## START STATE MACHINE EXCEPTION: {str(err)}")
+        message_ids = [record["Source"]["sqs_message_id"] for record in records]
+        release_messages(message_ids)
+        return [{"itemIdentifier": messageId} for messageId in message_ids]
 
 
 def lambda_handler(event, context):
     """Lambda Handler that executes the first step at the State Machine - State0
         In this step we loop through the Records adding each record to a new list of records.
         With this new records, we add the messageId and the receiptHandle, needed for each record
-        be processed correctly
+        be processed correctly.
+        Records already processed are acknowledged, records still in process, that can't be claimed, have an invalid body
+        or can't start the State Machine are reported back to SQS as batchItemFailures,
+        the remaining records still start the State Machine.
+        The records are packed into the same execution while their serialized size fits in SFN_MAX_INPUT_BYTES.
 
     Args:
         event (dict): Lambda Event
         context (dict): Lambda Context
     Returns:
-        dict: Dictionary with list of Records to be processed
+        dict: Dictionary with the list of batchItemFailures to be returned to the queue
     """
     start = time.time()
 
     AWS_REQUEST_ID = context.aws_request_id
     LOGGER.info(f"Start processing message {AWS_REQUEST_ID}")
 
-    input_sfn = {"aws_request_id": AWS_REQUEST_ID, "Records": []}
+    records_sfn = []
+    batch_item_failures = []
+
+    # CHECK IF MESSAGES ARE ALREADY PROCESSED OR IN PROCESS, CLAIMING THE NEW ONES
+    claimed_messages, failed_messages, processed_messages = claim_messages(
+        AWS_REQUEST_ID, [record["messageId"] for record in event["Records"]]
+    )
 
     for main_record in event["Records"]:
 
-        # CHECK IF MESSAGE IS ALREADY PROCESSED OR IN PROCESS
         MESSAGE_ID = main_record["messageId"]
         receiptHandle = main_record["receiptHandle"]
 
-        if is_message_processed(AWS_REQUEST_ID, MESSAGE_ID):
-            # Go to next if Item is present, message is already been processed
-            LOGGER.error(f"## SQS Messsage id: {str(MESSAGE_ID)} was already processed, going to next message.")
+        if MESSAGE_ID in failed_messages:
+            LOGGER.error(f"## SQS Messsage id: {str(MESSAGE_ID)} could not be claimed, going to next message.")
+            batch_item_failures.append({"itemIdentifier": MESSAGE_ID})
+            continue
 
-            raise Exception("Message is already Processed or been Processed")
+        if MESSAGE_ID in processed_messages:
+            # Message already processed, it is acknowledged so SQS doesn't redeliver it
+            LOGGER.info(f"## SQS Messsage id: {str(MESSAGE_ID)} was already processed, going to next message.")
+            continue
+
+        if MESSAGE_ID not in claimed_messages:
+            # Message in process, or claimed by a concurrent invocation, SQS redelivers it until it is finished
+            LOGGER.info(f"## SQS Messsage id: {str(MESSAGE_ID)} is in process, returned to the queue.")
+            batch_item_failures.append({"itemIdentifier": MESSAGE_ID})
+            continue
+
+        try:
+            body = json.loads(main_record["body"])
+        except ValueError as err:
+            LOGGER.error(f"## SQS Messsage id: {str(MESSAGE_ID)} has an invalid body: {str(err)}")
+            release_messages([MESSAGE_ID])
+            batch_item_failures.append({"itemIdentifier": MESSAGE_ID})
+            continue
 
-        body = json.loads(main_record["body"])
         LOGGER.info(body)
         if "Records" in body:
             source = {
@@ -132,11 +347,15 @@ def lambda_handler(event, context):
                 "Record": body["Records"][0],
             }
 
-            input_sfn["Records"].append(source)
+            records_sfn.append(source)
         else:
             continue
 
-    LOGGER.info(input_sfn)
-    response = STEPFUNCTIONS_CLIENT.start_execution(stateMachineArn=SFN_ARN, input=json.dumps(input_sfn))
+    # Micro-batching, the records of the SQS batch are packed into as few executions as possible,
+    # the ValidateAll Map state fans them out again
+    for records in chunk_by_size(records_sfn, SFN_MAX_INPUT_BYTES):
+        batch_item_failures.extend(start_state_machine(AWS_REQUEST_ID, records))
+
+    LOGGER.info(f"Processed in {time.time() - start:.3f}s, batchItemFailures: {batch_item_failures}")
 
-    return response
+    return {"batchItemFailures": batch_item_failures}
@@ -21,10 +21,13 @@ import boto3
 import os
 from datetime import datetime
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
-from urllib.parse import unquote_plus
+from urllib.parse import quote_plus, unquote_plus
 from pathlib import Path
 import importlib
+from utils import archive_helper
 
 # Instatiate the Logger to save messages to Cloudwatch
 LOGGER = logging.getLogger()
@@ -34,53 +37,239 @@ LOGGER.setLevel(logging.INFO)
 CCDS_SQSMESSAGE_TABLE_LOG = os.environ["CCDS_SQSMESSAGE_TABLE_LOG"]
 BUCKET_PROCESSED_CCDS = os.environ["BUCKET_PROCESSED_CCDS"]
 FOLDER_PROCESSED_CCDS = os.environ["FOLDER_PROCESSED_CCDS"]
+CCD_QUEUE_URL = os.environ["CCD_QUEUE_URL"]
+ARCHIVE_UPLOAD_WORKERS = int(os.environ.get("ARCHIVE_UPLOAD_WORKERS", "8"))
+ARCHIVE_MEMBER_MAX_BYTES = int(os.environ.get("ARCHIVE_MEMBER_MAX_BYTES", f"{1024 * 1024 * 1024}"))
+COPY_MAX_WORKERS = int(os.environ.get("COPY_MAX_WORKERS", "10"))
+ENQUEUE_MAX_WORKERS = int(os.environ.get("ENQUEUE_MAX_WORKERS", "8"))
+MULTIPART_COPY_THRESHOLD = int(os.environ.get("MULTIPART_COPY_THRESHOLD", f"{1024 * 1024 * 1024}"))
 
 # Instantiate the service clients
 DYNAMODB_CLIENT = boto3.client("dynamodb")
 S3_CLIENT = boto3.client("s3")
+SQS_CLIENT = boto3.client("sqs")
 
-"""@TODO
-Currently not supported, needs more validation if there is usecase to handle compressed batches.
-"""
-BATCH_TYPES = [".zip", ".gz"]
+# Compressed batches, each file inside is expanded to the processed bucket and processed as a SINGLE_FILE
+BATCH_TYPES = [".zip", ".gz", ".tgz"]
+
+# Max number of items accepted by a single TransactWriteItems request
+DYNAMODB_TRANSACT_LIMIT = 25
+# Max number of entries accepted by a single SendMessageBatch request
+SQS_SEND_BATCH_LIMIT = 10
+
+# Copies bigger than the threshold are split in parts copied in parallel with upload_part_copy
+MULTIPART_COPY_CONFIG = TransferConfig(
+    multipart_threshold=MULTIPART_COPY_THRESHOLD, multipart_chunksize=256 * 1024 * 1024, max_concurrency=10
+)
+
+# Archive members bigger than the part size are streamed to S3 in parts, never held in memory as a whole
+ARCHIVE_MEMBER_PART_SIZE = 8 * 1024 * 1024
+ARCHIVE_MEMBER_CONFIG = TransferConfig(
+    multipart_threshold=ARCHIVE_MEMBER_PART_SIZE,
+    multipart_chunksize=ARCHIVE_MEMBER_PART_SIZE,
+    max_concurrency=ARCHIVE_UPLOAD_WORKERS,
+)
 
 
-def update_dynamodb_log(messageId, status, error_result):
-    """Updates the current status of the message log
+def update_dynamodb_logs(statuses):
+    """Updates the current status of the message logs, all the messages are written together
 
     Args:
-        messageId (str): SQS message id, comes with each Record inside Records
-        status (str): Current Status of the pipeline
-        error_result (str): Error description, empty if None
+        statuses (dict): Current Status and Error description, empty if None, for each SQS message id
 
     Raises:
-        e: Client Exception if error updating the record
-
-    Returns:
-        dict: Object updated
+        e: Client Exception if error updating the records
     """
+    items = list(statuses.items())
     try:
-        response = DYNAMODB_CLIENT.update_item(
-            TableName=CCDS_SQSMESSAGE_TABLE_LOG,
-            Key={"id": {"S": messageId}},
-            ExpressionAttributeValues={
-                ":s": {
-                    "S": status,
-                },
-                ":e": {
-                    "S": error_result,
-                },
-            },
-            ExpressionAttributeNames={"#status_message": "status", "#error_message": "error"},
-            UpdateExpression="SET #status_message=:s, #error_message=:e",
-            ReturnValues="UPDATED_NEW",
-        )
-        return response
+        for i in range(0, len(items), DYNAMODB_TRANSACT_LIMIT):
+            DYNAMODB_CLIENT.transact_write_items(
+                TransactItems=[
+                    {
+                        "Update": {
+                            "TableName": CCDS_SQSMESSAGE_TABLE_LOG,
+                            "Key": {"id": {"S": messageId}},
+                            "ExpressionAttributeValues": {
+                                ":s": {
+                                    "S": status,
+                                },
+                                ":e": {
+                                    "S": error_result,
+                                },
+                            },
+                            "ExpressionAttributeNames": {"#status_message": "status", "#error_message": "error"},
+                            "UpdateExpression": "SET #status_message=:s, #error_message=:e",
+                        }
+                    }
+                    for messageId, (status, error_result) in items[i : i + DYNAMODB_TRANSACT_LIMIT]
+                ]
+            )
     except Exception as e:
         LOGGER.error(f"## DYNAMODB PUT MESSAGEID EXCEPTION: {str(e)}")
         raise e
 
 
+def copy_to_processed(bucket_landing, filename, processed_key, size):
+    """Copy the file from the landing bucket to the processed bucket.
+    Files bigger than MULTIPART_COPY_THRESHOLD, or with unknown size, are copied with multipart upload_part_copy,
+    a single copy_object can't copy files bigger than 5GB.
+
+    Args:
+        bucket_landing (str): Landing bucket name
+        filename (str): Key of the file in the landing bucket
+        processed_key (str): Key of the file in the processed bucket
+        size (int): Size of the file, None if unknown
+    """
+    if size is not None and size < MULTIPART_COPY_THRESHOLD:
+        S3_CLIENT.copy_object(
+            Bucket=f"{BUCKET_PROCESSED_CCDS}",
+            CopySource=f"/{bucket_landing}/{filename}",
+            Key=processed_key,
+        )
+    else:
+        S3_CLIENT.copy(
+            CopySource={"Bucket": bucket_landing, "Key": filename},
+            Bucket=BUCKET_PROCESSED_CCDS,
+            Key=processed_key,
+            Config=MULTIPART_COPY_CONFIG,
+        )
+
+
+def member_message(member_key):
+    """Body of the SQS message of a file expanded from a compressed batch,
+    with the same shape as the S3 event notifications, so step 0 and step 1 process it as any other file
+
+    Args:
+        member_key (str): Key of the file in the processed bucket
+
+    Returns:
+        str: Message body
+    """
+    return json.dumps(
+        {
+            "Records": [
+                {
+                    "eventSource": "aws:s3",
+                    "eventName": "ObjectCreated:Expanded",
+                    "eventTime": datetime.utcnow().isoformat(timespec="milliseconds") + "Z",
+                    "s3": {
+                        "bucket": {"name": BUCKET_PROCESSED_CCDS},
+                        "object": {"key": quote_plus(member_key)},
+                    },
+                }
+            ]
+        }
+    )
+
+
+def send_message_batch(entries):
+    """Send one batch of messages to the CCD queue
+
+    Args:
+        entries (list): SendMessageBatch entries, up to SQS_SEND_BATCH_LIMIT
+
+    Raises:
+        RuntimeError: Some of the messages were not sent
+    """
+    response = SQS_CLIENT.send_message_batch(QueueUrl=CCD_QUEUE_URL, Entries=entries)
+    if response.get("Failed"):
+        raise RuntimeError(f"{len(response['Failed'])} messages not sent to the queue: {response['Failed'][0]}")
+
+
+def enqueue_members(member_keys):
+    """Send one message to the CCD queue for each file expanded from a compressed batch.
+    Each file is claimed and processed by its own State Machine execution, so the thousands of files of an archive
+    are not carried in the state of a single execution (the payloads are limited to 256KB).
+
+    Args:
+        member_keys (list): Keys of the files in the processed bucket
+
+    Raises:
+        RuntimeError: Some of the messages were not sent, the files already sent are detected as duplicates on a retry
+    """
+    batches = [
+        [
+            {"Id": str(n), "MessageBody": member_message(member_key)}
+            for n, member_key in enumerate(member_keys[i : i + SQS_SEND_BATCH_LIMIT])
+        ]
+        for i in range(0, len(member_keys), SQS_SEND_BATCH_LIMIT)
+    ]
+    if not batches:
+        return
+
+    with ThreadPoolExecutor(max_workers=min(ENQUEUE_MAX_WORKERS, len(batches))) as executor:
+        futures = [executor.submit(send_message_batch, entries) for entries in batches]
+
+    for future in futures:
+        future.result()
+
+    LOGGER.info(f"{len(member_keys)} expanded files sent to the queue")
+
+
+def process_record(record, aws_request_id, processed_folder):
+    """Copy one file to the processed bucket and build the Records for the next step.
+    Compressed files are expanded and each file inside is sent back to the queue as a new message,
+    the compressed file doesn't add Records for the next step.
+    The files expanded from a compressed file are already in the processed bucket, they are not copied again.
+
+    Args:
+        record (dict): Record from the event, with the Source and the S3 Record
+        aws_request_id (str): AWS request id (Lambda id), generated from the main Lambda execution
+        processed_folder (str): Folder of the processed bucket for the current day
+
+    Raises:
+        err: Any error copying or expanding the file
+
+    Returns:
+        tuple: Status of the file and list of Records for the next step
+    """
+    sqs_message_id = record["Source"]["sqs_message_id"]
+    receiptHandle = record["Source"]["receiptHandle"]
+
+    filename = record["Record"]["s3"]["object"]["key"]
+    bucket_landing = record["Record"]["s3"]["bucket"]["name"]
+
+    filename = unquote_plus(filename)
+    f_name = os.path.basename(filename)
+    size = record["Record"]["s3"]["object"].get("size")
+    processed_prefix = f"{processed_folder}/message_id={sqs_message_id}"
+
+    suffix = check_suffix(f_name)
+
+    # copy the file to processed bucket
+    if bucket_landing != BUCKET_PROCESSED_CCDS:
+        copy_to_processed(bucket_landing, filename, f"{processed_prefix}/{f_name}", size)
+
+    file_record = {
+        "Source": {
+            "sqs_message_id": sqs_message_id,
+            "aws_request_id": aws_request_id,
+            "receiptHandle": receiptHandle,
+        },
+        "Object": {"bucket": bucket_landing, "key": filename},
+    }
+
+    if suffix in BATCH_TYPES:
+        # expand each file of the batch to the processed bucket and send it separated to the queue
+        member_keys = archive_helper.expand_archive(
+            S3_CLIENT,
+            bucket_landing,
+            filename,
+            BUCKET_PROCESSED_CCDS,
+            f"{processed_prefix}/{archive_helper.archive_name(f_name)}",
+            size=size,
+            max_workers=ARCHIVE_UPLOAD_WORKERS,
+            max_member_bytes=ARCHIVE_MEMBER_MAX_BYTES,
+            buffer_member_bytes=ARCHIVE_MEMBER_PART_SIZE,
+            transfer_config=ARCHIVE_MEMBER_CONFIG,
+        )
+        enqueue_members(member_keys)
+        return "COMPRESSED_FILE", []
+
+    file_record["Status"] = "SINGLE_FILE"
+    return file_record["Status"], [file_record]
+
+
 def check_suffix(filepath):
     """Get the suffix of a filepath
 
@@ -98,11 +287,13 @@ def lambda_handler(event, context):
     """Lambda Handler that executes Step 1 of the Pipeline
         Check if there is a 'Records' key in the event and for each Record check the type of file by the filetype
         If the file is in the compress list:
-            @TODO:
-                - open the compressed list locally, copy each file to the Raw folder
-                - Add each Record to the list of Records
+                - stream the compressed file from S3 member by member, copy each file to the processed folder
+                - Send a message to the CCD queue for each file, to be processed by its own execution
 
         If not int the compress list, add the record to the list.
+        The Records are copied in parallel and the status of all of them is saved with a single write.
+        A Record that fails is added as FAILED and the execution continues, the ValidateAll Map state sends it
+        to the exception handler, and its message can be claimed again by a redelivery or a redrive.
 
     Args:
         event (dict): Lambda Event
@@ -117,66 +308,48 @@ def lambda_handler(event, context):
     day = str(datetime.today().day)
 
     aws_request_id = event["aws_request_id"]
+    processed_folder = f"{FOLDER_PROCESSED_CCDS}/year={year}/month={month}/day={day}"
 
     input_next_step = {"Records": []}
 
     if "Records" in event:
-        for record in event["Records"]:
-            if record["Record"]["eventSource"] == "aws:s3":
-
-                sqs_message_id = record["Source"]["sqs_message_id"]
-                receiptHandle = record["Source"]["receiptHandle"]
-
-                filename = record["Record"]["s3"]["object"]["key"]
-                bucket_landing = record["Record"]["s3"]["bucket"]["name"]
-
-                filename = unquote_plus(filename)
-                f_name = os.path.basename(filename)
-
-                suffix = check_suffix(f_name)
-
-                try:
-                    # copy the file to processed bucket
-                    copy_response = S3_CLIENT.copy_object(
-                        Bucket=f"{BUCKET_PROCESSED_CCDS}",
-                        CopySource=f"/{bucket_landing}/{filename}",
-                        Key=f"{FOLDER_PROCESSED_CCDS}/year={year}/month={month}/day={day}/message_id={sqs_message_id}/{f_name}",
-                    )
-
-                    file_record = {
-                        "Source": {
-                            "sqs_message_id": sqs_message_id,
-                            "aws_request_id": aws_request_id,
-                            "receiptHandle": receiptHandle,
-                        },
-                        "Object": {"bucket": bucket_landing, "key": filename},
-                    }
+        records = [record for record in event["Records"] if record["Record"]["eventSource"] == "aws:s3"]
 
-                    if suffix in BATCH_TYPES:
-                        # @TODO: unzip and add each file separated to the list
-                        file_record["Status"] = "COMPRESSED_FILE"
-                        error_results = "Compressed Files are not supported at this moment"
-                        update_dynamodb_log(sqs_message_id, file_record["Status"], error_results)
-                        raise Exception("Compressed Files are not supported at this moment")
-                    else:
-                        file_record["Status"] = "SINGLE_FILE"
-                        update_dynamodb_log(sqs_message_id, file_record["Status"], "")
-
-                    input_next_step["Records"].append(file_record)
-
-                except Exception as err:
-                    file_record = {
-                        "Source": {
-                            "sqs_message_id": sqs_message_id,
-                            "aws_request_id": aws_request_id,
-                            "receiptHandle": receiptHandle,
-                        },
-                        "Object": {"bucket": bucket_landing, "key": filename},
-                        "Status": "FAILED",
-                    }
-                    input_next_step["Records"].append(file_record)
-                    update_dynamodb_log(sqs_message_id, file_record["Status"], str(err))
-                    LOGGER.error(err)
-                    raise err
+        if not records:
+            return input_next_step
+
+        with ThreadPoolExecutor(max_workers=min(COPY_MAX_WORKERS, len(records))) as executor:
+            futures = [
+                executor.submit(process_record, record, aws_request_id, processed_folder) for record in records
+            ]
+
+        statuses = {}
+        for record, future in zip(records, futures):
+            sqs_message_id = record["Source"]["sqs_message_id"]
+            err = future.exception()
+
+            if err is None:
+                status, next_records = future.result()
+                input_next_step["Records"].extend(next_records)
+                statuses[sqs_message_id] = (status, "")
+            else:
+                file_record = {
+                    "Source": {
+                        "sqs_message_id": sqs_message_id,
+                        "aws_request_id": aws_request_id,
+                        "receiptHandle": record["Source"]["receiptHandle"],
+                    },
+                    "Object": {
+                        "bucket": record["Record"]["s3"]["bucket"]["name"],
+                        "key": unquote_plus(record["Record"]["s3"]["object"]["key"]),
+                    },
+                    "Status": "FAILED",
+                    "Error": f"ERROR STEP1 - {str(err)}",
+                }
+                input_next_step["Records"].append(file_record)
+                statuses[sqs_message_id] = (file_record["Status"], file_record["Error"])
+                LOGGER.error(err)
+
+        update_dynamodb_logs(statuses)
 
     return input_next_step
@@ -0,0 +1,267 @@
+"""
+File: archive_helper.py
+Project: utils
+Description: Stream the members of compressed batches (.zip, .gz, .tar.gz) straight from S3,
+without buffering the whole archive in memory or /tmp
+"""
+
+# Import the libraries
+import io
+import os
+import gzip
+import tarfile
+import zipfile
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Instatiate the Logger to save messages to Cloudwatch
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+TAR_SUFFIXES = (".tar.gz", ".tgz")
+
+
+class S3RangeReader(io.RawIOBase):
+    """Seekable read only file object over an S3 object, each read is a Range GET.
+    Zip files keep the list of members at the end of the file, so they need random access.
+
+    Args:
+        io.RawIOBase (io.RawIOBase): Base class for raw binary streams.
+    """
+
+    def __init__(self, s3_client, bucket, key, size=None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.size = size if size is not None else s3_client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+
+        self.position = position
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size or len(buffer) == 0:
+            return 0
+
+        end = min(self.position + len(buffer), self.size) - 1
+        response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={self.position}-{end}")
+        data = response["Body"].read()
+
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def archive_name(filename):
+    """Get the name of the archive without the compression suffixes
+
+    Args:
+        filename (str): Archive file name, like batch.zip or batch.tar.gz
+
+    Returns:
+        str: Name without the suffixes, like batch
+    """
+    f_name = os.path.basename(filename)
+    for suffix in TAR_SUFFIXES + (".zip", ".gz"):
+        if f_name.lower().endswith(suffix):
+            return f_name[: -len(suffix)]
+    return f_name
+
+
+def member_path(name):
+    """Normalize the path of a member inside the archive, removing absolute and parent references
+
+    Args:
+        name (str): Member path inside the archive
+
+    Returns:
+        str: Relative member path, empty if the member must be skipped
+    """
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".", "..")]
+
+    # Skip folders, OS metadata and hidden files
+    if not parts or parts[0] == "__MACOSX" or parts[-1].startswith("."):
+        return ""
+
+    return "/".join(parts)
+
+
+class SizeLimitedReader(io.RawIOBase):
+    """Read only file object over an archive member, failing as soon as the member is bigger than max_bytes.
+    The size in the archive headers is not trusted, gzip members do not even have one.
+
+    Args:
+        io.RawIOBase (io.RawIOBase): Base class for raw binary streams.
+    """
+
+    def __init__(self, member_file, name, max_bytes=None):
+        self.member_file = member_file
+        self.name = name
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.member_file.read(len(buffer))
+        self.total_bytes += len(data)
+
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            raise ValueError(f"{self.name} is bigger than the limit of {self.max_bytes} bytes")
+
+        buffer[: len(data)] = data
+        return len(data)
+
+
+def iter_archive_members(s3_client, bucket, key, size=None, buffer_size=8 * 1024 * 1024):
+    """Iterate the members of a compressed file in S3, one at a time
+
+    Args:
+        s3_client (S3.Client): Boto3 S3 client
+        bucket (str): Bucket of the archive
+        key (str): Key of the archive
+        size (int): Size of the archive, if known
+        buffer_size (int): Size of each read from S3
+
+    Yields:
+        tuple: Member path, size declared in the archive (None for gzip) and file object with the member content
+    """
+    lower_key = key.lower()
+
+    if lower_key.endswith(".zip"):
+        reader = io.BufferedReader(S3RangeReader(s3_client, bucket, key, size), buffer_size=buffer_size)
+        with zipfile.ZipFile(reader) as zip_file:
+            for info in zip_file.infolist():
+                name = member_path(info.filename)
+                if info.is_dir() or not name:
+                    continue
+                with zip_file.open(info) as member_file:
+                    yield name, info.file_size, member_file
+
+    elif lower_key.endswith(TAR_SUFFIXES):
+        body = s3_client.get_object(Bucket=bucket, Key=key)["Body"]
+        # Stream mode, the tar members are read in order without seeking
+        with tarfile.open(fileobj=body, mode="r|gz") as tar_file:
+            for info in tar_file:
+                name = member_path(info.name)
+                if not info.isfile() or not name:
+                    continue
+                yield name, info.size, tar_file.extractfile(info)
+
+    elif lower_key.endswith(".gz"):
+        body = s3_client.get_object(Bucket=bucket, Key=key)["Body"]
+        with gzip.GzipFile(fileobj=body) as member_file:
+            yield archive_name(key), None, member_file
+
+    else:
+        raise ValueError(f"{key} is not a supported compressed file")
+
+
+def expand_archive(
+    s3_client,
+    bucket,
+    key,
+    destination_bucket,
+    destination_prefix,
+    size=None,
+    max_workers=8,
+    max_member_bytes=None,
+    buffer_member_bytes=8 * 1024 * 1024,
+    transfer_config=None,
+):
+    """Expand a compressed file from S3 member by member, writing each member to the destination prefix.
+    Members up to buffer_member_bytes are read to memory and uploaded in parallel, at most max_workers at the same time.
+    Bigger members, and gzip members whose size is unknown, are streamed to S3 with a multipart upload
+    while they are decompressed, so no member is ever held in memory as a whole.
+
+    Args:
+        s3_client (S3.Client): Boto3 S3 client
+        bucket (str): Bucket of the archive
+        key (str): Key of the archive
+        destination_bucket (str): Bucket where the members are saved
+        destination_prefix (str): Prefix where the members are saved
+        size (int): Size of the archive, if known
+        max_workers (int): Number of parallel uploads of small members
+        max_member_bytes (int): Members bigger than this fail the expansion, None for no limit
+        buffer_member_bytes (int): Members up to this size are uploaded from memory
+        transfer_config (TransferConfig): Boto3 transfer configuration of the streamed uploads
+
+    Raises:
+        ValueError: A member is bigger than max_member_bytes
+
+    Returns:
+        list: Keys of the members saved in the destination bucket, in the archive order
+    """
+    member_keys = []
+    uploads = set()
+    # The SHA-256 checksum lets the deduplication step skip the download of the member
+    extra_args = {"ChecksumAlgorithm": "SHA256"}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for name, member_size, member_file in iter_archive_members(s3_client, bucket, key, size):
+                member_key = f"{destination_prefix}/{name}"
+
+                # Reject the member before reading it when the archive already declares it too big
+                if max_member_bytes is not None and member_size is not None and member_size > max_member_bytes:
+                    raise ValueError(f"{name} is bigger than the limit of {max_member_bytes} bytes")
+
+                reader = SizeLimitedReader(member_file, name, max_member_bytes)
+
+                if member_size is not None and member_size <= buffer_member_bytes:
+                    content = reader.read()
+
+                    if len(uploads) >= max_workers:
+                        done, uploads = wait(uploads, return_when=FIRST_COMPLETED)
+                        for upload in done:
+                            upload.result()
+
+                    uploads.add(
+                        executor.submit(
+                            s3_client.put_object,
+                            Body=content,
+                            Bucket=destination_bucket,
+                            Key=member_key,
+                            **extra_args,
+                        )
+                    )
+                else:
+                    # The member file is only valid until the next member, so the streamed upload finishes here
+                    upload_args = {"ExtraArgs": extra_args}
+                    if transfer_config is not None:
+                        upload_args["Config"] = transfer_config
+                    s3_client.upload_fileobj(io.BufferedReader(reader), destination_bucket, member_key, **upload_args)
+
+                member_keys.append(member_key)
+        finally:
+            done, _ = wait(uploads)
+
+        for upload in done:
+            upload.result()
+
+    LOGGER.info(f"{len(member_keys)} files expanded from {bucket}/{key}")
+
+    return member_keys
@@ -25,6 +25,8 @@ from botocore.exceptions import ClientError
 from urllib.parse import unquote_plus
 import xml.etree.ElementTree as ET
 import xml.parsers
+from utils import validation_helper
+from utils.exceptions import InvalidFileError
 
 # Instatiate the Logger to save messages to Cloudwatch
 LOGGER = logging.getLogger()
@@ -34,11 +36,23 @@ LOGGER.setLevel(logging.INFO)
 S3_CLIENT = boto3.client("s3")
 DYNAMODB_CLIENT = boto3.client("dynamodb")
 
-# Define types of HL7
-hl7_supported_types = ["ADT", "VXU", "ORM", "ORU", "PPR", "SIU", "MDM", "ACK", "OML"]
-
 # Load the enviroment variables
 CCDS_SQSMESSAGE_TABLE_LOG = os.environ["CCDS_SQSMESSAGE_TABLE_LOG"]
+# FULL downloads and parses the whole file, SNIFF classifies the file reading only the first SNIFF_BYTES,
+# STRICT parses the whole file validating the CCDs against the CDA schema
+VALIDATION_MODE = os.environ.get("VALIDATION_MODE", "FULL").upper()
+SNIFF_BYTES = int(os.environ.get("SNIFF_BYTES", "4096"))
+# Size of each chunk read from S3 and fed to the XML parser
+STREAM_CHUNK_BYTES = int(os.environ.get("STREAM_CHUNK_BYTES", f"{64 * 1024}"))
+# Check the ClinicalDocument root element and templateIds of the CCDs
+VALIDATE_CCD_STRUCTURE = os.environ.get("VALIDATE_CCD_STRUCTURE", "false").lower() == "true"
+# STRICT mode validates the CCDs against the CDA schema, a local path or a s3:// URI of the main XSD file
+CDA_SCHEMA_LOCATION = os.environ.get("CDA_SCHEMA_LOCATION", "")
+VALIDATION_MAX_ERRORS = int(os.environ.get("VALIDATION_MAX_ERRORS", "10"))
+SCHEMA_DOWNLOAD_FOLDER = "/tmp/cda_schema"
+
+# Compiled CDA schema, loaded once per container
+CDA_SCHEMA = None
 
 
 def update_dynamodb_log(messageId, status, error_result):
@@ -77,19 +91,131 @@ def update_dynamodb_log(messageId, status, error_result):
         raise e
 
 
+def download_schema(schema_uri):
+    """Download the XSD files in the folder of the schema, so the included schemas are found
+
+    Args:
+        schema_uri (str): s3:// URI of the main XSD file
+
+    Returns:
+        str: Local path of the main XSD file
+    """
+    bucketname, key = schema_uri[len("s3://") :].split("/", 1)
+    prefix = key.rsplit("/", 1)[0] + "/" if "/" in key else ""
+
+    paginator = S3_CLIENT.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucketname, Prefix=prefix):
+        for s3_object in page.get("Contents", []):
+            if s3_object["Key"].endswith("/"):
+                continue
+            local_path = os.path.join(SCHEMA_DOWNLOAD_FOLDER, s3_object["Key"][len(prefix) :])
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            S3_CLIENT.download_file(bucketname, s3_object["Key"], local_path)
+
+    return os.path.join(SCHEMA_DOWNLOAD_FOLDER, key[len(prefix) :])
+
+
+def get_cda_schema():
+    """Compiled CDA schema, compiled on the first call and kept for the next invocations of the container
+
+    Raises:
+        ValueError: CDA_SCHEMA_LOCATION is not defined
+
+    Returns:
+        lxml.etree.XMLSchema: Compiled schema
+    """
+    global CDA_SCHEMA
+
+    if CDA_SCHEMA is None:
+        if not CDA_SCHEMA_LOCATION:
+            raise ValueError("CDA_SCHEMA_LOCATION is required in STRICT validation mode")
+
+        start = time.time()
+        schema_path = CDA_SCHEMA_LOCATION
+        if schema_path.startswith("s3://"):
+            schema_path = download_schema(schema_path)
+        CDA_SCHEMA = validation_helper.load_xml_schema(schema_path)
+        LOGGER.info(f"CDA schema {CDA_SCHEMA_LOCATION} compiled in {time.time() - start:.2f}s")
+
+    return CDA_SCHEMA
+
+
+def sniff_document(bucketname, filename):
+    """Classify the file reading only its first SNIFF_BYTES with a Range GET
+
+    Args:
+        bucketname (str): Bucket of the file
+        filename (str): Key of the file
+
+    Returns:
+        str: CCD or HL7, None if the type can't be decided from the first bytes
+    """
+    try:
+        s3_file = S3_CLIENT.get_object(Bucket=bucketname, Key=filename, Range=f"bytes=0-{SNIFF_BYTES - 1}")
+    except ClientError as err:
+        # Empty files have no valid range
+        if err.response["Error"]["Code"] == "InvalidRange":
+            return None
+        raise err
+
+    return validation_helper.classify_head(s3_file["Body"].read())
+
+
+def validate_document(bucketname, filename):
+    """Validate the file streaming its content from S3 through an incremental XML parser,
+    without building the full tree. If the content is not XML, the first chunk is checked for a supported HL7 MSH segment.
+    In STRICT mode the CCDs are also validated against the CDA schema.
+
+    Args:
+        bucketname (str): Bucket of the file
+        filename (str): Key of the file
+
+    Returns:
+        tuple: CCD or HL7, None if not valid, and the error description, empty if valid
+    """
+    s3_file = S3_CLIENT.get_object(Bucket=bucketname, Key=filename)
+
+    if VALIDATION_MODE == "STRICT":
+        validator = validation_helper.XSDStreamValidator(get_cda_schema(), max_errors=VALIDATION_MAX_ERRORS)
+    else:
+        validator = validation_helper.XMLStreamValidator(check_structure=VALIDATE_CCD_STRUCTURE)
+    head = b""
+
+    try:
+        for chunk in s3_file["Body"].iter_chunks(STREAM_CHUNK_BYTES):
+            if not head:
+                head = chunk
+            validator.update(chunk)
+        structure_errors = validator.close()
+    except ET.ParseError as err:
+        if validation_helper.is_hl7_supported(validation_helper.hl7_message_type(head)):
+            return "HL7", ""
+        return None, str(err)
+    finally:
+        s3_file["Body"].close()
+
+    if structure_errors:
+        return None, "; ".join(structure_errors)
+
+    return "CCD", ""
+
+
 def lambda_handler(event, context):
     """Lambda Handler that executes step 2 of the pipeline
-    Check if the Status is a SINGLE_FILE, if True, get the object from S3 landing bucket
-    reads, and try to parse as XML, if an error is raised, try to split the file by pipe(|) and validate the position 8 of the file.
-    If any value of the list hl7_supported_types is in the position 8 value it's an HL7, otherwise,
+    Check if the Status is a SINGLE_FILE, if True, stream the object from S3 landing bucket
+    through an incremental XML parser, if an error is raised, find the MSH segment of the file and validate its position 8 (MSH-9).
+    If any value of the list HL7_SUPPORTED_TYPES is in the position 8 value it's an HL7, otherwise,
     raises an Exception of Unsuported File.
+    In SNIFF mode, only the first SNIFF_BYTES are read with a Range GET: a ClinicalDocument root element is a CCD,
+    a MSH segment with a supported type is an HL7. If the type can't be decided, the full file is validated.
+    In STRICT mode the CCDs are validated against the CDA schema, the first VALIDATION_MAX_ERRORS violations are logged.
 
     Args:
         event (dict): Lambda Event
         context (dict): Lambda Context
 
     Raises:
-        Exception: Unsuported File Type
+        InvalidFileError: Unsuported File Type, or CCD structure not valid if VALIDATE_CCD_STRUCTURE is enabled
 
     Returns:
         dict: Event updated with the Filetype to be converted
@@ -103,26 +229,28 @@ def lambda_handler(event, context):
     bucketname = event["Object"]["bucket"]
     filename = event["Object"]["key"]
 
-    if event["Status"] == "SINGLE_FILE":
+    if event["Status"] == "SINGLE_FILE" and VALIDATION_MODE == "SNIFF":
 
-        s3_file = S3_CLIENT.get_object(Bucket=bucketname, Key=filename)
-        s3_filedata = s3_file["Body"].read()
+        filetype = sniff_document(bucketname, filename)
 
-        try:
-            tree = ET.ElementTree(ET.fromstring(s3_filedata))
+        if filetype:
             event["Status"] = "VALID"
-            event["Object"]["Type"] = "CCD"
+            event["Object"]["Type"] = filetype
             update_dynamodb_log(sqs_message_id, event["Status"], "")
-        except ET.ParseError as err:
-            event["Status"] = "VALID"
-            hl7_type = [x.split("|")[8] for x in s3_filedata.decode("utf-8").splitlines() if x.startswith("MSH")][0]
-            # hl7_type = s3_filedata.decode().split("|")[8]
-
-            if len([x for x in hl7_supported_types if x in hl7_type]) == 1:
-                event["Object"]["Type"] = "HL7"
-                update_dynamodb_log(sqs_message_id, event["Status"], "")
-            else:
-                update_dynamodb_log(sqs_message_id, event["Status"], str(err))
-                raise Exception("Not Supported File type")
+            return event
+
+        LOGGER.info(f"Type of {filename} not found in the first {SNIFF_BYTES} bytes, validating the full file")
+
+    if event["Status"] == "SINGLE_FILE":
+
+        filetype, error_result = validate_document(bucketname, filename)
+
+        event["Status"] = "VALID"
+        if filetype:
+            event["Object"]["Type"] = filetype
+            update_dynamodb_log(sqs_message_id, event["Status"], "")
+        else:
+            update_dynamodb_log(sqs_message_id, event["Status"], error_result)
+            raise InvalidFileError(event, f"Not Supported File type: {error_result}")
 
     return event
@@ -0,0 +1,96 @@
+"""
+File: test_validation_helper.py
+Project: tests
+Description: Truncated and malformed documents must be rejected by the stream validators
+"""
+
+# Import the libraries
+import os
+import sys
+import unittest
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import validation_helper
+
+SCHEMA = b"""<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+  <xs:element name="a">
+    <xs:complexType>
+      <xs:sequence>
+        <xs:element name="b" type="xs:int" maxOccurs="unbounded"/>
+      </xs:sequence>
+    </xs:complexType>
+  </xs:element>
+</xs:schema>"""
+
+VALID = b"<a><b>1</b><b>2</b></a>"
+TRUNCATED = [b"<a><b>1</b>", b"<a><b>1</b></a", b"<a><b>1"]
+MALFORMED = [b"<a><b>1</c></a>", b"<a><b>1</b></a><a/>", b"not xml", b"", b"<a><b>&x;</b></a>"]
+
+
+def validate(validator, content, chunk_size):
+    """Feed the content in chunks and close the validator
+
+    Args:
+        validator (XMLStreamValidator): Validator
+        content (bytes): Document
+        chunk_size (int): Size of the chunks fed to the validator
+
+    Returns:
+        list: Errors returned by close
+    """
+    for start in range(0, len(content), chunk_size):
+        validator.update(content[start : start + chunk_size])
+    return validator.close()
+
+
+class XMLStreamValidatorTest(unittest.TestCase):
+    def test_valid(self):
+        for chunk_size in (3, 1024):
+            self.assertEqual(validate(validation_helper.XMLStreamValidator(), VALID, chunk_size), [])
+
+    def test_truncated_and_malformed(self):
+        for content in TRUNCATED + MALFORMED:
+            for chunk_size in (3, 1024):
+                with self.subTest(content=content, chunk_size=chunk_size):
+                    with self.assertRaises(ET.ParseError):
+                        validate(validation_helper.XMLStreamValidator(), content, chunk_size)
+
+
+@unittest.skipIf(validation_helper.LXML_ETREE is None, "lxml is not installed")
+class XSDStreamValidatorTest(unittest.TestCase):
+    def setUp(self):
+        self.schema = validation_helper.LXML_ETREE.XMLSchema(validation_helper.LXML_ETREE.fromstring(SCHEMA))
+
+    def validator(self):
+        return validation_helper.XSDStreamValidator(self.schema)
+
+    def test_valid(self):
+        for chunk_size in (3, 1024):
+            self.assertEqual(validate(self.validator(), VALID, chunk_size), [])
+
+    def test_truncated_and_malformed(self):
+        for content in TRUNCATED + MALFORMED:
+            for chunk_size in (3, 1024):
+                with self.subTest(content=content, chunk_size=chunk_size):
+                    with self.assertRaises(ET.ParseError):
+                        validate(self.validator(), content, chunk_size)
+
+    def test_entity_declarations(self):
+        content = b'<!DOCTYPE a [<!ENTITY x "1">]><a><b>&x;</b></a>'
+        for chunk_size in (3, 1024):
+            with self.assertRaises(ET.ParseError):
+                validate(self.validator(), content, chunk_size)
+
+    def test_violations_of_each_document(self):
+        for chunk_size in (3, 1024):
+            violations = validate(self.validator(), b"<a><b>x</b></a>", chunk_size)
+            self.assertEqual(len(violations), 1)
+            self.assertIn("'x'", violations[0])
+            # The violations of the previous document are not returned again
+            self.assertEqual(validate(self.validator(), VALID, chunk_size), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,24 @@
+"""
+File: exceptions.py
+Project: utils
+Description: Exceptions raised by the validation step, handled by the Step Functions Exception Handler
+"""
+import logging
+import json
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+
+class InvalidFileError(Exception):
+    """Raised when the file is not a valid CCD or a supported HL7"""
+
+    def __init__(self, event, message="Not Supported File type"):
+        self.event = event
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        error_message = {"error": self.message, "event": self.event}
+        LOGGER.error(error_message)
+        return json.dumps(error_message)
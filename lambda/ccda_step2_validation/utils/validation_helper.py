@@ -0,0 +1,309 @@
+"""
+File: validation_helper.py
+Project: utils
+Description: Classify CCD and HL7 documents from their first bytes and validate XML as a stream, optionally against a XSD schema
+"""
+
+# Import the libraries
+import re
+import xml.etree.ElementTree as ET
+
+# lxml is optional, only needed to validate against a XSD schema
+try:
+    from lxml import etree as LXML_ETREE
+except ImportError:
+    LXML_ETREE = None
+
+# Define types of HL7
+HL7_SUPPORTED_TYPES = ["ADT", "VXU", "ORM", "ORU", "PPR", "SIU", "MDM", "ACK", "OML"]
+
+# Root element of a CDA document, CCDs are CDA documents
+CCD_ROOT_ELEMENT = "ClinicalDocument"
+CDA_NAMESPACE = "urn:hl7-org:v3"
+
+# MSH segment at the start of the content or of a new segment, the next char is the field separator
+MSH_SEGMENT = re.compile(rb"(?:^|[\r\n])MSH(.)")
+SEGMENT_END = re.compile(rb"[\r\n]")
+
+UTF8_BOM = b"\xef\xbb\xbf"
+
+# Entities can only be declared in the DTD before the root element, the documents declaring them are rejected
+ENTITY_DECLARATION = b"<!ENTITY"
+
+
+def local_name(tag):
+    """Remove the namespace from an XML tag
+
+    Args:
+        tag (str): Tag in the ElementTree format, like {urn:hl7-org:v3}ClinicalDocument
+
+    Returns:
+        str: Tag without the namespace
+    """
+    return tag.rsplit("}", 1)[-1]
+
+
+def xml_root_element(head):
+    """Get the root element name from the first bytes of a XML document, without parsing the full document
+
+    Args:
+        head (bytes): First bytes of the document
+
+    Returns:
+        str: Root element name without the namespace, None if not found or not XML
+    """
+    parser = ET.XMLPullParser(events=("start",))
+    try:
+        parser.feed(head)
+        for _, element in parser.read_events():
+            return local_name(element.tag)
+    except ET.ParseError:
+        return None
+    return None
+
+
+def hl7_message_type(content):
+    """Get the message type (MSH-9) of the first MSH segment, the segments after it are not split
+
+    Args:
+        content (bytes): Full content or first bytes of the document
+
+    Returns:
+        str: Message type like ADT^A01, None if there is no MSH segment
+    """
+    match = MSH_SEGMENT.search(content)
+    if match is None:
+        return None
+
+    segment_end = SEGMENT_END.search(content, match.end())
+    segment = content[match.start() : segment_end.start() if segment_end else len(content)].strip()
+    fields = segment.split(match.group(1))
+
+    # MSH-1 is the field separator itself, so MSH-9 is the position 8 after splitting
+    if len(fields) <= 8:
+        return None
+    return fields[8].decode("utf-8", errors="replace")
+
+
+def is_hl7_supported(hl7_type):
+    """Check if the HL7 message type is one of HL7_SUPPORTED_TYPES
+
+    Args:
+        hl7_type (str): Message type like ADT^A01
+
+    Returns:
+        bool: True if supported, otherwise False
+    """
+    return hl7_type is not None and len([x for x in HL7_SUPPORTED_TYPES if x in hl7_type]) == 1
+
+
+def classify_head(head):
+    """Classify a document as CCD or HL7 from its first bytes
+
+    Args:
+        head (bytes): First bytes of the document
+
+    Returns:
+        str: CCD or HL7, None if the type can't be decided from the first bytes
+    """
+    head = head[len(UTF8_BOM) :] if head.startswith(UTF8_BOM) else head
+    stripped = head.lstrip()
+
+    if stripped.startswith(b"<"):
+        if xml_root_element(stripped) == CCD_ROOT_ELEMENT:
+            return "CCD"
+        return None
+
+    if is_hl7_supported(hl7_message_type(stripped)):
+        return "HL7"
+
+    return None
+
+
+class XMLStreamValidator:
+    """Incremental XML validation, the content is fed in chunks like a hashlib object.
+    Each element is dropped as soon as it is closed, so the full tree is never kept in memory.
+    Raises ET.ParseError as soon as the content is not well-formed.
+
+    Args:
+        check_structure (bool): If True, also check the CCD structural markers when closing
+    """
+
+    def __init__(self, check_structure=False):
+        self.check_structure = check_structure
+        self.parser = ET.XMLPullParser(events=("start", "end"))
+        self.open_elements = []
+        self.root_tag = None
+        self.template_ids = 0
+
+    def update(self, chunk):
+        """Feed the next chunk of the content
+
+        Args:
+            chunk (bytes): Next chunk of the content
+        """
+        self.parser.feed(chunk)
+        self._read_events()
+
+    def close(self):
+        """Finish the validation, raises ET.ParseError if the content is incomplete
+
+        Returns:
+            list: Structural errors found, empty if valid or if check_structure is False
+        """
+        self.parser.close()
+        self._read_events()
+
+        if self.check_structure:
+            return self.structure_errors()
+        return []
+
+    def structure_errors(self):
+        """Check the CCD structural markers: ClinicalDocument root element in the HL7 v3 namespace with templateIds
+
+        Returns:
+            list: Structural errors found, empty if valid
+        """
+        errors = []
+        if self.root_tag != f"{{{CDA_NAMESPACE}}}{CCD_ROOT_ELEMENT}":
+            errors.append(f"Root element {self.root_tag} is not a {{{CDA_NAMESPACE}}}{CCD_ROOT_ELEMENT}")
+        if self.template_ids == 0:
+            errors.append(f"{CCD_ROOT_ELEMENT} has no templateId")
+        return errors
+
+    def _read_events(self):
+        for event, element in self.parser.read_events():
+            if event == "start":
+                if self.root_tag is None:
+                    self.root_tag = element.tag
+                elif len(self.open_elements) == 1 and local_name(element.tag) == "templateId":
+                    self.template_ids += 1
+                self.open_elements.append(element)
+            else:
+                self.open_elements.pop()
+                element.clear()
+                # Closed elements are removed from the parent, only the open path is kept in memory
+                if self.open_elements:
+                    self.open_elements[-1].remove(element)
+
+
+def load_xml_schema(path):
+    """Compile a XSD schema, the included schemas are resolved relative to the path
+
+    Args:
+        path (str): Local path of the main XSD file
+
+    Raises:
+        ImportError: lxml is not available
+
+    Returns:
+        lxml.etree.XMLSchema: Compiled schema
+    """
+    if LXML_ETREE is None:
+        raise ImportError("lxml is required to validate against a XSD schema")
+
+    return LXML_ETREE.XMLSchema(LXML_ETREE.parse(path))
+
+
+class XSDStreamValidator:
+    """Incremental XSD validation with the same interface of XMLStreamValidator.
+    The schema is checked by the parser while the chunks are fed, and closed elements are dropped.
+    Raises ET.ParseError if the content is not well-formed, is incomplete or declares entities,
+    schema violations are returned by close.
+
+    Args:
+        schema (lxml.etree.XMLSchema): Compiled schema
+        max_errors (int): Maximum number of violations returned
+    """
+
+    def __init__(self, schema, max_errors=10):
+        self.max_errors = max_errors
+        # The schema is shared by the documents validated in the container, the errors of the previous ones are dropped
+        LXML_ETREE.clear_error_log()
+        schema._clear_error_log()
+        self.parser = LXML_ETREE.XMLPullParser(events=("start", "end"), schema=schema, no_network=True, huge_tree=True)
+        self.depth = 0
+        self.root_closed = False
+        self.prolog_tail = b""
+        self.violations = None
+
+    def update(self, chunk):
+        """Feed the next chunk of the content
+
+        Args:
+            chunk (bytes): Next chunk of the content
+        """
+        if not self.root_closed and self.depth == 0:
+            # The declaration can be split between two chunks
+            prolog = self.prolog_tail + chunk
+            if ENTITY_DECLARATION in prolog:
+                raise ET.ParseError("Entity declarations are not allowed")
+            self.prolog_tail = prolog[-(len(ENTITY_DECLARATION) - 1) :]
+
+        # The parser stops at the first chunk with a schema violation, the rest of the content is not read
+        if self.violations is not None:
+            return
+
+        try:
+            self.parser.feed(chunk)
+        except LXML_ETREE.XMLSyntaxError as err:
+            self.violations = self._schema_violations(err)
+            return
+        self._read_events()
+
+    def close(self):
+        """Finish the validation, raises ET.ParseError if the content is not well-formed or is incomplete
+
+        Returns:
+            list: First max_errors schema violations, empty if valid
+        """
+        if self.violations is not None:
+            return self.violations
+
+        try:
+            self.parser.close()
+        except LXML_ETREE.XMLSyntaxError as err:
+            return self._schema_violations(err)
+
+        self._read_events()
+        # The parser doesn't always report a document truncated after a closed element
+        if not self.root_closed:
+            raise ET.ParseError("Document is incomplete, the root element is not closed")
+        return []
+
+    def _schema_violations(self, err):
+        """Schema violations of the error raised by the parser, the error log was cleared when the validator was created
+
+        Args:
+            err (lxml.etree.XMLSyntaxError): Error raised by the parser
+
+        Raises:
+            ET.ParseError: The content is not well-formed
+
+        Returns:
+            list: First max_errors schema violations
+        """
+        entries = list(err.error_log)
+        # Well-formedness errors are raised as the XMLStreamValidator does, so the caller can try other formats
+        if not entries or any(entry.domain == LXML_ETREE.ErrorDomains.PARSER for entry in entries):
+            raise ET.ParseError(str(err))
+
+        return [
+            f"line {entry.line}: {entry.message}"
+            for entry in entries
+            if entry.domain == LXML_ETREE.ErrorDomains.SCHEMASV
+        ][: self.max_errors]
+
+    def _read_events(self):
+        for event, element in self.parser.read_events():
+            if event == "start":
+                self.depth += 1
+                continue
+
+            self.depth -= 1
+            if self.depth == 0:
+                self.root_closed = True
+            element.clear()
+            # Remove the closed siblings, only the open path is kept in memory
+            while element.getprevious() is not None:
+                del element.getparent()[0]
@@ -19,11 +19,14 @@ Amazon Web Services, Inc. or Amazon Web Services EMEA SARL or both.
 # Import the libraries
 import json
 import os
+import base64
 import boto3
 import logging
 from botocore.exceptions import ClientError
 import hashlib
-from datetime import datetime
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+from utils import canonical_helper, hash_cache, validation_helper
 from utils.exceptions import CCDADuplicatedError, InvalidFileError
 
 # Instatiate the Logger to save messages to Cloudwatch
@@ -37,6 +40,37 @@ S3_CLIENT = boto3.client("s3")
 # Load the enviroment variables
 CCDS_HASH_TABLE_LOG = os.environ["CCDS_HASH_TABLE_LOG"]
 CCDS_SQSMESSAGE_TABLE_LOG = os.environ["CCDS_SQSMESSAGE_TABLE_LOG"]
+# Fused mode: the SINGLE_FILE records are validated and hashed in the same read of the object, skipping the validation step
+FUSED_VALIDATION = os.environ.get("FUSED_VALIDATION", "false").lower() == "true"
+# Validation of the fused mode, the same VALIDATION_MODE of step 2: FULL parses the whole file,
+# SNIFF classifies the file from its first SNIFF_BYTES, STRICT is not supported as the CDA schema is only loaded by step 2
+VALIDATION_MODE = os.environ.get("VALIDATION_MODE", "FULL").upper()
+SNIFF_BYTES = int(os.environ.get("SNIFF_BYTES", "4096"))
+STREAM_CHUNK_BYTES = int(os.environ.get("STREAM_CHUNK_BYTES", f"{64 * 1024}"))
+VALIDATE_CCD_STRUCTURE = os.environ.get("VALIDATE_CCD_STRUCTURE", "false").lower() == "true"
+# CONTENT hashes the file content, S3_CHECKSUM uses the object checksum when available, without downloading the file,
+# CANONICAL hashes the canonical form of the CCDs, ignoring whitespaces, attributes order and CANONICAL_EXCLUDE_XPATHS
+DEDUP_KEY_SOURCE = os.environ.get("DEDUP_KEY_SOURCE", "CONTENT").upper()
+CANONICAL_EXCLUDE_XPATHS = os.environ.get(
+    "CANONICAL_EXCLUDE_XPATHS", "/ClinicalDocument/id,/ClinicalDocument/effectiveTime"
+).split(",")
+# Days the hashes are kept in the hash table, the expiration_time TTL attribute is set when saved, 0 never expires
+HASH_RETENTION_DAYS = int(os.environ.get("HASH_RETENTION_DAYS", "0"))
+# Seconds after which an IN_PROGRESS hash is stale, its message stopped without the exception handler, it can be claimed again
+HASH_CLAIM_LEASE_SECONDS = int(os.environ.get("HASH_CLAIM_LEASE_SECONDS", "3600"))
+# Hashes of COMPLETED messages kept in memory by the container
+HASH_CACHE_SIZE = int(os.environ.get("HASH_CACHE_SIZE", "10000"))
+
+if FUSED_VALIDATION and VALIDATION_MODE not in ("FULL", "SNIFF"):
+    raise ValueError(f"VALIDATION_MODE {VALIDATION_MODE} is not supported with FUSED_VALIDATION, use FULL or SNIFF")
+
+# Kept between the invocations of a warm container
+COMPLETED_HASHES = hash_cache.LRUSet(HASH_CACHE_SIZE)
+
+# Status of the message that owns the hash, a hash can be claimed again if its message is not COMPLETED
+HASH_STATUS_IN_PROGRESS = "IN_PROGRESS"
+HASH_STATUS_FAILED = "FAILED"
+HASH_STATUS_COMPLETED = "COMPLETED"
 
 
 def update_dynamodb_log(messageId, status, error_result):
@@ -75,8 +109,11 @@ def update_dynamodb_log(messageId, status, error_result):
         raise e
 
 
-def put_dynamodb_hash(messageId, creation_date, ccd_hash, filename):
-    """Save MD5 digest hash to DynamoDB if does not exists
+def claim_dynamodb_hash(messageId, creation_date, ccd_hash, filename):
+    """Save MD5 digest hash to DynamoDB with a single conditional update.
+    The hash is claimed if it does not exist, if it is expired, if it is already owned by the same message,
+    if the message that owns it FAILED, or if it is IN_PROGRESS since more than HASH_CLAIM_LEASE_SECONDS.
+    A hash IN_PROGRESS by another message is not taken over, so only one of the concurrent copies is converted.
 
     Args:
         messageId (str): SQS message id, comes with each Record inside Records
@@ -86,24 +123,69 @@ def put_dynamodb_hash(messageId, creation_date, ccd_hash, filename):
 
     Raises:
         err: ClientError is raised if can't save the record
+
+    Returns:
+        dict: Existing item, with the owner messageId, if the hash can't be claimed, None if claimed
     """
+    expression_values = {
+        ":m": {"S": messageId},
+        ":f": {"S": filename},
+        ":c": {"N": f"{creation_date}"},
+        ":s": {"S": HASH_STATUS_IN_PROGRESS},
+        ":failed": {"S": HASH_STATUS_FAILED},
+        ":now": {"N": f"{creation_date}"},
+        ":stale": {"N": f"{creation_date - HASH_CLAIM_LEASE_SECONDS}"},
+    }
+    update_expression = "SET messageId=:m, filename=:f, creation_date=:c, #status=:s"
+
+    if HASH_RETENTION_DAYS > 0:
+        expiration_time = datetime.fromtimestamp(creation_date) + timedelta(days=HASH_RETENTION_DAYS)
+        expression_values[":x"] = {"N": f"{int(expiration_time.timestamp())}"}
+        update_expression += ", expiration_time=:x"
+
     try:
-        DYNAMODB_CLIENT.put_item(
+        DYNAMODB_CLIENT.update_item(
             TableName=CCDS_HASH_TABLE_LOG,
-            Item={
-                "ccd_hash": {"S": ccd_hash},
-                "messageId": {"S": messageId},
-                "filename": {"S": filename},
-                "creation_date": {"N": f"{creation_date}"},
-            },
+            Key={"ccd_hash": {"S": ccd_hash}},
+            ExpressionAttributeNames={"#status": "status"},
+            ExpressionAttributeValues=expression_values,
+            UpdateExpression=update_expression,
+            # Expired hashes are claimed again, DynamoDB deletes them up to 48 hours after the TTL
+            ConditionExpression=(
+                "attribute_not_exists(ccd_hash) OR messageId = :m OR #status = :failed OR expiration_time < :now"
+                " OR (#status = :s AND creation_date < :stale)"
+            ),
+            ReturnValuesOnConditionCheckFailure="ALL_OLD",
         )
+        return None
     except ClientError as err:
+        if err.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return err.response.get("Item", {})
         LOGGER.error(f"## DYNAMODB PUT HASH EXCEPTION: {str(err)}")
-        raise err("Error adding hash to table")
+        raise err
+
+
+def is_message_completed(messageId) -> bool:
+    """Check the status of the message in the DynamoDB message log
+
+    Args:
+        messageId (str): SQS message id
+
+    Returns:
+        bool: True if the message is COMPLETED
+    """
+    message_log_response = DYNAMODB_CLIENT.get_item(TableName=CCDS_SQSMESSAGE_TABLE_LOG, Key={"id": {"S": messageId}})
+    if "Item" in message_log_response:
+        LOGGER.info(f"message_log_response: {message_log_response}")
+        return message_log_response["Item"]["status"]["S"] == "COMPLETED"
+    return False
 
 
 def is_hash_existent(messageId, ccd_hash, filename) -> bool:
-    """Query the DynamoDB hash table log for the item containing the given hash
+    """Claim the hash in the DynamoDB hash table log, the claim fails if the hash belongs to a COMPLETED message,
+    or to another message still IN_PROGRESS, that converts the same content.
+    The hashes of COMPLETED messages already seen by the container are answered from memory.
+    Hashes saved before the status was kept in the hash table are checked in the message log.
 
     Args:
         messageId (str): SQS message id, comes with each Record inside Records
@@ -116,34 +198,178 @@ def is_hash_existent(messageId, ccd_hash, filename) -> bool:
     Returns:
         bool: If found returns True otherwise False
     """
+    if ccd_hash in COMPLETED_HASHES:
+        LOGGER.info(f"CCDA HASH {ccd_hash} found in the cache of completed hashes")
+        return True
+
+    creation_date = int(datetime.now().timestamp())
+
     try:
-        response = DYNAMODB_CLIENT.get_item(TableName=CCDS_HASH_TABLE_LOG, Key={"ccd_hash": {"S": ccd_hash}})
-
-        if "Item" in response:
-            message_id_hash = response["Item"]["messageId"]["S"]
-            LOGGER.info(f"CCDA HASH {ccd_hash} already found in table, message_id {message_id_hash}")
-
-            message_log_response = DYNAMODB_CLIENT.get_item(
-                TableName=CCDS_SQSMESSAGE_TABLE_LOG, Key={"id": {"S": message_id_hash}}
-            )
-            if "Item" in message_log_response:
-                if message_log_response["Item"]["status"]["S"] == "COMPLETED":
-                    LOGGER.info(f"message_log_response: {message_log_response}")
-                    return True
-                else:
-                    return False
-            else:
-                return False
-        else:
-            now = datetime.now()
-            creation_date = int(now.timestamp())
-            put_dynamodb_hash(messageId, creation_date, ccd_hash, filename)
+        existing_item = claim_dynamodb_hash(messageId, creation_date, ccd_hash, filename)
+        if existing_item is None:
             return False
+
+        message_id_hash = existing_item.get("messageId", {}).get("S", "")
+        LOGGER.info(f"CCDA HASH {ccd_hash} already found in table, message_id {message_id_hash}")
+
+        if "status" in existing_item:
+            is_completed = existing_item["status"]["S"] == HASH_STATUS_COMPLETED
+            if not is_completed:
+                LOGGER.info(f"CCDA HASH {ccd_hash} is IN_PROGRESS by message_id {message_id_hash}")
+                return True
+        else:
+            is_completed = is_message_completed(message_id_hash)
+
+        if is_completed:
+            # the cached hash expires with the item, so it can be claimed again once the retention is over
+            expiration_time = existing_item.get("expiration_time", {}).get("N")
+            COMPLETED_HASHES.add(ccd_hash, int(expiration_time) if expiration_time else None)
+        return is_completed
     except ClientError as err:
         LOGGER.error(err)
         raise err
 
-    return False
+
+def hash_object(bucketname, filename, canonical=False):
+    """Generate the MD5 digest of the file streaming its content from S3 in chunks,
+    and the SHA-256 of the raw content, that identifies the exact bytes even when the dedup key is canonical
+
+    Args:
+        bucketname (str): Bucket of the file
+        filename (str): Key of the file
+        canonical (bool): If True, the hash of the canonical form of the XML, the MD5 if it is not XML
+
+    Returns:
+        tuple: MD5 hash of the content, or canonical: prefixed hash, and SHA-256 hex digest of the content
+    """
+    s3_file = S3_CLIENT.get_object(Bucket=bucketname, Key=filename)
+
+    md5_hash = hashlib.md5()
+    sha256_hash = hashlib.sha256()
+    canonical_hasher = canonical_helper.CanonicalHasher(CANONICAL_EXCLUDE_XPATHS) if canonical else None
+    try:
+        for chunk in s3_file["Body"].iter_chunks(STREAM_CHUNK_BYTES):
+            md5_hash.update(chunk)
+            sha256_hash.update(chunk)
+            if canonical_hasher is not None:
+                try:
+                    canonical_hasher.update(chunk)
+                except ET.ParseError as err:
+                    LOGGER.info(f"{filename} is not XML, using the content hash: {str(err)}")
+                    canonical_hasher = None
+    finally:
+        s3_file["Body"].close()
+
+    if canonical_hasher is not None:
+        try:
+            return f"canonical:{canonical_hasher.hexdigest()}", sha256_hash.hexdigest()
+        except ET.ParseError as err:
+            LOGGER.info(f"{filename} is not XML, using the content hash: {str(err)}")
+
+    return md5_hash.hexdigest(), sha256_hash.hexdigest()
+
+
+def object_checksum_key(bucketname, filename):
+    """Dedup key from the object metadata, without downloading the file.
+    The SHA-256 additional checksum is used if the object has one, otherwise the ETag if it is the MD5 of the content:
+    single part uploads not encrypted with SSE-KMS or SSE-C.
+
+    Args:
+        bucketname (str): Bucket of the file
+        filename (str): Key of the file
+
+    Returns:
+        str: Dedup key, None if the metadata has no usable checksum
+    """
+    response = S3_CLIENT.head_object(Bucket=bucketname, Key=filename, ChecksumMode="ENABLED")
+
+    # Checksums of multipart uploads are composite, suffixed with the number of parts
+    checksum = response.get("ChecksumSHA256")
+    if checksum and "-" not in checksum:
+        return f"sha256:{checksum}"
+
+    etag = response.get("ETag", "").strip('"')
+    is_encrypted_with_key = response.get("ServerSideEncryption", "").startswith("aws:kms") or (
+        "SSECustomerAlgorithm" in response
+    )
+    if etag and "-" not in etag and not is_encrypted_with_key:
+        return etag
+
+    return None
+
+
+def validate_and_hash(bucketname, filename):
+    """Stream the file from S3 once, generating the MD5 digest and the SHA-256 of the raw content,
+    and validating the content at the same time.
+    If the content is not XML, the first chunk is checked for a supported HL7 MSH segment.
+    In SNIFF mode the type is decided from the first SNIFF_BYTES when possible, and the rest is only hashed.
+
+    Args:
+        bucketname (str): Bucket of the file
+        filename (str): Key of the file
+
+    Returns:
+        tuple: MD5 hash (canonical hash of the CCDs in CANONICAL mode), SHA-256 hex digest of the content,
+        CCD or HL7 (None if not valid) and the error description, empty if valid
+    """
+    s3_file = S3_CLIENT.get_object(Bucket=bucketname, Key=filename)
+
+    md5_hash = hashlib.md5()
+    sha256_hash = hashlib.sha256()
+    validator = validation_helper.XMLStreamValidator(check_structure=VALIDATE_CCD_STRUCTURE)
+    canonical_hasher = None
+    if DEDUP_KEY_SOURCE == "CANONICAL":
+        canonical_hasher = canonical_helper.CanonicalHasher(CANONICAL_EXCLUDE_XPATHS)
+    head = b""
+    sniffed_type = None
+    parse_error = None
+    structure_errors = []
+
+    try:
+        for chunk in s3_file["Body"].iter_chunks(STREAM_CHUNK_BYTES):
+            if not head:
+                head = chunk
+                if VALIDATION_MODE == "SNIFF":
+                    sniffed_type = validation_helper.classify_head(head[:SNIFF_BYTES])
+            md5_hash.update(chunk)
+            sha256_hash.update(chunk)
+            # After a parse error the content is not XML, only the hash is updated
+            if parse_error is None:
+                try:
+                    if sniffed_type is None:
+                        validator.update(chunk)
+                    if canonical_hasher is not None:
+                        canonical_hasher.update(chunk)
+                except ET.ParseError as err:
+                    parse_error = err
+        if parse_error is None:
+            try:
+                if sniffed_type is None:
+                    structure_errors = validator.close()
+                if canonical_hasher is not None:
+                    ccd_hash = f"canonical:{canonical_hasher.hexdigest()}"
+            except ET.ParseError as err:
+                parse_error = err
+    finally:
+        s3_file["Body"].close()
+
+    if parse_error is not None or canonical_hasher is None:
+        ccd_hash = md5_hash.hexdigest()
+
+    content_sha256 = sha256_hash.hexdigest()
+
+    if sniffed_type is not None:
+        return ccd_hash, content_sha256, sniffed_type, ""
+
+    if parse_error is not None:
+        if validation_helper.is_hl7_supported(validation_helper.hl7_message_type(head)):
+            return ccd_hash, content_sha256, "HL7", ""
+        return ccd_hash, content_sha256, None, str(parse_error)
+
+    if structure_errors:
+        return ccd_hash, content_sha256, None, "; ".join(structure_errors)
+
+    return ccd_hash, content_sha256, "CCD", ""
 
 
 def lambda_handler(event, context):
@@ -151,48 +377,73 @@ def lambda_handler(event, context):
         # 1. Read the file in the Processed Bucket
         # 2. check the dynamodb table if hash exists
         # 3. if found, check the status of the message processing, if message status is COMPLETE raises CCDADuplicatedError, otherwise, enter the new hash
+        #    the hash is claimed with a single conditional update, that returns the status of the existing hash
         # 4. if not exists continue processing
+    In FUSED_VALIDATION mode a SINGLE_FILE record is validated and hashed in the same read of the file,
+    and the validation step is skipped. If the md5_digest is already in the event, the file is not read again.
+    With DEDUP_KEY_SOURCE S3_CHECKSUM, the checksum in the object metadata is used as hash when available.
+    With DEDUP_KEY_SOURCE CANONICAL, the CCDs are hashed by their canonical form, so near-duplicates are detected.
 
     Args:
         event (dict): Lambda Event
         context (dict): Lambda Context
 
     Raises:
-        Exception: InvalidFileError, raised if the file is not valid
+        Exception: InvalidFileError, raised if the file is not valid or the type is not supported in FUSED_VALIDATION mode
         Exception: CCDADuplicatedError, raised if the hash is already in the hash table
 
     Returns:
-        dict: Event updated with the md5_digest key containing the hash
+        dict: Event updated with the md5_digest key containing the hash, the content_sha256 key with the SHA-256
+        of the raw content when it was computed, and the Type in FUSED_VALIDATION mode
     """
     sqs_message_id = event["Source"]["sqs_message_id"]
 
     bucketname = event["Object"]["bucket"]
     filename = event["Object"]["key"]
 
-    if event["Status"] == "VALID":
-
-        ccd_file = S3_CLIENT.get_object(Bucket=bucketname, Key=filename)
-        ccd_content = ccd_file["Body"].read()
-
-        ccd_hash = str(hashlib.md5(ccd_content).hexdigest())
-        # print(ccd_hash)
+    is_fused = event["Status"] == "SINGLE_FILE" and FUSED_VALIDATION
 
-        is_hash_found = is_hash_existent(sqs_message_id, ccd_hash, filename)
-
-        if is_hash_found:
-            event["Status"] = "DUPLICATED"
-            LOGGER.info("-------DUPLICATED CCDA-------")
-            update_dynamodb_log(sqs_message_id, event["Status"], "DUPLICATED CCDA")
-            raise CCDADuplicatedError(event, "DUPLICATED CCDA")
-        else:
-            event["Status"] = "VALID"
-            event["Object"]["md5_digest"] = ccd_hash
-            update_dynamodb_log(sqs_message_id, event["Status"], "")
-            return event
-
-    else:
+    if event["Status"] != "VALID" and not is_fused:
         event["Status"] = "FAILED"
-        update_dynamodb_log(sqs_message_id, event["Status"], "ERROR STEP3 - NOT a VALID status to continue")
-        raise InvalidFileError(event, "NOT a VALID status to continue")
-
-    return event
+        # the records that failed in step 1 keep their error
+        error = event.get("Error", "ERROR STEP3 - NOT a VALID status to continue")
+        update_dynamodb_log(sqs_message_id, event["Status"], error)
+        raise InvalidFileError(event, error)
+
+    ccd_hash = event["Object"].get("md5_digest")
+    content_sha256 = event["Object"].get("content_sha256")
+    if ccd_hash is None and DEDUP_KEY_SOURCE == "S3_CHECKSUM":
+        ccd_hash = object_checksum_key(bucketname, filename)
+        # The SHA-256 additional checksum is the base64 digest of the raw content
+        if ccd_hash is not None and ccd_hash.startswith("sha256:"):
+            content_sha256 = base64.b64decode(ccd_hash[len("sha256:") :]).hex()
+
+    if is_fused:
+        content_hash, content_sha256, filetype, error_result = validate_and_hash(bucketname, filename)
+
+        event["Status"] = "VALID"
+        if not filetype:
+            update_dynamodb_log(sqs_message_id, event["Status"], error_result)
+            raise InvalidFileError(event, f"Not Supported File type: {error_result}")
+
+        event["Object"]["Type"] = filetype
+        ccd_hash = ccd_hash or content_hash
+    elif ccd_hash is None:
+        is_canonical = DEDUP_KEY_SOURCE == "CANONICAL" and event["Object"].get("Type") == "CCD"
+        ccd_hash, content_sha256 = hash_object(bucketname, filename, canonical=is_canonical)
+
+    is_hash_found = is_hash_existent(sqs_message_id, ccd_hash, filename)
+
+    if is_hash_found:
+        event["Status"] = "DUPLICATED"
+        LOGGER.info("-------DUPLICATED CCDA-------")
+        update_dynamodb_log(sqs_message_id, event["Status"], "DUPLICATED CCDA")
+        raise CCDADuplicatedError(event, "DUPLICATED CCDA")
+    else:
+        event["Status"] = "VALID"
+        event["Object"]["md5_digest"] = ccd_hash
+        # Raw content digest, used by the conversion cache, the md5_digest is shared by near-duplicates in CANONICAL mode
+        if content_sha256:
+            event["Object"]["content_sha256"] = content_sha256
+        update_dynamodb_log(sqs_message_id, event["Status"], "")
+        return event
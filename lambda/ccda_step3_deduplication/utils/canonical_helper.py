@@ -0,0 +1,182 @@
+"""
+File: canonical_helper.py
+Project: utils
+Description: Fingerprint of the canonical form of a XML document, generated while the content is streamed
+"""
+
+# Import the libraries
+import hashlib
+import xml.etree.ElementTree as ET
+from fnmatch import fnmatchcase
+
+
+def local_name(tag):
+    """Remove the namespace of the tag or attribute name
+
+    Args:
+        tag (str): Name in the {namespace}name format
+
+    Returns:
+        str: Name without the namespace
+    """
+    return tag.rsplit("}", 1)[-1]
+
+
+def collapse_whitespace(text):
+    """Collapse the sequences of whitespaces and remove them from the edges
+
+    Args:
+        text (str): Text of an element, None if empty
+
+    Returns:
+        str: Text with single spaces
+    """
+    return " ".join(text.split()) if text else ""
+
+
+class ExcludedPath:
+    """Path of the elements or attributes ignored in the canonical form, a subset of XPath:
+    steps with the local names of the elements, * as wildcard, // at the start to match at any depth,
+    and @name as last step to exclude only the attribute.
+
+    Args:
+        expression (str): Path like /ClinicalDocument/effectiveTime, //entry/*/id or /ClinicalDocument/setId/@extension
+    """
+
+    def __init__(self, expression):
+        expression = expression.strip()
+        self.anywhere = expression.startswith("//")
+        steps = [step for step in expression.strip("/").split("/") if step]
+        self.attribute = steps.pop()[1:] if steps and steps[-1].startswith("@") else None
+        self.steps = steps
+
+    def matches_element(self, path):
+        """Check if the element path matches
+
+        Args:
+            path (list): Local names from the root to the element
+
+        Returns:
+            bool: True if the element is excluded
+        """
+        if self.attribute is not None:
+            return False
+        return self._matches(path)
+
+    def matches_attribute(self, path, attribute):
+        """Check if the attribute of the element path matches
+
+        Args:
+            path (list): Local names from the root to the element
+            attribute (str): Local name of the attribute
+
+        Returns:
+            bool: True if the attribute is excluded
+        """
+        if self.attribute is None or not fnmatchcase(attribute, self.attribute):
+            return False
+        return self._matches(path)
+
+    def _matches(self, path):
+        if self.anywhere:
+            if len(path) < len(self.steps):
+                return False
+            path = path[len(path) - len(self.steps) :]
+        elif len(path) != len(self.steps):
+            return False
+        return all(fnmatchcase(name, step) for name, step in zip(path, self.steps))
+
+
+class CanonicalHasher:
+    """SHA-256 of the canonical form of a XML document, the content is fed in chunks like a hashlib object.
+    The canonical form ignores namespaces prefixes, whitespace differences, the order of the attributes
+    and the excluded paths. Closed elements are dropped, so the full tree is never kept in memory.
+    Raises ET.ParseError if the content is not well-formed.
+
+    Args:
+        excluded_paths (list): Path expressions of the elements and attributes ignored
+    """
+
+    def __init__(self, excluded_paths=()):
+        self.excluded_paths = [ExcludedPath(expression) for expression in excluded_paths if expression.strip()]
+        self.parser = ET.XMLPullParser(events=("start", "end"))
+        self.digest = hashlib.sha256()
+        # Open elements, with their path and last closed child, the tail of the child is the text that follows it
+        self.open_elements = []
+        self.path = []
+        self.excluded_depth = 0
+
+    def update(self, chunk):
+        """Feed the next chunk of the content
+
+        Args:
+            chunk (bytes): Next chunk of the content
+        """
+        self.parser.feed(chunk)
+        self._read_events()
+
+    def hexdigest(self):
+        """Finish the document, raises ET.ParseError if the content is incomplete
+
+        Returns:
+            str: Hex SHA-256 of the canonical form
+        """
+        self.parser.close()
+        self._read_events()
+        return self.digest.hexdigest()
+
+    def _write(self, token):
+        self.digest.update(token.encode("utf-8"))
+        self.digest.update(b"\x00")
+
+    def _write_text(self, text):
+        text = collapse_whitespace(text)
+        if text and not self.excluded_depth:
+            self._write(f"#{text}")
+
+    def _flush_text(self, entry):
+        # Text before the next tag: the text of the element or the tail of its last closed child
+        element, last_child = entry
+        if last_child is None:
+            self._write_text(element.text)
+        else:
+            self._write_text(last_child.tail)
+            element.remove(last_child)
+            entry[1] = None
+
+    def _read_events(self):
+        for event, element in self.parser.read_events():
+            if event == "start":
+                if self.open_elements:
+                    self._flush_text(self.open_elements[-1])
+                self.path.append(local_name(element.tag))
+
+                if self.excluded_depth or any(excluded.matches_element(self.path) for excluded in self.excluded_paths):
+                    self.excluded_depth += 1
+                else:
+                    attributes = sorted(
+                        (local_name(name), collapse_whitespace(value))
+                        for name, value in element.attrib.items()
+                        if not any(
+                            excluded.matches_attribute(self.path, local_name(name)) for excluded in self.excluded_paths
+                        )
+                    )
+                    self._write("<" + self.path[-1] + "".join(f" {name}={value}" for name, value in attributes))
+
+                self.open_elements.append([element, None])
+            else:
+                entry = self.open_elements.pop()
+                self._flush_text(entry)
+
+                if self.excluded_depth:
+                    self.excluded_depth -= 1
+                else:
+                    self._write(">")
+                self.path.pop()
+
+                # The tail is kept until the parent reads it
+                tail = element.tail
+                element.clear()
+                element.tail = tail
+                if self.open_elements:
+                    self.open_elements[-1][1] = element
@@ -0,0 +1,53 @@
+"""
+File: hash_cache.py
+Project: utils
+Description: In memory structures to answer the hash lookups of a warm container without DynamoDB
+"""
+
+# Import the libraries
+import time
+from collections import OrderedDict
+
+
+class LRUSet:
+    """Bounded set of keys, the least recently used key is dropped when full.
+    A key can have an expiration time, it is dropped when found expired, as DynamoDB does with the TTL attribute.
+
+    Args:
+        max_size (int): Maximum number of keys kept
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # expiration time of each key, None if it never expires
+        self.keys = OrderedDict()
+
+    def __contains__(self, key):
+        if key not in self.keys:
+            return False
+
+        expiration_time = self.keys[key]
+        if expiration_time is not None and expiration_time <= time.time():
+            del self.keys[key]
+            return False
+
+        self.keys.move_to_end(key)
+        return True
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, expiration_time=None):
+        """Add the key as the most recently used
+
+        Args:
+            key (str): Key to add
+            expiration_time (int): Epoch seconds when the key expires, None if it never expires
+        """
+        if self.max_size <= 0:
+            return
+        self.keys[key] = expiration_time
+        self.keys.move_to_end(key)
+        if len(self.keys) > self.max_size:
+            self.keys.popitem(last=False)
+
@@ -0,0 +1,179 @@
+"""
+File: validation_helper.py
+Project: utils
+Description: Classify CCD and HL7 documents from their first bytes and validate XML as a stream
+"""
+
+# Import the libraries
+import re
+import xml.etree.ElementTree as ET
+
+# Define types of HL7
+HL7_SUPPORTED_TYPES = ["ADT", "VXU", "ORM", "ORU", "PPR", "SIU", "MDM", "ACK", "OML"]
+
+# Root element of a CDA document, CCDs are CDA documents
+CCD_ROOT_ELEMENT = "ClinicalDocument"
+CDA_NAMESPACE = "urn:hl7-org:v3"
+
+# MSH segment at the start of the content or of a new segment, the next char is the field separator
+MSH_SEGMENT = re.compile(rb"(?:^|[\r\n])MSH(.)")
+SEGMENT_END = re.compile(rb"[\r\n]")
+
+UTF8_BOM = b"\xef\xbb\xbf"
+
+
+def local_name(tag):
+    """Remove the namespace from an XML tag
+
+    Args:
+        tag (str): Tag in the ElementTree format, like {urn:hl7-org:v3}ClinicalDocument
+
+    Returns:
+        str: Tag without the namespace
+    """
+    return tag.rsplit("}", 1)[-1]
+
+
+def xml_root_element(head):
+    """Get the root element name from the first bytes of a XML document, without parsing the full document
+
+    Args:
+        head (bytes): First bytes of the document
+
+    Returns:
+        str: Root element name without the namespace, None if not found or not XML
+    """
+    parser = ET.XMLPullParser(events=("start",))
+    try:
+        parser.feed(head)
+        for _, element in parser.read_events():
+            return local_name(element.tag)
+    except ET.ParseError:
+        return None
+    return None
+
+
+def hl7_message_type(content):
+    """Get the message type (MSH-9) of the first MSH segment, the segments after it are not split
+
+    Args:
+        content (bytes): Full content or first bytes of the document
+
+    Returns:
+        str: Message type like ADT^A01, None if there is no MSH segment
+    """
+    match = MSH_SEGMENT.search(content)
+    if match is None:
+        return None
+
+    segment_end = SEGMENT_END.search(content, match.end())
+    segment = content[match.start() : segment_end.start() if segment_end else len(content)].strip()
+    fields = segment.split(match.group(1))
+
+    # MSH-1 is the field separator itself, so MSH-9 is the position 8 after splitting
+    if len(fields) <= 8:
+        return None
+    return fields[8].decode("utf-8", errors="replace")
+
+
+def is_hl7_supported(hl7_type):
+    """Check if the HL7 message type is one of HL7_SUPPORTED_TYPES
+
+    Args:
+        hl7_type (str): Message type like ADT^A01
+
+    Returns:
+        bool: True if supported, otherwise False
+    """
+    return hl7_type is not None and len([x for x in HL7_SUPPORTED_TYPES if x in hl7_type]) == 1
+
+
+def classify_head(head):
+    """Classify a document as CCD or HL7 from its first bytes
+
+    Args:
+        head (bytes): First bytes of the document
+
+    Returns:
+        str: CCD or HL7, None if the type can't be decided from the first bytes
+    """
+    head = head[len(UTF8_BOM) :] if head.startswith(UTF8_BOM) else head
+    stripped = head.lstrip()
+
+    if stripped.startswith(b"<"):
+        if xml_root_element(stripped) == CCD_ROOT_ELEMENT:
+            return "CCD"
+        return None
+
+    if is_hl7_supported(hl7_message_type(stripped)):
+        return "HL7"
+
+    return None
+
+
+class XMLStreamValidator:
+    """Incremental XML validation, the content is fed in chunks like a hashlib object.
+    Each element is dropped as soon as it is closed, so the full tree is never kept in memory.
+    Raises ET.ParseError as soon as the content is not well-formed.
+
+    Args:
+        check_structure (bool): If True, also check the CCD structural markers when closing
+    """
+
+    def __init__(self, check_structure=False):
+        self.check_structure = check_structure
+        self.parser = ET.XMLPullParser(events=("start", "end"))
+        self.open_elements = []
+        self.root_tag = None
+        self.template_ids = 0
+
+    def update(self, chunk):
+        """Feed the next chunk of the content
+
+        Args:
+            chunk (bytes): Next chunk of the content
+        """
+        self.parser.feed(chunk)
+        self._read_events()
+
+    def close(self):
+        """Finish the validation, raises ET.ParseError if the content is incomplete
+
+        Returns:
+            list: Structural errors found, empty if valid or if check_structure is False
+        """
+        self.parser.close()
+        self._read_events()
+
+        if self.check_structure:
+            return self.structure_errors()
+        return []
+
+    def structure_errors(self):
+        """Check the CCD structural markers: ClinicalDocument root element in the HL7 v3 namespace with templateIds
+
+        Returns:
+            list: Structural errors found, empty if valid
+        """
+        errors = []
+        if self.root_tag != f"{{{CDA_NAMESPACE}}}{CCD_ROOT_ELEMENT}":
+            errors.append(f"Root element {self.root_tag} is not a {{{CDA_NAMESPACE}}}{CCD_ROOT_ELEMENT}")
+        if self.template_ids == 0:
+            errors.append(f"{CCD_ROOT_ELEMENT} has no templateId")
+        return errors
+
+    def _read_events(self):
+        for event, element in self.parser.read_events():
+            if event == "start":
+                if self.root_tag is None:
+                    self.root_tag = element.tag
+                elif len(self.open_elements) == 1 and local_name(element.tag) == "templateId":
+                    self.template_ids += 1
+                self.open_elements.append(element)
+            else:
+                self.open_elements.pop()
+                element.clear()
+                # Closed elements are removed from the parent, only the open path is kept in memory
+                if self.open_elements:
+                    self.open_elements[-1].remove(element)
+
@@ -16,41 +16,84 @@ Amazon Web Services, Inc. or Amazon Web Services EMEA SARL or both.
 
 # Import the libraries
 import json
+import hashlib
+import random
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 import os
 import boto3
 import logging
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from urllib.parse import unquote_plus
 from pathlib import Path
 from datetime import datetime
-from utils.exceptions import ConverterError
+from utils import circuit_breaker, fhir_payload_helper
+from utils.exceptions import ConverterError, ConverterUnavailableError
 
 # Instatiate the Logger to save messages to Cloudwatch
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 
 # Load the enviroment variables
-CCD_FHIR_CONVERTER_ENDPOINT = (
-    os.environ["FHIR_CONVERTER_URL"]
-    + os.environ["CCD_FHIR_CONVERTER_ENDPOINT"]
-    + os.environ["CCD_FHIR_CONVERTER_TEMPLATENAME"]
-)
+# Comma separated list of converter URLs, the conversions are routed to the healthiest
+FHIR_CONVERTER_URLS = [
+    url.strip() for url in os.environ.get("FHIR_CONVERTER_URLS", os.environ["FHIR_CONVERTER_URL"]).split(",") if url.strip()
+]
 
-HL7_FHIR_CONVERTER_URL = (
-    os.environ["FHIR_CONVERTER_URL"]
-    + os.environ["HL7_FHIR_CONVERTER_ENDPOINT"]
-    + os.environ["HL7_FHIR_CONVERTER_TEMPLATENAME"]
-)
+CCD_FHIR_CONVERTER_PATH = os.environ["CCD_FHIR_CONVERTER_ENDPOINT"] + os.environ["CCD_FHIR_CONVERTER_TEMPLATENAME"]
+
+HL7_FHIR_CONVERTER_PATH = os.environ["HL7_FHIR_CONVERTER_ENDPOINT"] + os.environ["HL7_FHIR_CONVERTER_TEMPLATENAME"]
 
 CCDS_SQSMESSAGE_TABLE_LOG = os.environ["CCDS_SQSMESSAGE_TABLE_LOG"]
 BUCKET_PROCESSED_CCDS = os.environ["BUCKET_PROCESSED_CCDS"]
 FOLDER_PROCESSED_CCDS = os.environ["FOLDER_PROCESSED_CCDS"]
+# Converted bundles are cached in the processed bucket by content hash, converter path, template name and version
+FOLDER_CONVERSION_CACHE = os.environ.get("FOLDER_CONVERSION_CACHE", "")
+CONVERTER_TEMPLATE_VERSION = os.environ.get("CONVERTER_TEMPLATE_VERSION", "1")
+# gzip, zstd (if zstandard is available) or none
+FHIR_OUTPUT_ENCODING = fhir_payload_helper.output_encoding(os.environ.get("FHIR_OUTPUT_COMPRESSION", "gzip"))
+# Bundles up to this size, compressed and base64 encoded, are sent inline in the event, 0 to always read them from S3
+FHIR_INLINE_MAX_BYTES = int(os.environ.get("FHIR_INLINE_MAX_BYTES", "65536"))
+# Retries of the converter requests on 5xx and connection errors, with jittered exponential backoff
+CONVERTER_MAX_RETRIES = int(os.environ.get("CONVERTER_MAX_RETRIES", "2"))
+CONVERTER_BACKOFF_SECONDS = float(os.environ.get("CONVERTER_BACKOFF_SECONDS", "0.5"))
+CONVERTER_TIMEOUT_SECONDS = float(os.environ.get("CONVERTER_TIMEOUT_SECONDS", "60"))
+CONVERTER_POOL_SIZE = int(os.environ.get("CONVERTER_POOL_SIZE", "10"))
+# Documents converted at the same time in batch mode, kept within the connections of the session
+CONVERTER_BATCH_CONCURRENCY = min(int(os.environ.get("CONVERTER_BATCH_CONCURRENCY", "10")), CONVERTER_POOL_SIZE)
+# Circuit breaker state shared by the concurrent Lambdas, kept by each container if the table is not defined
+CONVERTER_BREAKER_TABLE = os.environ.get("CONVERTER_BREAKER_TABLE", "")
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_OPEN_SECONDS = int(os.environ.get("BREAKER_OPEN_SECONDS", "30"))
 
 # Instantiate the service clients
-S3_CLIENT = boto3.client("s3")
+# Each converted document of a batch saves up to two archive copies at the same time
+S3_CLIENT = boto3.client("s3", config=Config(max_pool_connections=max(10, 2 * CONVERTER_BATCH_CONCURRENCY)))
 DYNAMODB_CLIENT = boto3.client("dynamodb")
 
+# Session kept between the invocations of a warm container, the connections to the converter are reused
+CONVERTER_SESSION = requests.Session()
+CONVERTER_SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=CONVERTER_POOL_SIZE))
+CONVERTER_SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=CONVERTER_POOL_SIZE))
+CONVERTER_SESSION.verify = False
+
+# Threads saving the archive copies of the bundle while the log is updated
+ARCHIVE_EXECUTOR = ThreadPoolExecutor(max_workers=2 * CONVERTER_BATCH_CONCURRENCY)
+# Threads running the conversions of a batch
+BATCH_EXECUTOR = ThreadPoolExecutor(max_workers=CONVERTER_BATCH_CONCURRENCY)
+
+# Health of the converter endpoints, kept between the invocations of a warm container
+ENDPOINT_HEALTH = {url: circuit_breaker.EndpointHealth() for url in FHIR_CONVERTER_URLS}
+CIRCUIT_BREAKER = circuit_breaker.CircuitBreaker(
+    DYNAMODB_CLIENT,
+    CONVERTER_BREAKER_TABLE or None,
+    failure_threshold=BREAKER_FAILURE_THRESHOLD,
+    open_seconds=BREAKER_OPEN_SECONDS,
+)
+
 # Set extra constants
 HEADERS = {"Content-type": "text/plain"}
 
@@ -91,105 +134,358 @@ def update_dynamodb_log(messageId, status, error_result):
         raise e
 
 
-def convert_to_fhir(url, headers, ccd_content, event):
-    """Send the file content to the Converter
+def select_endpoint(failed_urls):
+    """Select the healthiest converter endpoint that is not open, preferring the ones not failed in this conversion.
+    A half-open endpoint is only selected if this conversion takes its trial lease.
 
     Args:
-        url (str: Converter Endpoint
+        failed_urls (set): Endpoints failed in this conversion
+
+    Returns:
+        str: Converter URL, None if all the endpoints are open
+    """
+    # The lease is only requested for the selected endpoint, so the endpoints not selected keep their trial
+    not_open_urls = [url for url in FHIR_CONVERTER_URLS if not CIRCUIT_BREAKER.is_open(url)]
+
+    while not_open_urls:
+        candidate_urls = [url for url in not_open_urls if url not in failed_urls] or not_open_urls
+        # Random tie break, so the containers don't all pick the same new endpoint
+        url = min(candidate_urls, key=lambda url: (ENDPOINT_HEALTH[url].score(), random.random()))
+        if CIRCUIT_BREAKER.is_available(url):
+            return url
+        not_open_urls.remove(url)
+
+    return None
+
+
+def convert_to_fhir(path, headers, ccd_content, event):
+    """Send the file content to the healthiest Converter endpoint, reusing the connections of the session.
+    5xx errors and connection errors are retried up to CONVERTER_MAX_RETRIES times with jittered backoff,
+    on the other endpoints if available. Open endpoints are not called.
+
+    Args:
+        path (str): Converter endpoint path and template name
         headers (dict): Headers to be sent to the Converter API
         ccd_content (str): Content of the file to be converted
         event (dict): input event to be logged if Exception is raised
 
     Raises:
-        ConverterError: Raised if any error happen during convertion, like 4xx, 5xx errors
+        ConverterError: Raised if the Converter returns a 4xx error
+        ConverterUnavailableError: Raised if all the endpoints are open or keep failing, can be retried
+
+    Returns:
+        bytes: If return is 200, returns the converted Fhir Bundle content
+    """
+    error = None
+    failed_urls = set()
+
+    for attempt in range(CONVERTER_MAX_RETRIES + 1):
+        if attempt:
+            # Full jitter, so the concurrent iterations don't retry at the same time
+            time.sleep(random.uniform(0, CONVERTER_BACKOFF_SECONDS * 2 ** (attempt - 1)))
+
+        base_url = select_endpoint(failed_urls)
+        if base_url is None:
+            error = "All the FHIR Converter endpoints are open"
+            break
+        url = base_url + path
+
+        start = time.time()
+        try:
+            response = CONVERTER_SESSION.post(url, headers=headers, data=ccd_content, timeout=CONVERTER_TIMEOUT_SECONDS)
+        except (requests.ConnectionError, requests.Timeout) as err:
+            error = err
+            LOGGER.warning(f"---- CONVERTER CONNECTION ERROR, ATTEMPT {attempt + 1} ---- {str(err)}")
+            ENDPOINT_HEALTH[base_url].record(time.time() - start, True)
+            CIRCUIT_BREAKER.record_failure(base_url)
+            failed_urls.add(base_url)
+            continue
+
+        is_server_error = response.status_code >= 500
+        ENDPOINT_HEALTH[base_url].record(time.time() - start, is_server_error)
+
+        if is_server_error:
+            error = f"{response.status_code} Server Error: {response.reason} for url: {url}"
+            LOGGER.warning(f"---- CONVERTER SERVER ERROR, ATTEMPT {attempt + 1} ---- {error}")
+            CIRCUIT_BREAKER.record_failure(base_url)
+            failed_urls.add(base_url)
+            continue
+
+        # 4xx errors are caused by the document, the endpoint is healthy
+        CIRCUIT_BREAKER.record_success(base_url)
+
+        try:
+            response.raise_for_status()
+        except requests.HTTPError as err:
+            LOGGER.error("---- CONVERTER POST ERROR ----")
+            LOGGER.error(err)
+            LOGGER.info(event)
+            event["Status"] = "FAILED"
+            raise ConverterError(event, str(err))
+
+        return response.content
+
+    LOGGER.error("---- CONVERTER UNAVAILABLE ----")
+    LOGGER.error(error)
+    LOGGER.info(event)
+    event["Status"] = "FAILED"
+    raise ConverterUnavailableError(event, str(error))
+
+
+def content_digest(s3_object):
+    """Digest of the raw file content set by the deduplication step.
+    The content_sha256 is used when available, otherwise the md5_digest if it is not a canonical hash:
+    the canonical hashes are shared by near-duplicates with different content, so they can't key the conversions.
+
+    Args:
+        s3_object (dict): Object of the event
+
+    Returns:
+        str: Digest of the raw content, None if not available
+    """
+    if s3_object.get("content_sha256"):
+        return f"sha256:{s3_object['content_sha256']}"
+
+    md5_digest = s3_object.get("md5_digest")
+    if md5_digest and not md5_digest.startswith("canonical:"):
+        return md5_digest
+    return None
+
+
+def conversion_cache_key(converter_path, content_hash):
+    """Key of the converted bundle in the conversion cache, a new template name or version uses new keys
+
+    Args:
+        converter_path (str): Converter endpoint path and template name
+        content_hash (str): Digest of the raw file content, from content_digest
 
     Returns:
-        str: If return is 200, returns the converted Fhir Bundle as string
+        str: Key in the processed bucket, None if the cache is disabled or there is no content hash
     """
+    if not FOLDER_CONVERSION_CACHE or not content_hash:
+        return None
 
-    # check if server is up
+    template_id = hashlib.sha256(f"{converter_path}|{CONVERTER_TEMPLATE_VERSION}".encode("utf-8")).hexdigest()[:16]
+    # The hash can be a checksum with / and + characters, it is hashed again to get a valid file name
+    content_id = hashlib.sha256(content_hash.encode("utf-8")).hexdigest()
+    return f"{FOLDER_CONVERSION_CACHE}/template={template_id}/{content_id}.fhir.json"
+
+
+def copy_cached_conversion(cache_key, key_fhir_json):
+    """Copy the cached bundle to the FHIR output key, without calling the converter
+
+    Args:
+        cache_key (str): Key of the bundle in the conversion cache
+        key_fhir_json (str): Key of the FHIR output of the message
+
+    Raises:
+        err: ClientError is raised if can't copy the bundle
+
+    Returns:
+        bool: True if found in the cache
+    """
     try:
-        res_get = requests.get(os.environ["FHIR_CONVERTER_URL"], verify=False)
-        res_get.raise_for_status()
-        # check if up POST
-        if res_get:
-            try:
-                response = requests.post(url, headers=headers, data=ccd_content, verify=False)
-                response.raise_for_status()
-                if response:
-                    return response.text
-            except Exception as err:
-                LOGGER.error("---- CONVERTER POST ERROR ----")
-                LOGGER.error(err)
-                LOGGER.info(event)
-                event["Status"] = "FAILED"
-                raise ConverterError(event, str(err))
-    except Exception as err:
-        LOGGER.error("---- CONVERTER GET ERROR ----")
-        LOGGER.error(err)
-        LOGGER.info(event)
-        raise ConverterError(event, str(err))
+        S3_CLIENT.copy_object(
+            Bucket=BUCKET_PROCESSED_CCDS,
+            CopySource={"Bucket": BUCKET_PROCESSED_CCDS, "Key": cache_key},
+            Key=key_fhir_json,
+        )
+        return True
+    except ClientError as err:
+        # Cached bundles already moved to Glacier by the lifecycle rule are converted again
+        if err.response["Error"]["Code"] in ("NoSuchKey", "404", "InvalidObjectState"):
+            return False
+        raise err
 
 
-def lambda_handler(event, context):
-    """Convert the CCD or HL7 to FHIR Bundle
-        # 1. Read the CCD file and send to the FHIR converter
+def put_fhir_object(fhir_bundle_body, key):
+    """Save the FHIR bundle compressed with FHIR_OUTPUT_ENCODING, the next steps read the ContentEncoding to decompress it
+
+    Args:
+        fhir_bundle_body (bytes): FHIR bundle JSON content, compressed with FHIR_OUTPUT_ENCODING
+        key (str): Key in the processed bucket
+    """
+    put_arguments = {"ContentType": "application/json"}
+    if FHIR_OUTPUT_ENCODING:
+        put_arguments["ContentEncoding"] = FHIR_OUTPUT_ENCODING
+
+    S3_CLIENT.put_object(
+        Body=fhir_bundle_body,
+        Bucket=BUCKET_PROCESSED_CCDS,
+        Key=key,
+        **put_arguments,
+    )
+
+
+def inline_fhir_payload(fhir_bundle_content, fhir_bundle_body):
+    """Inline the compressed bundle in the event if it is not bigger than FHIR_INLINE_MAX_BYTES,
+    so the next steps don't have to read it from S3
+
+    Args:
+        fhir_bundle_content (bytes): FHIR bundle JSON content
+        fhir_bundle_body (bytes): FHIR bundle JSON content, compressed with FHIR_OUTPUT_ENCODING
+
+    Returns:
+        dict: Inline bundle fields to add to the Fhir reference, None if the bundle is too big
+    """
+    if not FHIR_INLINE_MAX_BYTES:
+        return None
+
+    encoding = FHIR_OUTPUT_ENCODING
+    if not encoding:
+        # The bundle is always compressed in the event, even if it is saved uncompressed
+        encoding = fhir_payload_helper.GZIP_ENCODING
+        fhir_bundle_body = fhir_payload_helper.compress(fhir_bundle_content, encoding)
+
+    # Size of the base64 content, checked before encoding it
+    if 4 * ((len(fhir_bundle_body) + 2) // 3) > FHIR_INLINE_MAX_BYTES:
+        return None
+
+    return fhir_payload_helper.inline_payload(fhir_bundle_body, encoding)
+
+
+def convert_document(event, year, month, day, inline=True):
+    """Convert the CCD or HL7 of a single document to FHIR Bundle
+        # 1. Read the CCD file and send to the FHIR converter, if not found in the conversion cache
         # 2. If returns 200, save the FHIR into the same folder as the original CCD
         # 3. save the logs to DynamoDB
-        # 4. Forward the Fhir bucket and filename
+        # 4. Forward the Fhir bucket and filename, with the compressed bundle inline if it is small enough
     Args:
-        event (dict): Lambda Event
-        context (dict): Lambda Context
+        event (dict): Document event, from the state machine iteration or from the Records of a batch
+        year (str): Year of the output folder
+        month (str): Month of the output folder
+        day (str): Day of the output folder
+        inline (bool, optional): Send small bundles inline in the event. Defaults to True.
     Raises:
         ConverterError: Raised if an error happen during the Convertion Step
+        ConverterUnavailableError: Raised if the Converter is unavailable, can be retried
 
     Returns:
         dict: Updated Event with the  Status CONVERTED, if no Exception is raised
     """
-    year = str(datetime.today().year)
-    month = str(datetime.today().month)
-    day = str(datetime.today().day)
+    sqs_message_id = event["Source"]["sqs_message_id"]
 
     if event["Status"] == "VALID":
 
-        sqs_message_id = event["Source"]["sqs_message_id"]
         bucketname = event["Object"]["bucket"]
         filename = event["Object"]["key"]
         filetype = event["Object"]["Type"]
 
-        ccd_file = S3_CLIENT.get_object(Bucket=bucketname, Key=filename)
-        ccd_content = ccd_file["Body"].read()
+        f_name = os.path.basename(unquote_plus(filename))
+        fhir_filename = f"{f_name}.fhir.json"
+        key_fhir_json = f"{FOLDER_PROCESSED_CCDS}/year={year}/month={month}/day={day}/message_id={sqs_message_id}/{fhir_filename}"
+
+        converter_path = CCD_FHIR_CONVERTER_PATH if filetype == "CCD" else HL7_FHIR_CONVERTER_PATH
+        cache_key = conversion_cache_key(converter_path, content_digest(event["Object"]))
+        fhir_inline = None
+        archive_futures = []
 
-        if filetype == "CCD":
-            LOGGER.info("---- CCDA Convertion Started -----")
-            fhir_bundle_content = convert_to_fhir(CCD_FHIR_CONVERTER_ENDPOINT, HEADERS, ccd_content, event)
+        if cache_key and copy_cached_conversion(cache_key, key_fhir_json):
+            LOGGER.info(f"---- FHIR Bundle found in the conversion cache {cache_key} -----")
         else:
-            LOGGER.info("---- HL7 Convertion Started -----")
-            fhir_bundle_content = convert_to_fhir(HL7_FHIR_CONVERTER_URL, HEADERS, ccd_content, event)
+            ccd_file = S3_CLIENT.get_object(Bucket=bucketname, Key=filename)
+            ccd_content = ccd_file["Body"].read()
 
-        if fhir_bundle_content:
+            if filetype == "CCD":
+                LOGGER.info("---- CCDA Convertion Started -----")
+            else:
+                LOGGER.info("---- HL7 Convertion Started -----")
+            fhir_bundle_content = convert_to_fhir(converter_path, HEADERS, ccd_content, event)
 
-            filename = unquote_plus(filename)
-            f_name = os.path.basename(filename)
+            # The bundle is saved as returned by the converter, only checked to be a JSON object
+            if not fhir_bundle_content or not fhir_payload_helper.is_json_object(fhir_bundle_content):
+                event["Status"] = "FAILED"
+                LOGGER.info("---- FHIR Convertion Failed -----")
+                update_dynamodb_log(sqs_message_id, event["Status"], "ERROR: STEP4, FHIR Convertion Failed")
+                raise ConverterError(event)
 
-            # convert to json
-            fhir_json = json.loads(fhir_bundle_content)
-            fhir_filename = f"{f_name}.fhir.json"
-            key_fhir_json = f"{FOLDER_PROCESSED_CCDS}/year={year}/month={month}/day={day}/message_id={sqs_message_id}/{fhir_filename}"
-            fhir_json_str = str(json.dumps(fhir_json))
-            S3_CLIENT.put_object(Body=fhir_json_str, Bucket=BUCKET_PROCESSED_CCDS, Key=key_fhir_json)
+            fhir_bundle_body = fhir_payload_helper.compress(fhir_bundle_content, FHIR_OUTPUT_ENCODING)
 
-            event["Fhir"] = {"bucket": BUCKET_PROCESSED_CCDS, "key": key_fhir_json}
+            # The archive copies are saved in background, and waited before returning the event
+            archive_futures.append(ARCHIVE_EXECUTOR.submit(put_fhir_object, fhir_bundle_body, key_fhir_json))
+            if cache_key:
+                archive_futures.append(ARCHIVE_EXECUTOR.submit(put_fhir_object, fhir_bundle_body, cache_key))
 
-            event["Status"] = "CONVERTED"
-            update_dynamodb_log(sqs_message_id, event["Status"], "")
-        else:
-            event["Status"] = "FAILED"
-            LOGGER.info("---- FHIR Convertion Failed -----")
-            update_dynamodb_log(sqs_message_id, event["Status"], "ERROR: STEP4, FHIR Convertion Failed")
-            raise ConverterError(event)
+            if inline:
+                fhir_inline = inline_fhir_payload(fhir_bundle_content, fhir_bundle_body)
+
+        event["Fhir"] = {"bucket": BUCKET_PROCESSED_CCDS, "key": key_fhir_json}
+        if fhir_inline:
+            event["Fhir"].update(fhir_inline)
+
+        event["Status"] = "CONVERTED"
+        update_dynamodb_log(sqs_message_id, event["Status"], "")
+
+        # The Lambda is frozen after returning, the archive copies must be saved before
+        for future in archive_futures:
+            future.result()
     else:
         event["Status"] = "FAILED"
         update_dynamodb_log(sqs_message_id, event["Status"], "ERROR: STEP4, FHIR Convertion Failed")
 
     return event
+
+
+def convert_batch(records):
+    """Convert the documents concurrently in the BATCH_EXECUTOR threads, up to CONVERTER_BATCH_CONCURRENCY
+    at the same time, sharing the connections of the pooled session.
+    A failed document doesn't stop the others, its status is reported in its event.
+    The bundles are not inlined, they would exceed the size of the Lambda response.
+
+    Args:
+        records (list): Document events
+
+    Returns:
+        list: Document events with the Status CONVERTED, or FAILED and the Error, in the order of the records
+    """
+    year = str(datetime.today().year)
+    month = str(datetime.today().month)
+    day = str(datetime.today().day)
+
+    def convert_record(record):
+        try:
+            return convert_document(record, year, month, day, False)
+        except ConverterError as err:
+            # The exception handler of the state machine is not called in batch mode
+            record["Status"] = "FAILED"
+            record["Error"] = {"type": type(err).__name__, "message": err.message}
+            update_dynamodb_log(record["Source"]["sqs_message_id"], record["Status"], f"ERROR: STEP4, {err.message}")
+            return record
+        except Exception as err:
+            LOGGER.error(f"---- CONVERTER BATCH DOCUMENT ERROR ---- {str(err)}")
+            record["Status"] = "FAILED"
+            record["Error"] = {"type": type(err).__name__, "message": str(err)}
+            return record
+
+    return list(BATCH_EXECUTOR.map(convert_record, records))
+
+
+def lambda_handler(event, context):
+    """Convert the CCD or HL7 to FHIR Bundle.
+    An event with Records is a batch of documents, converted concurrently, used for the backfills.
+
+    Args:
+        event (dict): Lambda Event, a document of the state machine iteration or a batch with the Records
+        context (dict): Lambda Context
+    Raises:
+        ConverterError: Raised if an error happen during the Convertion Step
+        ConverterUnavailableError: Raised if the Converter is unavailable, retried by the state machine
+
+    Returns:
+        dict: Updated Event with the  Status CONVERTED, if no Exception is raised.
+            For a batch, the Records with the status of each document, and the count of each status
+    """
+    if "Records" in event:
+        records = convert_batch(event["Records"])
+        LOGGER.info(f"---- CONVERTER BATCH OF {len(records)} DOCUMENTS FINISHED -----")
+        return {
+            "Records": records,
+            "Converted": sum(1 for record in records if record["Status"] == "CONVERTED"),
+            "Failed": sum(1 for record in records if record["Status"] != "CONVERTED"),
+        }
+
+    year = str(datetime.today().year)
+    month = str(datetime.today().month)
+    day = str(datetime.today().day)
+
+    return convert_document(event, year, month, day)
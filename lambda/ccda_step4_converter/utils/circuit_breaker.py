@@ -0,0 +1,242 @@
+"""
+File: circuit_breaker.py
+Project: utils
+Description: Health of the converter endpoints, used to route the conversions and to stop calling failing endpoints
+"""
+
+# Import the libraries
+import time
+import logging
+import threading
+from botocore.exceptions import ClientError
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+
+class EndpointHealth:
+    """Latency and error rate of an endpoint seen by the container, as exponentially weighted moving averages
+
+    Args:
+        alpha (float): Weight of the last request in the averages
+    """
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.latency = None
+        self.error_rate = 0.0
+
+    def record(self, latency, is_error):
+        """Add a request to the averages
+
+        Args:
+            latency (float): Seconds of the request
+            is_error (bool): True if the request failed
+        """
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = self.alpha * latency + (1 - self.alpha) * self.latency
+        self.error_rate = self.alpha * float(is_error) + (1 - self.alpha) * self.error_rate
+
+    def score(self):
+        """Expected cost of a request, the lowest is the healthiest endpoint
+
+        Returns:
+            float: Latency increased by the error rate, 0 if the endpoint was not called yet
+        """
+        if self.latency is None:
+            return 0.0
+        return self.latency / max(1 - self.error_rate, 0.05)
+
+
+class CircuitBreaker:
+    """Circuit breaker for each endpoint, with the state shared by the concurrent Lambdas in a DynamoDB table.
+    After failure_threshold consecutive failures the endpoint is open for open_seconds, and it is not called.
+    When the time ends the endpoint is half-open: a single caller takes the trial lease, that keeps the endpoint open
+    for the other callers during open_seconds more. A success of the trial closes the endpoint,
+    a failure or a lost trial lets the next caller take a new lease when it expires.
+    The state read from the table is cached for cache_seconds. Without a table, the state is kept by the container.
+
+    Args:
+        dynamodb_client (botocore.client.DynamoDB): DynamoDB client
+        table (str): Table with the endpoint partition key, None to keep the state in the container
+        failure_threshold (int): Consecutive failures that open the endpoint
+        open_seconds (int): Seconds the endpoint stays open
+        cache_seconds (int): Seconds the state read from the table is reused
+    """
+
+    def __init__(self, dynamodb_client, table=None, failure_threshold=5, open_seconds=30, cache_seconds=5):
+        self.dynamodb_client = dynamodb_client
+        self.table = table
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.cache_seconds = cache_seconds
+        # endpoint: (failures, opened_until, read time)
+        self.states = {}
+        # The trial lease of the container state is taken by one of the threads of the container
+        self.lock = threading.Lock()
+
+    def _state(self, endpoint):
+        failures, opened_until, read_at = self.states.get(endpoint, (0, 0, 0))
+        if self.table is None or time.time() - read_at < self.cache_seconds:
+            return failures, opened_until
+
+        try:
+            response = self.dynamodb_client.get_item(TableName=self.table, Key={"endpoint": {"S": endpoint}})
+            item = response.get("Item", {})
+            failures = int(item.get("failures", {}).get("N", "0"))
+            opened_until = float(item.get("opened_until", {}).get("N", "0"))
+        except ClientError as err:
+            # The converter is still called if the state can't be read
+            LOGGER.error(f"## DYNAMODB GET BREAKER EXCEPTION: {str(err)}")
+
+        self.states[endpoint] = (failures, opened_until, time.time())
+        return failures, opened_until
+
+    def is_open(self, endpoint) -> bool:
+        """Check if the endpoint is open, without taking the trial lease of a half-open endpoint
+
+        Args:
+            endpoint (str): Endpoint URL
+
+        Returns:
+            bool: True while the endpoint is open
+        """
+        _, opened_until = self._state(endpoint)
+        return time.time() < opened_until
+
+    def is_available(self, endpoint) -> bool:
+        """Check if the endpoint can be called, a half-open endpoint is only available to the caller that takes the trial lease
+
+        Args:
+            endpoint (str): Endpoint URL
+
+        Returns:
+            bool: False while the endpoint is open, or if the trial lease was taken by another caller
+        """
+        _, opened_until = self._state(endpoint)
+        if opened_until == 0:
+            return True
+        if time.time() < opened_until:
+            return False
+        return self._take_trial_lease(endpoint, opened_until)
+
+    def _take_trial_lease(self, endpoint, opened_until):
+        """Extend opened_until by open_seconds for the other callers, only if it was not changed since it was read
+
+        Args:
+            endpoint (str): Endpoint URL
+            opened_until (float): opened_until read by the caller
+
+        Returns:
+            bool: True if the lease was taken, or the endpoint was closed meanwhile
+        """
+        now = time.time()
+        lease_until = now + self.open_seconds
+
+        if self.table is None:
+            with self.lock:
+                failures, current_until, read_at = self.states.get(endpoint, (0, 0, 0))
+                # Another thread took the lease, or the endpoint was closed by a successful trial
+                if current_until == 0 or now < current_until:
+                    return current_until == 0
+                self.states[endpoint] = (failures, lease_until, read_at)
+            LOGGER.info(f"---- CONVERTER ENDPOINT {endpoint} HALF-OPEN, TRIAL REQUEST ----")
+            return True
+
+        failures, _, _ = self.states.get(endpoint, (0, 0, 0))
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.table,
+                Key={"endpoint": {"S": endpoint}},
+                ExpressionAttributeValues={":until": {"N": f"{lease_until}"}, ":seen": {"N": f"{opened_until}"}},
+                UpdateExpression="SET opened_until=:until",
+                ConditionExpression="opened_until = :seen",
+                ReturnValuesOnConditionCheckFailure="ALL_OLD",
+            )
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                # The converter is still called if the state can't be written, as when it can't be read
+                LOGGER.error(f"## DYNAMODB UPDATE BREAKER EXCEPTION: {str(err)}")
+                return True
+
+            # Another caller took the lease, or the endpoint was closed by a successful trial
+            item = err.response.get("Item", {})
+            failures = int(item.get("failures", {}).get("N", "0"))
+            current_until = float(item.get("opened_until", {}).get("N", "0"))
+            self.states[endpoint] = (failures, current_until, now)
+            return current_until == 0
+
+        self.states[endpoint] = (failures, lease_until, now)
+        LOGGER.info(f"---- CONVERTER ENDPOINT {endpoint} HALF-OPEN, TRIAL REQUEST ----")
+        return True
+
+    def record_success(self, endpoint):
+        """Close the endpoint. The table is always updated, as the failures can be counted by other containers
+        after the state was cached, the condition skips the write when there are no failures
+
+        Args:
+            endpoint (str): Endpoint URL
+        """
+        self.states[endpoint] = (0, 0, time.time())
+        if self.table is None:
+            return
+
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.table,
+                Key={"endpoint": {"S": endpoint}},
+                ExpressionAttributeValues={":zero": {"N": "0"}},
+                UpdateExpression="SET failures=:zero, opened_until=:zero",
+                ConditionExpression="failures > :zero",
+            )
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                LOGGER.error(f"## DYNAMODB UPDATE BREAKER EXCEPTION: {str(err)}")
+
+    def record_failure(self, endpoint):
+        """Count the failure, and open the endpoint when failure_threshold is reached
+
+        Args:
+            endpoint (str): Endpoint URL
+        """
+        now = time.time()
+        failures, opened_until, _ = self.states.get(endpoint, (0, 0, 0))
+
+        if self.table is None:
+            failures += 1
+            if failures >= self.failure_threshold and now >= opened_until:
+                LOGGER.warning(f"---- CONVERTER ENDPOINT {endpoint} OPEN FOR {self.open_seconds}s ----")
+                opened_until = now + self.open_seconds
+            self.states[endpoint] = (failures, opened_until, now)
+            return
+
+        try:
+            response = self.dynamodb_client.update_item(
+                TableName=self.table,
+                Key={"endpoint": {"S": endpoint}},
+                ExpressionAttributeValues={":one": {"N": "1"}},
+                UpdateExpression="ADD failures :one",
+                ReturnValues="ALL_NEW",
+            )
+            item = response["Attributes"]
+            failures = int(item["failures"]["N"])
+            opened_until = float(item.get("opened_until", {}).get("N", "0"))
+
+            # Only one of the concurrent failures opens the endpoint
+            if failures >= self.failure_threshold and now >= opened_until:
+                opened_until = now + self.open_seconds
+                self.dynamodb_client.update_item(
+                    TableName=self.table,
+                    Key={"endpoint": {"S": endpoint}},
+                    ExpressionAttributeValues={":until": {"N": f"{opened_until}"}, ":now": {"N": f"{now}"}},
+                    UpdateExpression="SET opened_until=:until",
+                    ConditionExpression="attribute_not_exists(opened_until) OR opened_until < :now",
+                )
+                LOGGER.warning(f"---- CONVERTER ENDPOINT {endpoint} OPEN FOR {self.open_seconds}s ----")
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                LOGGER.error(f"## DYNAMODB UPDATE BREAKER EXCEPTION: {str(err)}")
+
+        self.states[endpoint] = (failures, opened_until, now)
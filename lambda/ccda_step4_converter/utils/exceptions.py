@@ -32,3 +32,10 @@ class ConverterError(Exception):
         error_message = {"error": self.message, "event": self.event}
         LOGGER.error(error_message)
         return json.dumps(error_message)
+
+
+class ConverterUnavailableError(ConverterError):
+    """Raised when all the Converter endpoints are open or keep failing with 5xx or connection errors, can be retried"""
+
+    def __init__(self, event, message="FHIR Converter unavailable"):
+        super().__init__(event, message)
@@ -16,15 +16,17 @@ Amazon Web Services, Inc. or Amazon Web Services EMEA SARL or both.
 """
 
 # Import the libraries
+import io
 import json
 import requests
 import os
 import boto3
 import logging
 from botocore.exceptions import ClientError
-import awswrangler as wr
+import pyarrow.parquet as pq
 from datetime import datetime
 from utils.ccd_load_delta import build_datasets
+from utils import dataset_schemas, fhir_payload_helper, glue_catalog
 from utils.exceptions import FhirDatasetsGenerationError
 
 # Instatiate the Logger to save messages to Cloudwatch
@@ -35,10 +37,21 @@ LOGGER.setLevel(logging.INFO)
 CCDS_SQSMESSAGE_TABLE_LOG = os.environ["CCDS_SQSMESSAGE_TABLE_LOG"]
 BUCKET_PROCESSED_FHIR_DATASETS = os.environ["BUCKET_PROCESSED_FHIR_DATASETS"]
 FOLDER_PROCESSED_FHIRS_DATASETS = os.environ["FOLDER_PROCESSED_FHIRS_DATASETS"]
+# Parquet writer settings, the files of the datasets are compacted later with the same settings
+PARQUET_COMPRESSION = os.environ.get("PARQUET_COMPRESSION", "zstd")
+PARQUET_COMPRESSION_LEVEL = int(os.environ.get("PARQUET_COMPRESSION_LEVEL", "3"))
+PARQUET_ROW_GROUP_SIZE = int(os.environ.get("PARQUET_ROW_GROUP_SIZE", "131072"))
+# Glue database where the tables and partitions of the datasets are registered, not registered if empty
+GLUE_DATABASE = os.environ.get("GLUE_DATABASE", "")
+GLUE_TABLE_PREFIX = os.environ.get("GLUE_TABLE_PREFIX", "fhir_")
 
 # Instantiate the service clients
 S3_CLIENT = boto3.client("s3")
 DYNAMODB_CLIENT = boto3.client("dynamodb")
+GLUE_CLIENT = boto3.client("glue")
+
+# Tables and partitions registered, kept between the invocations of a warm container
+GLUE_REGISTRY = glue_catalog.GluePartitionRegistry(GLUE_CLIENT, GLUE_DATABASE, GLUE_TABLE_PREFIX)
 
 
 def update_dynamodb_log(messageId, status, error_result):
@@ -77,6 +90,44 @@ def update_dynamodb_log(messageId, status, error_result):
         raise e
 
 
+def put_dataset(table, key):
+    """Write the dataset table as parquet in memory and save it to the datasets bucket.
+    The timestamps are saved in milliseconds, supported by Athena.
+
+    Args:
+        table (pyarrow.Table): Dataset table
+        key (str): Key in the datasets bucket
+    """
+    parquet_buffer = io.BytesIO()
+    pq.write_table(
+        table,
+        parquet_buffer,
+        compression=PARQUET_COMPRESSION,
+        compression_level=PARQUET_COMPRESSION_LEVEL,
+        row_group_size=PARQUET_ROW_GROUP_SIZE,
+        coerce_timestamps="ms",
+        allow_truncated_timestamps=True,
+    )
+    S3_CLIENT.put_object(Body=parquet_buffer.getvalue(), Bucket=BUCKET_PROCESSED_FHIR_DATASETS, Key=key)
+
+
+def register_partitions(resource_types, year, month, day):
+    """Register the tables and the partitions of the day of the datasets saved, only the first time for each container
+
+    Args:
+        resource_types (list): Datasets saved
+        year (str): Year partition
+        month (str): Month partition
+        day (str): Day partition
+    """
+    for resource_type in resource_types:
+        schema = dataset_schemas.SCHEMAS[resource_type]
+        location = f"s3://{BUCKET_PROCESSED_FHIR_DATASETS}/{FOLDER_PROCESSED_FHIRS_DATASETS}/resource_type={resource_type}/"
+        if GLUE_REGISTRY.ensure_table(resource_type, schema, location):
+            partition_location = f"{location}year={year}/month={month}/day={day}/"
+            GLUE_REGISTRY.register_partitions(resource_type, schema, [((year, month, day), partition_location)])
+
+
 def generate_datasets(fhir_content, filename, message_id, event):
     """Send  the Fhir bundle to the Dataset Builder, generating the following datasets for each Bundlle:
         - conditions
@@ -108,12 +159,14 @@ def generate_datasets(fhir_content, filename, message_id, event):
             datasets = build_datasets(fhir_content["fhirResource"], filename)
 
             if datasets:
+                saved_resource_types = []
                 for k, v in datasets.items():
-                    if v.shape[0] > 0:
-                        _file = f"s3://{BUCKET_PROCESSED_FHIR_DATASETS}/{FOLDER_PROCESSED_FHIRS_DATASETS}/resource_type={k}/year={year}/month={month}/day={day}/message_id={message_id}/{filename}.parquet"
-                        wr.s3.to_parquet(v, _file)
-                        # res = add_new_partition(
-                        #     'AwsDataCatalog', 'fhir', k, year, month, day)
+                    if v.num_rows > 0:
+                        _file = f"{FOLDER_PROCESSED_FHIRS_DATASETS}/resource_type={k}/year={year}/month={month}/day={day}/message_id={message_id}/{filename}.parquet"
+                        put_dataset(v, _file)
+                        saved_resource_types.append(k)
+                if GLUE_DATABASE:
+                    register_partitions(saved_resource_types, year, month, day)
                 is_datasets_created = True
     except (Exception, AttributeError) as err:
         raise FhirDatasetsGenerationError(event, str(err))
@@ -145,11 +198,12 @@ def lambda_handler(event, context):
 
         sqs_message_id = event["Source"]["sqs_message_id"]
 
-        fhir_bucket = event["Fhir"]["bucket"]
         fhir_filename = event["Fhir"]["key"]
 
-        fhir_file = S3_CLIENT.get_object(Bucket=fhir_bucket, Key=fhir_filename)
-        fhir_content = json.loads(fhir_file["Body"].read())
+        # The bundle comes inline in the event if it is small, otherwise it is read from S3,
+        # and it is decompressed by its encoding
+        fhir_inline = fhir_payload_helper.pop_inline_payload(event["Fhir"])
+        fhir_content = json.loads(fhir_payload_helper.read_fhir_payload(S3_CLIENT, event["Fhir"], fhir_inline))
 
         f_name = os.path.basename(fhir_filename).replace(".json", "")
 
@@ -157,6 +211,9 @@ def lambda_handler(event, context):
             # process the dataset builder over the fhir bundle
             event["Status"] = "DATASETS_GENERATED"
             update_dynamodb_log(sqs_message_id, event["Status"], "")
+            # Forward the inline bundle to the next step
+            if fhir_inline:
+                event["Fhir"].update(fhir_inline)
         else:
             event["Status"] = "FAILED"
             update_dynamodb_log(sqs_message_id, event["Status"], "ERROR: STEP5, Failed to generate dataset from FHIR")
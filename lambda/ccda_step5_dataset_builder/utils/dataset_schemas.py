@@ -0,0 +1,196 @@
+"""
+File: dataset_schemas.py
+Project: utils
+Description: Declared parquet schemas of the FHIR datasets, so every file of a dataset has the same columns and types
+"""
+
+# Import the libraries
+import re
+from datetime import date, datetime, timezone
+import pyarrow as pa
+
+# Low cardinality columns are dictionary encoded
+DICTIONARY_STRING = pa.dictionary(pa.int32(), pa.string())
+# Dates of the FHIR dateTime columns, normalized to UTC
+TIMESTAMP = pa.timestamp("ms", tz="UTC")
+# Fraction of the seconds, FHIR allows any precision but datetime.fromisoformat of Python 3.8 only 3 or 6 digits
+SECONDS_FRACTION = re.compile(r"\.(\d+)")
+
+# Columns shared by all the datasets
+DOCUMENT_FIELDS = [
+    pa.field("filename", DICTIONARY_STRING),
+    pa.field("orgName", DICTIONARY_STRING),
+    pa.field("doc_id", pa.string()),
+    pa.field("doc_type", DICTIONARY_STRING),
+]
+
+SCHEMAS = {
+    "person": pa.schema(
+        [
+            pa.field("person_id", pa.string()),
+            pa.field("birthdate", pa.date32()),
+            pa.field("gender", DICTIONARY_STRING),
+            pa.field("lastname", pa.string()),
+            pa.field("firstname", pa.string()),
+            pa.field("raceVal", DICTIONARY_STRING),
+            pa.field("ethVal", DICTIONARY_STRING),
+            pa.field("address", pa.string()),
+            pa.field("city", DICTIONARY_STRING),
+            pa.field("state", DICTIONARY_STRING),
+            pa.field("country", DICTIONARY_STRING),
+            pa.field("postalCode", pa.string()),
+        ]
+        + DOCUMENT_FIELDS
+    ),
+    "encounters": pa.schema(
+        [
+            pa.field("person_id", pa.string()),
+            pa.field("encounter_id", pa.string()),
+            pa.field("class", DICTIONARY_STRING),
+            pa.field("type", DICTIONARY_STRING),
+            pa.field("start", TIMESTAMP),
+            pa.field("end", TIMESTAMP),
+            pa.field("dcDispo", DICTIONARY_STRING),
+        ]
+        + DOCUMENT_FIELDS
+    ),
+    "conditions": pa.schema(
+        [
+            pa.field("person_id", pa.string()),
+            pa.field("encounter_id", pa.string()),
+            pa.field("dxcode", pa.string()),
+            pa.field("dxdescription", pa.string()),
+            pa.field("dxsystem", DICTIONARY_STRING),
+        ]
+        + DOCUMENT_FIELDS
+    ),
+    "medications": pa.schema(
+        [
+            pa.field("record_type", DICTIONARY_STRING),
+            pa.field("person_id", pa.string()),
+            pa.field("encounter_id", pa.string()),
+            pa.field("code", pa.string()),
+            pa.field("drug_name", pa.string()),
+            pa.field("code_system", DICTIONARY_STRING),
+        ]
+        + DOCUMENT_FIELDS
+    ),
+    "observations": pa.schema(
+        [
+            pa.field("record_type", DICTIONARY_STRING),
+            pa.field("person_id", pa.string()),
+            pa.field("encounter_id", pa.string()),
+            pa.field("code", pa.string()),
+            pa.field("test_name", pa.string()),
+            pa.field("code_system", DICTIONARY_STRING),
+            pa.field("testInterp", DICTIONARY_STRING),
+            pa.field("testDate", TIMESTAMP),
+            pa.field("status", DICTIONARY_STRING),
+        ]
+        + DOCUMENT_FIELDS
+    ),
+}
+
+
+def parse_fhir_datetime(value):
+    """Parse a FHIR date or dateTime, partial dates like 2020 or 2020-05 are the first day of the period
+
+    Args:
+        value (str): FHIR date or dateTime
+
+    Returns:
+        datetime: Datetime in UTC, None if the value is empty or not valid
+    """
+    if not value:
+        return None
+    try:
+        if len(value) <= 10:
+            parts = [int(part) for part in value.split("-")]
+            parts += [1] * (3 - len(parts))
+            return datetime(parts[0], parts[1], parts[2], tzinfo=timezone.utc)
+        value = SECONDS_FRACTION.sub(lambda match: "." + match.group(1)[:6].ljust(6, "0"), value, count=1)
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except (TypeError, ValueError):
+        return None
+    # dateTimes without offset are taken as UTC
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def parse_fhir_date(value):
+    """Parse a FHIR date, the time of a dateTime is dropped
+
+    Args:
+        value (str): FHIR date or dateTime
+
+    Returns:
+        date: Date, None if the value is empty or not valid
+    """
+    parsed = parse_fhir_datetime(value)
+    if parsed is None:
+        return None
+    return date(parsed.year, parsed.month, parsed.day)
+
+
+def to_array(values, field_type):
+    """Convert the values of a column to the type of the schema
+
+    Args:
+        values (list): Column values, strings or None
+        field_type (pyarrow.DataType): Type of the column in the schema
+
+    Returns:
+        pyarrow.Array: Typed column
+    """
+    if field_type == TIMESTAMP:
+        return pa.array([parse_fhir_datetime(value) for value in values], type=field_type)
+    if field_type == pa.date32():
+        return pa.array([parse_fhir_date(value) for value in values], type=field_type)
+    if pa.types.is_dictionary(field_type):
+        return pa.array(values, type=field_type.value_type).dictionary_encode()
+    return pa.array(values, type=field_type)
+
+
+def to_table(columns, num_rows, schema):
+    """Build the Table of the dataset with the declared schema, missing columns are null
+
+    Args:
+        columns (dict): Column values by name
+        num_rows (int): Rows of the dataset
+        schema (pyarrow.Schema): Declared schema of the dataset
+
+    Returns:
+        pyarrow.Table: Dataset table
+    """
+    arrays = [to_array(columns.get(field.name, [None] * num_rows), field.type) for field in schema]
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def conform_table(table, schema):
+    """Convert a table read from a dataset file to the declared schema,
+    the files saved before the schemas were declared have inferred types and can miss columns
+
+    Args:
+        table (pyarrow.Table): Table read from a dataset file
+        schema (pyarrow.Schema): Declared schema of the dataset
+
+    Returns:
+        pyarrow.Table: Table with the declared schema, the columns not declared are dropped
+    """
+    if table.schema.equals(schema):
+        # The metadata saved by the writer is dropped, so the tables of all the files can be concatenated
+        return table.replace_schema_metadata()
+
+    arrays = []
+    for field in schema:
+        if field.name not in table.column_names:
+            arrays.append(to_array([None] * table.num_rows, field.type))
+            continue
+        column = table.column(field.name).combine_chunks()
+        if column.type == field.type:
+            arrays.append(column)
+            continue
+        values = [None if value is None else str(value) for value in column.to_pylist()]
+        arrays.append(to_array(values, field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
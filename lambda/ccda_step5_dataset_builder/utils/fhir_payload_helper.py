@@ -0,0 +1,152 @@
+"""
+File: fhir_payload_helper.py
+Project: utils
+Description: Compress and read the FHIR bundles saved by the converter step
+"""
+
+# Import the libraries
+import base64
+import gzip
+
+# zstandard is optional, gzip is used if it is not available
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# ContentEncoding of the supported compressions
+GZIP_ENCODING = "gzip"
+ZSTD_ENCODING = "zstd"
+
+# Fields of the Fhir reference of the event with the inline bundle
+INLINE_PAYLOAD_FIELDS = ("inline", "encoding")
+
+
+def output_encoding(compression):
+    """ContentEncoding used for the requested compression, zstd falls back to gzip if zstandard is not available
+
+    Args:
+        compression (str): gzip, zstd or none
+
+    Returns:
+        str: ContentEncoding, None if not compressed
+    """
+    compression = compression.lower()
+    if compression == ZSTD_ENCODING and zstandard is not None:
+        return ZSTD_ENCODING
+    if compression in (GZIP_ENCODING, ZSTD_ENCODING):
+        return GZIP_ENCODING
+    return None
+
+
+def compress(content, encoding):
+    """Compress the content
+
+    Args:
+        content (bytes): Content to compress
+        encoding (str): ContentEncoding, None to keep the content
+
+    Returns:
+        bytes: Compressed content
+    """
+    if encoding == GZIP_ENCODING:
+        return gzip.compress(content, compresslevel=6)
+    if encoding == ZSTD_ENCODING:
+        return zstandard.ZstdCompressor(level=3).compress(content)
+    return content
+
+
+def decompress(content, encoding):
+    """Decompress the content
+
+    Args:
+        content (bytes): Content to decompress
+        encoding (str): ContentEncoding of the content, None if not compressed
+
+    Raises:
+        ValueError: Raised if the encoding is not supported
+
+    Returns:
+        bytes: Decompressed content
+    """
+    if not encoding or encoding == "identity":
+        return content
+    if encoding == GZIP_ENCODING:
+        return gzip.decompress(content)
+    if encoding == ZSTD_ENCODING:
+        if zstandard is None:
+            raise ValueError("zstandard is required to read zstd FHIR bundles")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(content)
+    raise ValueError(f"Unsupported ContentEncoding {encoding}")
+
+
+def is_json_object(content):
+    """Cheap check of the converter response, without parsing it
+
+    Args:
+        content (bytes): Response content
+
+    Returns:
+        bool: True if the content is delimited as a JSON object
+    """
+    content = content.strip()
+    return content.startswith(b"{") and content.endswith(b"}")
+
+
+def read_fhir_object(s3_client, bucket, key):
+    """Read the FHIR bundle from S3, decompressing it by its ContentEncoding
+
+    Args:
+        s3_client (botocore.client.S3): S3 client
+        bucket (str): Bucket of the bundle
+        key (str): Key of the bundle
+
+    Returns:
+        bytes: FHIR bundle JSON content
+    """
+    fhir_file = s3_client.get_object(Bucket=bucket, Key=key)
+    return decompress(fhir_file["Body"].read(), fhir_file.get("ContentEncoding"))
+
+
+def inline_payload(content, encoding):
+    """Fields added to the Fhir reference of the event to carry the bundle in the state payload
+
+    Args:
+        content (bytes): Compressed FHIR bundle content
+        encoding (str): ContentEncoding of the content
+
+    Returns:
+        dict: Base64 content and its encoding
+    """
+    return {"inline": base64.b64encode(content).decode("ascii"), "encoding": encoding}
+
+
+def pop_inline_payload(fhir):
+    """Remove the inline bundle from the Fhir reference of the event,
+    so it is not carried in the Exceptions, that are limited in size by the state machine
+
+    Args:
+        fhir (dict): Fhir reference of the event
+
+    Returns:
+        dict: Inline bundle fields, None if the bundle is only in S3
+    """
+    if "inline" not in fhir:
+        return None
+    return {field: fhir.pop(field) for field in INLINE_PAYLOAD_FIELDS if field in fhir}
+
+
+def read_fhir_payload(s3_client, fhir, fhir_inline=None):
+    """Read the FHIR bundle from the inline payload, or from S3 if the bundle was too big to be inlined
+
+    Args:
+        s3_client (botocore.client.S3): S3 client
+        fhir (dict): Fhir reference of the event, with the bucket and key of the bundle
+        fhir_inline (dict, optional): Inline bundle fields removed from the event. Defaults to None.
+
+    Returns:
+        bytes: FHIR bundle JSON content
+    """
+    if fhir_inline:
+        return decompress(base64.b64decode(fhir_inline["inline"]), fhir_inline.get("encoding"))
+    return read_fhir_object(s3_client, fhir["bucket"], fhir["key"])
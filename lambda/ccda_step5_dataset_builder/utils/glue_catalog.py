@@ -0,0 +1,226 @@
+"""
+File: glue_catalog.py
+Project: utils
+Description: Register the tables and the new partitions of the FHIR datasets in the Glue Data Catalog, without crawlers,
+and move the partitions to the files merged by the compaction
+"""
+
+# Import the libraries
+import logging
+import pyarrow as pa
+from botocore.exceptions import ClientError
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Partitions of the tables, the folders saved by step 5 inside resource_type=
+PARTITION_KEYS = ["year", "month", "day"]
+# Maximum number of partitions of a BatchCreatePartition request
+GLUE_BATCH_PARTITION_LIMIT = 100
+
+PARQUET_STORAGE = {
+    "InputFormat": "org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
+    "OutputFormat": "org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
+    "SerdeInfo": {
+        "SerializationLibrary": "org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe",
+        "Parameters": {"serialization.format": "1"},
+    },
+}
+
+
+def glue_type(field_type):
+    """Glue column type of a pyarrow type, the dictionary columns are strings
+
+    Args:
+        field_type (pyarrow.DataType): Type of the column in the schema
+
+    Returns:
+        str: Glue column type
+    """
+    if pa.types.is_dictionary(field_type):
+        field_type = field_type.value_type
+    if pa.types.is_timestamp(field_type):
+        return "timestamp"
+    if pa.types.is_date(field_type):
+        return "date"
+    if pa.types.is_integer(field_type):
+        return "bigint"
+    if pa.types.is_floating(field_type):
+        return "double"
+    if pa.types.is_boolean(field_type):
+        return "boolean"
+    return "string"
+
+
+def glue_columns(schema):
+    """Glue columns of the schema
+
+    Args:
+        schema (pyarrow.Schema): Declared schema of the dataset
+
+    Returns:
+        list: Name and type of each column
+    """
+    return [{"Name": field.name, "Type": glue_type(field.type)} for field in schema]
+
+
+class GluePartitionRegistry:
+    """Tables and partitions registered in the Glue Data Catalog, the registered ones are kept by the warm container,
+    so each table and partition is checked in Glue once by container. The errors are logged and not cached,
+    so the next invocation tries again.
+
+    Args:
+        glue_client (botocore.client.Glue): Glue client
+        database (str): Glue database of the tables
+        table_prefix (str): Prefix of the table names, followed by the resource type
+    """
+
+    def __init__(self, glue_client, database, table_prefix="fhir_"):
+        self.glue_client = glue_client
+        self.database = database
+        self.table_prefix = table_prefix
+        self.tables = set()
+        self.partitions = set()
+
+    def table_name(self, resource_type):
+        return f"{self.table_prefix}{resource_type}"
+
+    def ensure_table(self, resource_type, schema, location):
+        """Create the table of the dataset if it doesn't exist
+
+        Args:
+            resource_type (str): Dataset name
+            schema (pyarrow.Schema): Declared schema of the dataset
+            location (str): S3 location of the dataset, with the partition folders
+
+        Returns:
+            bool: True if the table exists or was created
+        """
+        table_name = self.table_name(resource_type)
+        if table_name in self.tables:
+            return True
+
+        table_input = {
+            "Name": table_name,
+            "TableType": "EXTERNAL_TABLE",
+            "Parameters": {"classification": "parquet", "EXTERNAL": "TRUE"},
+            "PartitionKeys": [{"Name": name, "Type": "string"} for name in PARTITION_KEYS],
+            "StorageDescriptor": {
+                "Columns": glue_columns(schema),
+                "Location": location,
+                **PARQUET_STORAGE,
+            },
+        }
+        try:
+            self.glue_client.create_table(DatabaseName=self.database, TableInput=table_input)
+            LOGGER.info(f"---- GLUE TABLE {self.database}.{table_name} CREATED ----")
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "AlreadyExistsException":
+                LOGGER.error(f"## GLUE CREATE TABLE EXCEPTION: {str(err)}")
+                return False
+
+        self.tables.add(table_name)
+        return True
+
+    def register_partitions(self, resource_type, schema, partitions):
+        """Create the partitions not registered yet, with BatchCreatePartition
+
+        Args:
+            resource_type (str): Dataset name
+            schema (pyarrow.Schema): Declared schema of the dataset
+            partitions (list): Tuples with the year, month and day values, and the S3 location of the partition
+        """
+        table_name = self.table_name(resource_type)
+        new_partitions = [
+            (values, location) for values, location in partitions if (table_name, values) not in self.partitions
+        ]
+
+        for start in range(0, len(new_partitions), GLUE_BATCH_PARTITION_LIMIT):
+            batch = new_partitions[start : start + GLUE_BATCH_PARTITION_LIMIT]
+            partition_inputs = [
+                {
+                    "Values": list(values),
+                    "StorageDescriptor": {
+                        "Columns": glue_columns(schema),
+                        "Location": location,
+                        **PARQUET_STORAGE,
+                    },
+                }
+                for values, location in batch
+            ]
+            try:
+                response = self.glue_client.batch_create_partition(
+                    DatabaseName=self.database, TableName=table_name, PartitionInputList=partition_inputs
+                )
+            except ClientError as err:
+                LOGGER.error(f"## GLUE BATCH CREATE PARTITION EXCEPTION: {str(err)}")
+                continue
+
+            # Partitions created by the concurrent Lambdas are registered too
+            failed_values = {
+                tuple(error["PartitionValues"])
+                for error in response.get("Errors", [])
+                if error["ErrorDetail"]["ErrorCode"] != "AlreadyExistsException"
+            }
+            for values, _ in batch:
+                if values in failed_values:
+                    LOGGER.error(f"## GLUE BATCH CREATE PARTITION ERROR: {table_name} {values}")
+                else:
+                    self.partitions.add((table_name, values))
+
+    def partition_location(self, resource_type, values):
+        """Location of a partition in the Glue Data Catalog
+
+        Args:
+            resource_type (str): Dataset name
+            values (tuple): Year, month and day values of the partition
+
+        Returns:
+            str: S3 location of the partition, None if the partition is not registered
+        """
+        try:
+            response = self.glue_client.get_partition(
+                DatabaseName=self.database, TableName=self.table_name(resource_type), PartitionValues=list(values)
+            )
+        except ClientError as err:
+            if err.response["Error"]["Code"] == "EntityNotFoundException":
+                return None
+            raise
+        return response["Partition"]["StorageDescriptor"]["Location"]
+
+    def move_partition(self, resource_type, schema, values, location):
+        """Point the partition to a new location, creating it if not registered. The queries of the table see the files
+        of the old location or the files of the new one, never both. Unlike register_partitions the errors are raised,
+        as the files of the old location can only be deleted once the partition was moved.
+
+        Args:
+            resource_type (str): Dataset name
+            schema (pyarrow.Schema): Declared schema of the dataset
+            values (tuple): Year, month and day values of the partition
+            location (str): New S3 location of the partition
+        """
+        table_name = self.table_name(resource_type)
+        partition_input = {
+            "Values": list(values),
+            "StorageDescriptor": {
+                "Columns": glue_columns(schema),
+                "Location": location,
+                **PARQUET_STORAGE,
+            },
+        }
+        try:
+            self.glue_client.update_partition(
+                DatabaseName=self.database,
+                TableName=table_name,
+                PartitionValueList=list(values),
+                PartitionInput=partition_input,
+            )
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "EntityNotFoundException":
+                raise
+            self.glue_client.create_partition(
+                DatabaseName=self.database, TableName=table_name, PartitionInput=partition_input
+            )
+
+        self.partitions.add((table_name, tuple(values)))
+        LOGGER.info(f"---- GLUE PARTITION {self.database}.{table_name} {values} MOVED TO {location} ----")
@@ -27,7 +27,8 @@ import json
 import requests
 from datetime import datetime
 import boto3
-from utils import aws_signature
+from botocore.exceptions import ClientError
+from utils import aws_signature, fhir_payload_helper
 from utils.exceptions import HealthLakePostError, AWSKeyMissingError, HealthLakePostTooManyRequestsError
 
 # Instatiate the Logger to save messages to Cloudwatch
@@ -36,6 +37,7 @@ LOGGER.setLevel(logging.INFO)
 
 # Load the enviroment variables
 CCDS_SQSMESSAGE_TABLE_LOG = os.environ["CCDS_SQSMESSAGE_TABLE_LOG"]
+CCDS_HASH_TABLE_LOG = os.environ["CCDS_HASH_TABLE_LOG"]
 BUCKET_PROCESSED_FHIR_RESOURCES = os.environ["BUCKET_PROCESSED_FHIR_RESOURCES"]
 FOLDER_PROCESSED_FHIR_RESOURCES = os.environ["FOLDER_PROCESSED_FHIR_RESOURCES"]
 HEALTHLAKE_ENDPOINT = os.environ["HEALTHLAKE_ENDPOINT"]
@@ -94,6 +96,36 @@ def update_dynamodb_log(messageId, status, error_result):
         raise e
 
 
+def update_hash_status(ccd_hash, status, messageId):
+    """Updates the status of the hash, so the deduplication step finds it without reading the message log.
+    The hash is only updated if it is still owned by the message, a message that lost its claim doesn't overwrite the owner
+
+    Args:
+        ccd_hash (str): MD5 hash key of the file content
+        status (str): Current Status of the pipeline
+        messageId (str): SQS message id, owner of the hash
+
+    Raises:
+        e: Client Exception if error updating the record
+    """
+    try:
+        DYNAMODB_CLIENT.update_item(
+            TableName=CCDS_HASH_TABLE_LOG,
+            Key={"ccd_hash": {"S": ccd_hash}},
+            ExpressionAttributeNames={"#status": "status"},
+            ExpressionAttributeValues={":s": {"S": status}, ":m": {"S": messageId}},
+            UpdateExpression="SET #status=:s",
+            ConditionExpression="messageId = :m",
+        )
+    except ClientError as e:
+        # The hash was removed by the exception handler, or claimed by another message with the same content
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            LOGGER.info(f"CCDA HASH {ccd_hash} not owned by message {messageId}, not updated")
+            return
+        LOGGER.error(f"## DYNAMODB UPDATE HASH EXCEPTION: {str(e)}")
+        raise e
+
+
 def post_healthlake(full_url, headers, fhir_resource, event):
     """Send the FHIR resource to HealthLake endpoint
     If a 429 error is returned, the step function will catch the exception wait for 10s and try again.
@@ -167,11 +199,12 @@ def lambda_handler(event, context):
         month = str(datetime.today().month)
         day = str(datetime.today().day)
 
-        fhir_bucket = event["Fhir"]["bucket"]
         fhir_filename = event["Fhir"]["key"]
 
-        fhir_file = S3_CLIENT.get_object(Bucket=fhir_bucket, Key=fhir_filename)
-        fhir_content = json.loads(fhir_file["Body"].read())
+        # The bundle comes inline in the event if it is small, otherwise it is read from S3,
+        # and it is decompressed by its encoding
+        fhir_inline = fhir_payload_helper.pop_inline_payload(event["Fhir"])
+        fhir_content = json.loads(fhir_payload_helper.read_fhir_payload(S3_CLIENT, event["Fhir"], fhir_inline))
 
         f_name = os.path.basename(fhir_filename)
 
@@ -232,6 +265,8 @@ def lambda_handler(event, context):
         key = event["Object"]["key"]
         S3_CLIENT.delete_object(Bucket=bucket_landing, Key=f"{key}")
         update_dynamodb_log(sqs_message_id, event["Status"], "")
+        if "md5_digest" in event["Object"]:
+            update_hash_status(event["Object"]["md5_digest"], event["Status"], sqs_message_id)
     else:
         event["Status"] = "FAILED"
         update_dynamodb_log(sqs_message_id, event["Status"], "ERROR: STEP6, Fail to save FHIR Bundle to HelathLake")
@@ -34,8 +34,9 @@ def lambda_handler(event, context):
 
     s3 = boto3.client("s3")
 
+    # The SHA-256 checksum lets the deduplication step skip the download of the file
     try:
-        s3_response = s3.put_object(Bucket=BUCKET_NAME, Key=FILE_NAME, Body=xml)
+        s3_response = s3.put_object(Bucket=BUCKET_NAME, Key=FILE_NAME, Body=xml, ChecksumAlgorithm="SHA256")
     except Exception as e:
         print("Error: {}.".format(e.response["Error"]["Message"]))
         raise IOError(e)
@@ -28,6 +28,7 @@ import {createLambda, createLambdaWithLayer, creates3bucket} from "./helpers";
 
 export interface juvareStackProps extends StackProps {
   readonly envName: string;
+  readonly hashRetentionDays: number;
 }
 
 export class bedcapStack extends Stack {
@@ -35,6 +36,8 @@ export class bedcapStack extends Stack {
     super(app, id, props);
 
     const envName = props.envName
+    // Days the hashes are kept for deduplication, expired by the DynamoDB TTL, 0 never expires
+    const hashRetentionDays = props.hashRetentionDays
 
     // IAM role for processCCDA, .. add more tbd
 
@@ -115,6 +118,7 @@ export class bedcapStack extends Stack {
       encryption: dynamodb.TableEncryption.CUSTOMER_MANAGED,
       encryptionKey: kmsBedCapKey,
       partitionKey: {name: 'md5Digest', type: dynamodb.AttributeType.STRING},
+      timeToLiveAttribute: 'expiration_time',
       removalPolicy: RemovalPolicy.DESTROY,
     })
     bedcap_hash_table_log.grantFullAccess(roleLambdaProcessBedCap)
@@ -203,6 +207,7 @@ export class bedcapStack extends Stack {
         BUCKET_RAW_JUVARE_FOLDER: 'raw_cdph_idph',
         DYNAMODB_JUVARE_EXECUTION_LOG: bedcap_execution_log.tableName,
         DYNAMODB_JUVARE_HASH_TABLE_LOG: bedcap_hash_table_log.tableName,
+        HASH_RETENTION_DAYS: String(hashRetentionDays),
         GLUE_CRAWLER_JUVARE_CDPH_IDPH: envName+'JuvareDailyCDPHIDPHCrawler',
         SNS_TOPIC_ARN: BedCapProcessingTopic.topicArn
       });
@@ -216,6 +221,7 @@ export class bedcapStack extends Stack {
         BUCKET_RAW_JUVARE_FOLDER: 'raw_daily_havbed',
         DYNAMODB_JUVARE_EXECUTION_LOG: bedcap_execution_log.tableName,
         DYNAMODB_JUVARE_HASH_TABLE_LOG: bedcap_hash_table_log.tableName,
+        HASH_RETENTION_DAYS: String(hashRetentionDays),
         GLUE_CRAWLER_JUVARE_HAVE_BED: envName+'JuvareDailyHaveBedCrawler',
         SNS_TOPIC_ARN: BedCapProcessingTopic.topicArn
       });
@@ -225,6 +231,7 @@ export class bedcapStack extends Stack {
         BUCKET_PROCESSED_HHS: s3ProcessedBedCap.bucket.bucketName,
         DYNAMODB_HHS_EXECUTION_LOG: bedcap_execution_log.tableName,
         DYNAMODB_HHS_HASH_TABLE_LOG: bedcap_hash_table_log.tableName,
+        HASH_RETENTION_DAYS: String(hashRetentionDays),
         GLUE_CRAWLER_HHS: envName+'HHSBedCapacityCrawler',
         SNS_TOPIC_ARN: BedCapProcessingTopic.topicArn
       })
@@ -29,6 +29,8 @@ import tasks = require('@aws-cdk/aws-stepfunctions-tasks');
 import api = require('@aws-cdk/aws-apigatewayv2');
 import restapi = require('@aws-cdk/aws-apigateway');
 import ssm = require('@aws-cdk/aws-ssm')
+import events = require('@aws-cdk/aws-events');
+import targets = require('@aws-cdk/aws-events-targets');
 import {SqsEventSource} from '@aws-cdk/aws-lambda-event-sources';
 import {LambdaProxyIntegration} from '@aws-cdk/aws-apigatewayv2-integrations';
 import {App, CfnOutput, Duration, Fn, RemovalPolicy, Stack, StackProps} from "@aws-cdk/core";
@@ -37,6 +39,12 @@ import {createLambda, createLambdaWithLayer, creates3bucket} from "./helpers";
 export interface fhirStackProps extends StackProps {
   readonly envName: string;
   readonly healthLakeEndpoint: string;
+  readonly ccdBatchSize: number;
+  readonly ccdBatchingWindowSeconds: number;
+  readonly ccdFusedValidation: boolean;
+  readonly ccdValidationMode: string;
+  readonly cdaSchemaKey: string;
+  readonly hashRetentionDays: number;
 }
 
 export class fhirStack extends Stack {
@@ -45,6 +53,24 @@ export class fhirStack extends Stack {
 
     const envName = props.envName
     const healthLakeEndpoint = props.healthLakeEndpoint
+    // Micro-batching: step0 packs up to ccdBatchSize messages, or whatever arrives within the window, into one execution
+    const ccdBatchSize = props.ccdBatchSize
+    const ccdBatchingWindowSeconds = props.ccdBatchingWindowSeconds
+    // Fused validation: step3 validates and hashes each file in a single read, the ValidateFile state is skipped
+    const ccdFusedValidation = props.ccdFusedValidation
+    // Validation of step2: FULL, SNIFF or STRICT, STRICT validates the CCDs against the CDA schema with lxml
+    const ccdValidationMode = props.ccdValidationMode
+    if (!['FULL', 'SNIFF', 'STRICT'].includes(ccdValidationMode)) {
+      throw new Error(`ccdValidationMode ${ccdValidationMode} is not supported, use FULL, SNIFF or STRICT`)
+    }
+    // The fused mode skips step2, the CDA schema is only loaded by step2
+    if (ccdFusedValidation && ccdValidationMode === 'STRICT') {
+      throw new Error('ccdValidationMode STRICT is not supported with ccdFusedValidation, use FULL or SNIFF')
+    }
+    // Key of the main CDA XSD file in the processed bucket, its folder has the included XSD files
+    const cdaSchemaKey = props.cdaSchemaKey
+    // Days the hashes are kept for deduplication, expired by the DynamoDB TTL, 0 never expires
+    const hashRetentionDays = props.hashRetentionDays
     const ssm_base_path = '/'+envName+'/fhirConv/'
     // VPC imports
     const privateSubnetIds = Fn.split(",", Fn.importValue(envName+"-privateSubnets"));
@@ -149,6 +175,7 @@ export class fhirStack extends Stack {
       encryption: dynamodb.TableEncryption.CUSTOMER_MANAGED,
       encryptionKey: kmsDatabaseKey,
       partitionKey: {name: 'ccd_hash', type: dynamodb.AttributeType.STRING},
+      timeToLiveAttribute: 'expiration_time',
       removalPolicy: RemovalPolicy.DESTROY,
     })
     ccds_hash_table_log.grantFullAccess(roleLambdaProcessCCD)
@@ -182,6 +209,17 @@ export class fhirStack extends Stack {
     })
     ccds_sfn_exceptions_log.grantFullAccess(roleLambdaProcessCCD)
 
+    // circuit breaker state of the FHIR converter endpoints, shared by the concurrent step4 lambdas
+    const converter_breaker_state = new dynamodb.Table(this, 'converter_breaker_state', {
+      tableName: envName+'-converter_breaker_state',
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      encryption: dynamodb.TableEncryption.CUSTOMER_MANAGED,
+      encryptionKey: kmsDatabaseKey,
+      partitionKey: {name: 'endpoint', type: dynamodb.AttributeType.STRING},
+      removalPolicy: RemovalPolicy.DESTROY,
+    })
+    converter_breaker_state.grantReadWriteData(roleLambdaProcessCCD)
+
     //
     // SQS
     //
@@ -233,18 +271,45 @@ export class fhirStack extends Stack {
         BUCKET_PROCESSED_CCDS: s3Processed.bucket.bucketName,
         CCDS_SQSMESSAGE_TABLE_LOG: ccds_sqs_messages_log.tableName,
         FOLDER_PROCESSED_CCDS: 'converted',
+        CCD_QUEUE_URL: ccdQueue.queueUrl,
       });
-
-    const ccda_step2_validation = new createLambda(this, envName, roleLambdaProcessCCD, 'ccda_step2_validation',
-      {
-        CCDS_SQSMESSAGE_TABLE_LOG: ccds_sqs_messages_log.tableName,
-      }
-      );
+    // The files expanded from compressed batches are sent back to the queue, one message each
+    ccdQueue.grantSendMessages(ccda_step1_new_files.lambdaFunction)
+
+    const step2Environment: { [key: string]: string; } = {
+      CCDS_SQSMESSAGE_TABLE_LOG: ccds_sqs_messages_log.tableName,
+      VALIDATION_MODE: ccdValidationMode,
+      VALIDATE_CCD_STRUCTURE: 'false',
+    }
+    let ccda_step2_validation: createLambda | createLambdaWithLayer
+    if (ccdValidationMode === 'STRICT') {
+      // lxml is built for the lambda runtime by the CDK bundling, so Docker is only needed to deploy the STRICT mode
+      const layerLxml = new lambda.LayerVersion(this, 'lxml', {
+        code: lambda.Code.fromAsset('lambda_layer/lxml', {
+          bundling: {
+            image: lambda.Runtime.PYTHON_3_8.bundlingDockerImage,
+            command: ['bash', '-c', 'pip install -r requirements.txt -t /asset-output/python'],
+          },
+        }),
+        compatibleRuntimes: [lambda.Runtime.PYTHON_3_8],
+        layerVersionName: envName+'-lxml'
+      })
+      ccda_step2_validation = new createLambdaWithLayer(this, envName, roleLambdaProcessCCD, 'ccda_step2_validation', layerLxml,
+        {
+          ...step2Environment,
+          CDA_SCHEMA_LOCATION: 's3://'+s3Processed.bucket.bucketName+'/'+cdaSchemaKey,
+        });
+    } else {
+      ccda_step2_validation = new createLambda(this, envName, roleLambdaProcessCCD, 'ccda_step2_validation', step2Environment);
+    }
 
     const ccda_step3_deduplication = new createLambda(this, envName, roleLambdaProcessCCD, 'ccda_step3_deduplication',
       {
         CCDS_HASH_TABLE_LOG: ccds_hash_table_log.tableName,
         CCDS_SQSMESSAGE_TABLE_LOG: ccds_sqs_messages_log.tableName,
+        FUSED_VALIDATION: ccdFusedValidation ? 'true' : 'false',
+        VALIDATION_MODE: ccdValidationMode,
+        HASH_RETENTION_DAYS: String(hashRetentionDays),
       });
 
     const ccda_step4_converter = new lambda.Function(this, 'ccda_step4_converter', {
@@ -263,6 +328,11 @@ export class fhirStack extends Stack {
         HL7_FHIR_CONVERTER_ENDPOINT: '/api/convert/hl7v2/',
         HL7_FHIR_CONVERTER_TEMPLATENAME: 'ADT_A01.hbs',
         FHIR_CONVERTER_URL: fhirConvUrl.toString(),
+        CONVERTER_BREAKER_TABLE: converter_breaker_state.tableName,
+        FOLDER_CONVERSION_CACHE: 'conversion_cache',
+        CONVERTER_TEMPLATE_VERSION: '1',
+        FHIR_OUTPUT_COMPRESSION: 'gzip',
+        FHIR_INLINE_MAX_BYTES: '65536',
         FOLDER_PROCESSED_CCDS: 'converted',
         },
       vpc: vpc,
@@ -272,17 +342,60 @@ export class fhirStack extends Stack {
     );
 
 
+    //
+    // Glue Database for FHIR, the tables and partitions are registered by step 5, and moved to the merged files by the compaction
+    //
+    const glueDbFhir = new glue.Database(this, envName+'fhir',{
+      databaseName: envName+'-fhir'
+    })
+
+    roleLambdaProcessCCD.addToPolicy(new iam.PolicyStatement({
+      resources: [
+        glueDbFhir.catalogArn,
+        glueDbFhir.databaseArn,
+        'arn:aws:glue:'+this.region+':'+this.account+':table/'+glueDbFhir.databaseName+'/*',
+      ],
+      actions: ['glue:GetTable', 'glue:CreateTable', 'glue:BatchCreatePartition', 'glue:GetPartition', 'glue:CreatePartition', 'glue:UpdatePartition'],
+    }))
+
     const ccda_step5_dataset_builder = new createLambdaWithLayer(this, envName, roleLambdaProcessCCD, 'ccda_step5_dataset_builder',layerWrangler,
       {
         BUCKET_PROCESSED_FHIR_DATASETS: s3Processed.bucket.bucketName,
         CCDS_SQSMESSAGE_TABLE_LOG: ccds_sqs_messages_log.tableName,
-        FOLDER_PROCESSED_FHIRS_DATASETS: 'fhir_datasets'
+        FOLDER_PROCESSED_FHIRS_DATASETS: 'fhir_datasets',
+        GLUE_DATABASE: glueDbFhir.databaseName,
+        GLUE_TABLE_PREFIX: 'fhir_',
       });
 
+    // Merge the small parquet files saved by step 5 for each message, after the end of each day
+    const ccda_dataset_compaction = new lambda.Function(this, 'ccda_dataset_compaction', {
+      functionName: envName + '-' + 'ccda_dataset_compaction',
+      runtime: lambda.Runtime.PYTHON_3_8,
+      timeout: Duration.seconds(900),
+      memorySize: 3008,
+      handler: 'lambda_function.lambda_handler',
+      code: lambda.Code.fromAsset('lambda/ccda_dataset_compaction'),
+      layers: [layerWrangler],
+      role: roleLambdaProcessCCD,
+      environment: {
+        BUCKET_PROCESSED_FHIR_DATASETS: s3Processed.bucket.bucketName,
+        FOLDER_PROCESSED_FHIRS_DATASETS: 'fhir_datasets',
+        FOLDER_COMPACTED_FHIR_DATASETS: 'fhir_datasets_compacted',
+        GLUE_DATABASE: glueDbFhir.databaseName,
+        GLUE_TABLE_PREFIX: 'fhir_',
+      },
+    });
+
+    new events.Rule(this, 'DatasetCompactionSchedule', {
+      schedule: events.Schedule.cron({minute: '30', hour: '1'}),
+      targets: [new targets.LambdaFunction(ccda_dataset_compaction)],
+    });
+
     const ccda_step6_fhir_resource_split = new createLambdaWithLayer(this, envName, roleLambdaProcessCCD, 'ccda_step6_fhir_resource_split',layerWrangler,
       {
         BUCKET_PROCESSED_FHIR_RESOURCES: s3Processed.bucket.bucketName,
         CCDS_SQSMESSAGE_TABLE_LOG: ccds_sqs_messages_log.tableName,
+        CCDS_HASH_TABLE_LOG: ccds_hash_table_log.tableName,
         FOLDER_PROCESSED_FHIR_RESOURCES: 'fhir_resources',
         HEALTHLAKE_ENDPOINT: healthLakeEndpoint,
         //HEALTHLAKE_CANONICAL_URI: '/datastore/c93bb7da51d252aac7f77e831d5ca29f/r4/',
@@ -314,14 +427,16 @@ export class fhirStack extends Stack {
     })
     const NotifyFailure = new tasks.SnsPublish(this, 'NotifyFailure',{
         topic: snsCCDConversionStatusTopic,
-        message: sfn.TaskInput.fromJsonPathAt('$')
+        message: sfn.TaskInput.fromJsonPathAt('$'),
+        resultPath: '$.Notification',
       })
-    const Fail = new sfn.Fail(this,'Fail')
+    // A failed record only ends its own iteration, the other records of the execution keep being processed
+    const RecordFailed = new sfn.Pass(this,'RecordFailed')
 
     const exceptionHandler = sfn.Chain
       .start(ExceptionHandler)
       .next(NotifyFailure)
-      .next(Fail)
+      .next(RecordFailed)
 
     const ValidateFile = new tasks.LambdaInvoke(this, 'ValidateFile',{
       lambdaFunction: ccda_step2_validation.lambdaFunction,
@@ -336,7 +451,15 @@ export class fhirStack extends Stack {
     const ConvertToFHIR = new tasks.LambdaInvoke(this, 'ConvertToFHIR',{
       lambdaFunction: ccda_step4_converter,
       outputPath: '$.Payload',
-    }).addCatch(exceptionHandler)
+    })
+      // the converter endpoints are open or failing, wait for the circuit breaker to let requests through again
+      .addRetry({
+        maxAttempts: 3,
+        interval: Duration.seconds(30),
+        backoffRate: 2,
+        errors: ['ConverterUnavailableError']
+      })
+      .addCatch(exceptionHandler)
 
     const BuildFHIRDatasets = new tasks.LambdaInvoke(this, 'BuildFHIRDatasets',{
       lambdaFunction: ccda_step5_dataset_builder.lambdaFunction,
@@ -373,9 +496,11 @@ export class fhirStack extends Stack {
       lambdaFunction: ccda_finish_stepfunction.lambdaFunction,
     })
 
-    const validateMapChain = sfn.Chain
-      .start(ValidateFile)
-      .next(Deduplication)
+    const validateMapStart = ccdFusedValidation
+      ? sfn.Chain.start(Deduplication)
+      : sfn.Chain.start(ValidateFile).next(Deduplication)
+
+    const validateMapChain = validateMapStart
       .next(ConvertToFHIR)
       .next(BuildFHIRDatasets)
       .next(SaveFHIRResources)
@@ -407,12 +532,19 @@ export class fhirStack extends Stack {
       {
         CCDS_SQSMESSAGE_TABLE_LOG: ccds_sqs_messages_log.tableName,
         SFN_ARN: stateMachine.stateMachineArn,
+        SFN_MAX_INPUT_BYTES: '200000',
       });
     // Lambda Triggers
-    ccda_step0_start_state_machine.lambdaFunction.addEventSource(new SqsEventSource(ccdQueue,{
-      batchSize: 1,
+    ccdQueue.grantConsumeMessages(ccda_step0_start_state_machine.lambdaFunction)
+    const ccdQueueEventSource = ccda_step0_start_state_machine.lambdaFunction.addEventSourceMapping('ccdQueueEventSource', {
+      eventSourceArn: ccdQueue.queueArn,
+      batchSize: ccdBatchSize,
+      maxBatchingWindow: Duration.seconds(ccdBatchingWindowSeconds),
       enabled: true
-    }));
+    })
+    // step0 returns batchItemFailures, only the failed records go back to the queue
+    const cfnCcdQueueEventSource = ccdQueueEventSource.node.defaultChild as lambda.CfnEventSourceMapping
+    cfnCcdQueueEventSource.addPropertyOverride('FunctionResponseTypes', ['ReportBatchItemFailures'])
 
 
 
@@ -490,24 +622,6 @@ export class fhirStack extends Stack {
 
 
 
-    //
-    // Glue Crawler for FHIR
-    //
-    const glueDbFhir = new glue.Database(this, envName+'fhir',{
-      databaseName: envName+'-fhir'
-    })
-
-    const FHIRProcessedCrawler = new glue.CfnCrawler(this, 'FHIRProcessedCrawler',{
-      name: envName+'FHIRProcessedCrawler',
-      role: roleGlueService.roleArn,
-      databaseName: glueDbFhir.databaseName,
-      schedule: {"scheduleExpression": "cron(0 0 * * ? *)"},
-      targets: {
-        s3Targets: [{
-          path: 's3://'+s3Processed.bucket.bucketName+'/fhir_datasets/'
-        }]
-      }
-    })
 
 
     //
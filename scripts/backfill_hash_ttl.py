@@ -0,0 +1,171 @@
+"""
+File: backfill_hash_ttl.py
+Project: scripts
+Description: Set the expiration_time TTL attribute on the hash table items saved before the retention was configured
+
+The table is read with parallel segmented scans, and the items of each page are updated in parallel with conditional updates.
+Only the TTL attribute is set, and only if the item still has the scanned creation_date and no TTL,
+so a claim or a status saved by the pipelines while the backfill runs is never rolled back.
+
+Usage:
+    python scripts/backfill_hash_ttl.py --table dev-ccd_hash_table_log --retention-days 365
+    python scripts/backfill_hash_ttl.py --table dev-bedcap_hash_table_log --retention-days 365 --segments 8 --workers 32 --dry-run
+"""
+
+# Import the libraries
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import boto3
+
+# Instatiate the Logger
+logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s")
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+TTL_ATTRIBUTE = "expiration_time"
+
+
+def expiration_time(item, retention_days):
+    """TTL of the item, counted from its creation_date, or from now if the item has no creation_date
+
+    Args:
+        item (dict): DynamoDB item
+        retention_days (int): Days the hashes are kept
+
+    Returns:
+        int: Expiration timestamp in seconds
+    """
+    if "creation_date" in item:
+        creation_date = datetime.fromtimestamp(int(float(item["creation_date"]["N"])))
+    else:
+        creation_date = datetime.now()
+    return int((creation_date + timedelta(days=retention_days)).timestamp())
+
+
+def update_item_ttl(dynamodb_client, table, key, creation_date, ttl):
+    """Set the TTL of an item without rewriting the other attributes.
+    The item is only updated if it is still the scanned version: same creation_date and no TTL,
+    an item claimed again by the pipelines gets its TTL from the pipeline itself.
+
+    Args:
+        dynamodb_client (botocore.client.DynamoDB): DynamoDB client
+        table (str): Table name
+        key (dict): Key of the item
+        creation_date (dict): Scanned creation_date attribute value, None if the item has none
+        ttl (int): Expiration timestamp in seconds
+
+    Returns:
+        bool: True if updated, False if the item was deleted or changed during the backfill
+    """
+    expression_names = {"#ttl": TTL_ATTRIBUTE, "#key": next(iter(key)), "#c": "creation_date"}
+    expression_values = {":x": {"N": f"{ttl}"}}
+    condition = "attribute_exists(#key) AND attribute_not_exists(#ttl)"
+    if creation_date is None:
+        condition += " AND attribute_not_exists(#c)"
+    else:
+        expression_values[":c"] = creation_date
+        condition += " AND #c = :c"
+
+    try:
+        dynamodb_client.update_item(
+            TableName=table,
+            Key=key,
+            ExpressionAttributeNames=expression_names,
+            ExpressionAttributeValues=expression_values,
+            UpdateExpression="SET #ttl=:x",
+            ConditionExpression=condition,
+        )
+        return True
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def backfill_segment(table, key_attributes, segment, total_segments, retention_days, workers, dry_run):
+    """Scan a segment of the table and set the TTL on the items without it, the items of a page are updated in parallel
+
+    Args:
+        table (str): Table name
+        key_attributes (list): Names of the key attributes
+        segment (int): Segment scanned
+        total_segments (int): Number of segments of the scan
+        retention_days (int): Days the hashes are kept
+        workers (int): Parallel updates of the segment
+        dry_run (bool): If True, only count the items
+
+    Returns:
+        dict: Number of scanned, updated and skipped items, the skipped ones changed during the backfill
+    """
+    dynamodb_client = boto3.client("dynamodb")
+    paginator = dynamodb_client.get_paginator("scan")
+    counts = {"scanned": 0, "updated": 0, "skipped": 0}
+
+    pages = paginator.paginate(
+        TableName=table,
+        Segment=segment,
+        TotalSegments=total_segments,
+        ExpressionAttributeNames={"#ttl": TTL_ATTRIBUTE},
+        FilterExpression="attribute_not_exists(#ttl)",
+    )
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for page in pages:
+            counts["scanned"] += page["ScannedCount"]
+            if dry_run:
+                counts["updated"] += len(page["Items"])
+                continue
+
+            futures = [
+                executor.submit(
+                    update_item_ttl,
+                    dynamodb_client,
+                    table,
+                    {name: item[name] for name in key_attributes},
+                    item.get("creation_date"),
+                    expiration_time(item, retention_days),
+                )
+                for item in page["Items"]
+            ]
+            for future in futures:
+                counts["updated" if future.result() else "skipped"] += 1
+
+    LOGGER.info(f"Segment {segment}/{total_segments} finished: {counts}")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Set the expiration_time TTL on the items of a hash table")
+    parser.add_argument("--table", required=True, help="Hash table name")
+    parser.add_argument("--retention-days", required=True, type=int, help="Days the hashes are kept")
+    parser.add_argument("--segments", type=int, default=4, help="Parallel scan segments, default 4")
+    parser.add_argument("--workers", type=int, default=16, help="Parallel updates of each segment, default 16")
+    parser.add_argument("--dry-run", action="store_true", help="Count the items without writing")
+    args = parser.parse_args()
+
+    dynamodb_client = boto3.client("dynamodb")
+    key_schema = dynamodb_client.describe_table(TableName=args.table)["Table"]["KeySchema"]
+    key_attributes = [key["AttributeName"] for key in key_schema]
+
+    with ThreadPoolExecutor(max_workers=args.segments) as executor:
+        results = list(
+            executor.map(
+                lambda segment: backfill_segment(
+                    args.table,
+                    key_attributes,
+                    segment,
+                    args.segments,
+                    args.retention_days,
+                    args.workers,
+                    args.dry_run,
+                ),
+                range(args.segments),
+            )
+        )
+
+    totals = {name: sum(result[name] for result in results) for name in results[0]}
+    LOGGER.info(f"Backfill of {args.table} finished{' (dry run)' if args.dry_run else ''}: {totals}")
+
+
+if __name__ == "__main__":
+    main()